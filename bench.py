@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Round trips, wall time and memory of shell commands against the simulator
+
+from vcenter_shell import VcenterShell
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+import tracemalloc
+import core
+import simulator
+
+# what a benchmark run does by default, in order
+COMMANDS = [
+    'list_tenants',
+    'list_clusters',
+    'list_datastores',
+    'list_vms tenant0',
+    'list_vms tenant0 -r',
+    'list_templates',
+    'find_vm vm00042',
+    'find_vm vm0004*',
+    'vm_info vm00001',
+    'clone bench01 centos7 tenant0 CL01 DS01 4 8 default EPG1',
+    'clone bench02 centos7 tenant0 auto auto default default default default',
+    'set bench01 2 4 default',
+    'add disk bench01 8x10',
+    'power on bench01 bench02',
+    'power off --tenant tenant1',
+    'vm_stats --tenant tenant0 --top 10',
+    'host_stats',
+    'remove_vm bench02',
+]
+
+def bench(commands, memory=True, **sim_options):
+    """
+    Run commands in a shell connected to a new simulator. Returns a result
+    per command: command, round trips and calls by method, wall seconds
+    and with memory the peak traced allocation in bytes.
+    """
+    stub, content = simulator.connect(**sim_options)
+    site = simulator.register(content)
+    # the inventory a connected shell keeps, without an on-disk snapshot
+    core._inventories[content] = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES)
+    shell = VcenterShell()
+    shell.assume_yes = True
+    shell.sites = [(site, content)]
+    shell.use(site, content)
+    results = []
+    for line in commands:
+        stub.calls.clear()
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            shell.onecmd(line)
+        wall = time.perf_counter() - start
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append({'command': line, 'round_trips': sum(stub.calls.values()),
+                        'calls': dict(stub.calls), 'wall': wall, 'memory': peak,
+                        'error': any(l.startswith('ERR') for l in output.getvalue().splitlines())})
+    return results
+
+def compare(results, baseline):
+    """ commands that take more round trips than in baseline results """
+    before = {result['command']: result for result in baseline}
+    return [result['command'] for result in results if result['command'] in before
+            and result['round_trips'] > before[result['command']]['round_trips']]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark shell commands against the vcenter simulator')
+    parser.add_argument('commands', nargs='*', help='shell commands to benchmark (default a standard set)')
+    parser.add_argument('--vms', type=int, default=5000, help='simulated vms (default 5000)')
+    parser.add_argument('--tenants', type=int, default=50, help='tenant folders (default 50)')
+    parser.add_argument('--depth', type=int, default=2, help='nested folders per tenant (default 2)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--task-time', type=float, default=0.05, help='seconds a task runs')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory, it slows things down")
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    parser.add_argument('--save', help='write results to this file, as a baseline')
+    parser.add_argument('--check', help='fail when a command takes more round trips than in this baseline')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = bench(args.commands or COMMANDS, memory=not args.no_memory, vms=args.vms,
+                    tenants=args.tenants, depth=args.depth, latency=args.latency,
+                    task_time=args.task_time)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<60s} {:>6s} {:>9s} {:>10s}".format('COMMAND', 'RTT', 'WALL(ms)', 'PEAK(KB)'))
+        print('----')
+        for result in results:
+            print("{:<60s} {:>6d} {:>9.1f} {:>10s}{}".format(
+                  result['command'][:60], result['round_trips'], result['wall'] * 1000,
+                  '-' if result['memory'] is None else str(result['memory'] // 1024),
+                  '  ERR' if result['error'] else ''))
+        print("{} vms, {:.1f}s in all".format(args.vms, time.perf_counter() - start))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.check:
+        with open(args.check) as f:
+            worse = compare(results, json.load(f))
+        for command in worse:
+            print("ERR: more round trips than the baseline: {}".format(command), file=sys.stderr)
+        return 1 if worse else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,163 +2,1845 @@
 #
 # Core modules for operate with vcenter
 
-from pyVim.connect import SmartConnectNoSSL, Disconnect
-from pyVmomi import vim
+from pyVim.connect import SmartStubAdapter, VimSessionOrientedStub
+from pyVmomi import vim, vmodl, SoapAdapter
+import contextlib
+import contextvars
+import copy
+import datetime
+import fnmatch
+import heapq
+import http.server
+import ipaddress
+import itertools
 import json
+import asyncio
 import atexit
+import os
+import pickle
+import queue
+import re
+import shlex
+import ssl
+import sqlite3
+import tempfile
+import zlib
+import threading
+import time
+import urllib.request
+from concurrent.futures import (ThreadPoolExecutor, Future, as_completed, wait as futures_wait,
+                                FIRST_EXCEPTION, FIRST_COMPLETED, ALL_COMPLETED)
 
 GB = 1024*1024*1024
 __credentials__ = '.credentials'
+__snapshot__ = '.inventory.db'
+__session__ = '.session'
+# seconds between keep-alive calls on an idle session
+KEEPALIVE = 300
+# pooled SOAP connections per session
+POOL_SIZE = 8
+# seconds wait_for_task gives a task before giving up on it
+TASK_TIMEOUT = 3600
+# template snapshot linked clones are based on
+LINKED_SNAPSHOT = 'vcenter_shell-linked-base'
+CLONE_MODES = ('full', 'linked', 'instant')
+# default in-flight provisioning tasks per cluster and per datastore
+CLUSTER_TASKS = 4
+DATASTORE_TASKS = 2
+# datacenter of a .credentials entry without VC_DATACENTER
+DATACENTER = 'DC01'
+# clone cluster / datastore picked by the placement engine
+AUTO = 'auto'
+
+# seconds the inventory follower's WaitForUpdatesEx waits for a change
+INVENTORY_WAIT = 60
+# seconds the inventory follower waits after vcenter couldn't be reached
+INVENTORY_RETRY = 5
+# seconds a lookup waits for the first inventory fill before asking vcenter itself
+INVENTORY_READY = 30
+# managed object types kept in the name -> MoRef inventory index
+INVENTORY_TYPES = [vim.Datacenter, vim.Folder, vim.ComputeResource,
+                   vim.HostSystem, vim.ResourcePool, vim.Datastore,
+                   vim.Network, vim.DistributedVirtualSwitch,
+                   vim.VirtualMachine]
 
 def vc_credentials(filename):
     with open(filename) as f:
         credentials = json.load(f)
     return credentials
 
+def vc_sites(filename=__credentials__):
+    """
+    Configured vcenters. The credentials file holds one credentials object or
+    a list of them, each with optional VC_DATACENTER (default DATACENTER) and
+    VC_NAME, the source name in merged listings (default VC_HOST, plus the
+    datacenter when a host is listed more than once).
+    """
+    try:
+        credentials = vc_credentials(filename)
+    except FileNotFoundError:
+        raise SystemExit('No {} file found'.format(filename))
+    if not isinstance(credentials, list):
+        credentials = [credentials]
+    sites = [dict(creds) for creds in credentials]
+    hosts = [creds['VC_HOST'] for creds in sites]
+    for creds in sites:
+        creds.setdefault('VC_DATACENTER', DATACENTER)
+        if hosts.count(creds['VC_HOST']) > 1:
+            creds.setdefault('VC_NAME', '{}/{}'.format(creds['VC_HOST'], creds['VC_DATACENTER']))
+        creds.setdefault('VC_NAME', creds['VC_HOST'])
+    return sites
+
+def _prop_specs(vimtype, path_set):
+    """ path_set is either one list for all types or a {type: paths} dict """
+    pc = vmodl.query.PropertyCollector
+    if isinstance(path_set, dict):
+        return [pc.PropertySpec(type=t, pathSet=path_set[t]) for t in vimtype]
+    return [pc.PropertySpec(type=t, pathSet=path_set) for t in vimtype]
+
+def _view_filter_spec(view, vimtype, path_set):
+    """ filter spec selecting path_set of every vimtype object in a container view """
+    pc = vmodl.query.PropertyCollector
+    traversal = pc.TraversalSpec(name='traverseView', path='view', skip=False,
+                                 type=vim.view.ContainerView)
+    obj_spec = pc.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    return pc.FilterSpec(objectSet=[obj_spec], propSet=_prop_specs(vimtype, path_set))
+
+class Inventory(object):
+    """
+    In-process (type, name) -> MoRef index of the whole vcenter inventory.
+    Filled once by its own property collector and kept current by follow(),
+    a background WaitForUpdatesEx loop, so a lookup is a dictionary hit.
+    Only a name that isn't indexed costs a sync() round trip first.
+    With a {type: paths} path_set such as INVENTORY_PROPERTIES it also keeps
+    the listing properties, answers query() from memory and can be saved to
+    and loaded from an on-disk snapshot.
+    """
+    def __init__(self, content, vimtype=INVENTORY_TYPES, path_set=['name'], fill=True):
+        if isinstance(path_set, dict):
+            vimtype = list(path_set)
+        self.content = content
+        self.vimtype = vimtype
+        self.path_set = path_set
+        self.version = ''
+        self.objects = {}
+        self.index = {}
+        self.types = set()
+        # bumped on every change, derived indexes rebuild when it moves
+        self.generation = 0
+        # objects added by name only, until vcenter sends their properties
+        self.partial = set()
+        self.lock = threading.RLock()
+        # data to serve, from a fill() or a snapshot
+        self.ready = threading.Event()
+        # data from a collector that's alive, cleared while a lost one is replaced
+        self.loaded = threading.Event()
+        self.collector = None
+        self.view = None
+        # one WaitForUpdatesEx on the collector at a time
+        self.polling = threading.Lock()
+        # notified after every WaitForUpdatesEx round
+        self.rounds = threading.Condition()
+        # monotonic time the last finished round started, and the latest a sync() asks for
+        self.synced = 0
+        self.wanted = 0
+        self.follower = None
+        self.stopped = threading.Event()
+        # why the follower's last fill() failed, None once one works
+        self.error = None
+        if fill:
+            self.fill()
+
+    def _attach(self):
+        self.collector = self.content.propertyCollector.CreatePropertyCollector()
+        self.view = self.content.viewManager.CreateContainerView(
+                    self.content.rootFolder, self.vimtype, True)
+        # whole values, a partial update would report config.hardware.device[4000]
+        # and the like instead of the array it changes
+        self.collector.CreateFilter(_view_filter_spec(self.view, self.vimtype, self.path_set),
+                                    partialUpdates=False)
+        self.version = ''
+
+    def fill(self):
+        """ load everything through a new filter, the old data is served until it's done """
+        fresh = Inventory(self.content, self.vimtype, self.path_set, fill=False)
+        fresh._attach()
+        fresh.refresh()
+        with self.lock:
+            old = (self.collector, self.view)
+            self.objects, self.index, self.types = fresh.objects, fresh.index, fresh.types
+            self.partial = fresh.partial
+            self.generation += 1
+            self.collector, self.view, self.version = fresh.collector, fresh.view, fresh.version
+        self.ready.set()
+        self.loaded.set()
+        self.error = None
+        with self.rounds:
+            self.rounds.notify_all()
+        self._close(*old)
+
+    def _poll(self, wait):
+        """ one WaitForUpdatesEx round, truncated updates included, under self.polling """
+        collector = self.collector
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=wait)
+        start = time.monotonic()
+        while collector is not None:
+            update = collector.WaitForUpdatesEx(self.version, options)
+            if update is None:
+                break
+            with self.lock:
+                if collector is not self.collector:
+                    # a fill() replaced it meanwhile
+                    break
+                self.version = update.version
+                for filter_set in update.filterSet:
+                    for obj_update in filter_set.objectSet:
+                        self._apply(obj_update)
+            if not update.truncated:
+                break
+        with self.rounds:
+            self.synced = max(self.synced, start)
+            self.rounds.notify_all()
+
+    def refresh(self, wait=0):
+        """ apply pending inventory changes, waiting up to wait seconds for one """
+        with self.polling:
+            self._poll(wait)
+
+    def _lost(self, collector):
+        """ collector went away with its session or lost our version, follow() replaces it """
+        with self.lock:
+            if collector is None or collector is not self.collector:
+                return
+            self.collector = self.view = None
+            self.loaded.clear()
+        with self.rounds:
+            self.rounds.notify_all()
+        self.follow()
+
+    def reconcile(self):
+        """
+        Catch up with vcenter after a snapshot load: a WaitForUpdatesEx version
+        delta while the saved collector still lives, a full reload by the
+        follower otherwise. Returns once the data is current.
+        """
+        collector = self.collector
+        try:
+            self.refresh()
+        except vmodl.MethodFault:
+            self._lost(collector)
+        if self.collector is None:
+            self.follow()
+        self.loaded.wait()
+
+    def follow(self):
+        """ keep the index current from a background WaitForUpdatesEx loop, started once """
+        with self.lock:
+            if self.stopped.is_set() or (self.follower is not None and self.follower.is_alive()):
+                return
+            self.follower = threading.Thread(target=self._follow, daemon=True)
+            self.follower.start()
+
+    def _follow(self):
+        while not self.stopped.is_set():
+            collector = self.collector
+            try:
+                if collector is None:
+                    try:
+                        self.fill()
+                    except Exception as err:
+                        # lookups waiting on the data give up on it
+                        with self.rounds:
+                            self.error = err
+                            self.rounds.notify_all()
+                        raise
+                    continue
+                with self.polling:
+                    # a sync() waiting on us gets a round that doesn't wait
+                    self._poll(0 if self.wanted > self.synced else INVENTORY_WAIT)
+            except vmodl.fault.RequestCanceled:
+                continue
+            except vmodl.MethodFault:
+                if collector is None:
+                    self.stopped.wait(INVENTORY_RETRY)
+                self._lost(collector)
+            except Exception:
+                # vcenter unreachable, try again in a while
+                self.stopped.wait(INVENTORY_RETRY)
+
+    def _apply(self, obj_update):
+        obj = obj_update.obj
+        if obj_update.kind == 'leave':
+            self.forget(obj)
+            return
+        props = dict(self.objects.get(obj, {}))
+        for change in obj_update.changeSet:
+            if change.op in ('remove', 'indirectRemove'):
+                props.pop(change.name, None)
+            else:
+                props[change.name] = change.val
+        self.add(obj, props)
+        self.partial.discard(obj)
+
+    def _unindex(self, obj, name):
+        key = (type(obj), name)
+        objs = [other for other in self.index.get(key, ()) if other._moId != obj._moId]
+        if objs:
+            self.index[key] = objs
+        else:
+            self.index.pop(key, None)
+
+    def add(self, obj, props):
+        """
+        index obj (or re-index it after a rename) with props, the complete
+        kept properties, or a name only until vcenter sends the rest
+        """
+        with self.lock:
+            old = self.objects.get(obj)
+            if isinstance(props, str):
+                if old:
+                    props = dict(old, name=props)
+                else:
+                    props = {'name': props}
+                    if self.paths(type(obj)) - {'name'}:
+                        self.partial.add(obj)
+            if old:
+                self._unindex(obj, old.get('name'))
+            self.objects[obj] = props
+            # every object of a name, siblings stay findable when one goes
+            self.index.setdefault((type(obj), props.get('name')), []).append(obj)
+            self.types.add(type(obj))
+            self.generation += 1
+
+    def forget(self, obj):
+        """ drop obj from the index """
+        with self.lock:
+            props = self.objects.pop(obj, None)
+            self.partial.discard(obj)
+            self.generation += 1
+            if props:
+                self._unindex(obj, props.get('name'))
+
+    def lookup(self, vimtype, name):
+        objs = self.lookup_all(vimtype, name)
+        return objs[0] if objs else None
+
+    def lookup_all(self, vimtype, name):
+        """ every indexed vimtype object called name """
+        found = []
+        for t in vimtype:
+            found.extend(self.index.get((t, name), ()))
+            for concrete in list(self.types):
+                if concrete is not t and issubclass(concrete, t):
+                    found.extend(self.index.get((concrete, name), ()))
+        return found
+
+    def sync(self):
+        """
+        Apply the changes vcenter has pending. With a follower its waiting
+        WaitForUpdatesEx is cancelled and the round after it, which doesn't
+        wait, is awaited, otherwise it's one WaitForUpdatesEx that doesn't
+        wait. Callers that queue up behind a round started after they asked
+        share it. A collector that's gone is left to the follower to replace,
+        the data at hand is served meanwhile.
+        """
+        asked = time.monotonic()
+        while True:
+            collector = self.collector
+            if collector is None or self.synced >= asked:
+                return
+            if self.follower is None or not self.follower.is_alive():
+                with self.polling:
+                    if self.synced >= asked or collector is not self.collector:
+                        continue
+                    try:
+                        self._poll(0)
+                    except vmodl.fault.RequestCanceled:
+                        continue
+                    except vmodl.MethodFault:
+                        self._lost(collector)
+                return
+            with self.rounds:
+                self.wanted = max(self.wanted, asked)
+            try:
+                collector.CancelWaitForUpdates()
+            except vmodl.MethodFault:
+                # the follower finds out too
+                pass
+            with self.rounds:
+                # a cancel that came before the follower's wait is sent again
+                self.rounds.wait_for(lambda: self.synced >= asked or self.collector is not collector, 0.25)
+
+    def get(self, vimtype, name):
+        """ MoRef of vimtype object called name, None when there is no such object """
+        objs = self.get_all(vimtype, name)
+        return objs[0] if objs else None
+
+    def wait_ready(self):
+        """
+        True once there's data to serve, False when the first fill() takes
+        longer than INVENTORY_READY seconds or failed (the error is in error)
+        """
+        if self.ready.is_set():
+            return True
+        with self.rounds:
+            self.rounds.wait_for(lambda: self.ready.is_set() or self.error is not None,
+                                 INVENTORY_READY)
+        return self.ready.is_set()
+
+    def get_all(self, vimtype, name):
+        """ MoRefs of every vimtype object called name """
+        if not self.wait_ready():
+            # nothing to look in, ask vcenter
+            return [row['obj'] for row in retrieve_properties(self.content, vimtype, ['name'])
+                    if row.get('name') == name]
+        found = self.lookup_all(vimtype, name)
+        if found:
+            return found
+        # created since the follower's last update, or not there at all
+        self.sync()
+        if self.collector is None:
+            # the follower reloads, a name missing from old data proves nothing
+            self.loaded.wait(INVENTORY_READY)
+        return self.lookup_all(vimtype, name)
+
+    def name(self, obj):
+        props = self.objects.get(obj)
+        return props.get('name') if props else None
+
+    def paths(self, vimtype):
+        """ property paths kept for objects of vimtype """
+        if not isinstance(self.path_set, dict):
+            return set(self.path_set)
+        paths = set()
+        for t, kept in self.path_set.items():
+            if issubclass(vimtype, t):
+                paths.update(kept)
+        return paths
+
+    def covers(self, vimtype, path_set):
+        for t in vimtype:
+            wanted = path_set[t] if isinstance(path_set, dict) else path_set
+            if not set(wanted) <= self.paths(t):
+                return False
+        return True
+
+    def _under(self, props, root, recursive):
+        parent = props.get('parent')
+        while parent is not None:
+            if parent == root:
+                return True
+            if not recursive:
+                return False
+            parent = self.objects.get(parent, {}).get('parent')
+        return False
+
+    def select(self, vimtype, path_set, root=None, recursive=True, objs=None):
+        """
+        retrieve_properties() over the kept properties, after a sync() so
+        changes the follower hasn't applied yet are in. Raises the error of
+        a failed first fill.
+        """
+        if not self.wait_ready():
+            raise self.error or Exception("The inventory isn't loaded yet")
+        # serve what vcenter has now, or what the snapshot has while its collector is replaced
+        self.sync()
+        with self.lock:
+            if objs is None:
+                items = list(self.objects.items())
+            else:
+                items = [(obj, self.objects[obj]) for obj in objs if obj in self.objects]
+        for obj, props in items:
+            types = [t for t in vimtype if isinstance(obj, t)]
+            # MoRef hashing is slow, skip it while nothing is partial
+            if not types or (self.partial and obj in self.partial):
+                continue
+            if root is not None and not self._under(props, root, recursive):
+                continue
+            paths = path_set[types[0]] if isinstance(path_set, dict) else path_set
+            row = {path: props[path] for path in paths if props.get(path) is not None}
+            row['obj'] = obj
+            yield row
+
+    def _signature(self):
+        if isinstance(self.path_set, dict):
+            return json.dumps({t.__name__: sorted(paths) for t, paths in self.path_set.items()},
+                              sort_keys=True)
+        return json.dumps(sorted(self.path_set))
+
+    def save(self, host, filename=None):
+        """ write the inventory as the sqlite snapshot of vcenter host """
+        if not self.ready.is_set():
+            return
+        filename = filename or __snapshot__
+        pc = vmodl.query.PropertyCollector
+        stub = self.content.rootFolder._stub
+        with self.lock:
+            items = [(obj, props) for obj, props in self.objects.items()
+                     if obj not in self.partial]
+            state = (self.version,
+                     self.collector._moId if self.collector else None,
+                     self.view._moId if self.view else None)
+        rows = []
+        for obj, props in items:
+            obj_content = pc.ObjectContent(obj=obj, propSet=[
+                vmodl.DynamicProperty(name=path, val=val)
+                for path, val in props.items() if val is not None])
+            rows.append((host, obj._moId, zlib.compress(
+                SoapAdapter.Serialize(obj_content, version=stub.version))))
+        # the snapshot names every vm and host, only its owner reads it
+        os.close(os.open(filename, os.O_WRONLY | os.O_CREAT, 0o600))
+        db = sqlite3.connect(filename)
+        try:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS snapshot (host TEXT PRIMARY KEY, '
+                           'version TEXT, collector TEXT, view TEXT, paths TEXT)')
+                db.execute('CREATE TABLE IF NOT EXISTS object (host TEXT, moid TEXT, '
+                           'props BLOB, PRIMARY KEY (host, moid))')
+                db.execute('DELETE FROM object WHERE host = ?', (host,))
+                db.executemany('INSERT INTO object VALUES (?, ?, ?)', rows)
+                db.execute('INSERT OR REPLACE INTO snapshot VALUES (?, ?, ?, ?, ?)',
+                           (host,) + state + (self._signature(),))
+        finally:
+            db.close()
+
+    @classmethod
+    def load(cls, content, host, path_set, filename=None):
+        """ inventory from the snapshot of vcenter host, None without a usable one """
+        filename = filename or __snapshot__
+        if not os.path.exists(filename):
+            return None
+        pc = vmodl.query.PropertyCollector
+        stub = content.rootFolder._stub
+        inv = cls(content, path_set=path_set, fill=False)
+        db = sqlite3.connect(filename)
+        try:
+            row = db.execute('SELECT version, collector, view, paths FROM snapshot '
+                             'WHERE host = ?', (host,)).fetchone()
+            if not row or row[3] != inv._signature():
+                return None
+            for (blob,) in db.execute('SELECT props FROM object WHERE host = ?', (host,)):
+                obj_content = SoapAdapter.Deserialize(zlib.decompress(blob),
+                                                      pc.ObjectContent, stub=stub)
+                inv.add(obj_content.obj, {prop.name: prop.val for prop in obj_content.propSet})
+        except (sqlite3.Error, zlib.error):
+            return None
+        finally:
+            db.close()
+        inv.version = row[0]
+        inv.collector = vim.PropertyCollector(row[1], stub) if row[1] else None
+        inv.view = vim.view.ContainerView(row[2], stub) if row[2] else None
+        inv.ready.set()
+        if inv.collector is not None:
+            inv.loaded.set()
+        return inv
+
+    def _close(self, collector, view):
+        try:
+            if view is not None:
+                view.DestroyView()
+            if collector is not None:
+                collector.DestroyPropertyCollector()
+        except vmodl.MethodFault:
+            pass
+
+    def close(self):
+        """ stop following and drop the server side collector """
+        self.stopped.set()
+        with self.lock:
+            collector, view = self.collector, self.view
+            self.collector = self.view = None
+        try:
+            if collector is not None:
+                collector.CancelWaitForUpdates()
+        except vmodl.MethodFault:
+            pass
+        self._close(collector, view)
+
+_inventories = {}
+
+def inventory(content):
+    """ inventory index of content's vcenter, built on first use """
+    inv = _inventories.get(content)
+    if inv is None:
+        inv = _inventories[content] = Inventory(content)
+        inv.follow()
+    return inv
+
+def open_inventory(content, host=None, filename=None):
+    """
+    Register an INVENTORY_PROPERTIES inventory for content, served at once
+    from the on-disk snapshot of host (VC_HOST of .credentials by default)
+    when there is one. It's reconciled with vcenter and saved in the
+    background, then followed, and saved again at exit.
+    """
+    if host is None:
+        host = site_of(content)['VC_HOST']
+    inv = Inventory.load(content, host, INVENTORY_PROPERTIES, filename)
+    if inv is None:
+        inv = Inventory(content, path_set=INVENTORY_PROPERTIES, fill=False)
+    _inventories[content] = inv
+
+    def sync():
+        inv.reconcile()
+        inv.save(host, filename)
+        inv.follow()
+    threading.Thread(target=sync, daemon=True).start()
+    atexit.register(inv.save, host, filename)
+    return inv
+
 def get_obj(content, vimtype, name=None):
-    obj = None
-    container = content.viewManager.CreateContainerView(
-                content.rootFolder, vimtype, True)
+    """
+    Find vimtype object by name via the inventory index.
+    Without name a container view over vimtype is returned, caller destroys it.
+    """
     if not name:
-        obj = container
-        return obj
-    for c in container.view:
-        if name:
-            if c.name == name:
-                obj = c
+        return content.viewManager.CreateContainerView(
+                content.rootFolder, vimtype, True)
+    return inventory(content).get(vimtype, name)
+
+def get_objs(content, vimtype, name):
+    """ every vimtype object called name, same-name objects in other folders or datacenters included """
+    return inventory(content).get_all(vimtype, name)
+
+def _retrieve(content, spec, page_size):
+    pc = content.propertyCollector
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    result = pc.RetrievePropertiesEx([spec], options)
+    try:
+        while result:
+            for obj_content in result.objects:
+                props = {prop.name: prop.val for prop in obj_content.propSet}
+                props['obj'] = obj_content.obj
+                yield props
+            if not result.token:
                 break
+            token, result = result.token, None
+            result = pc.ContinueRetrievePropertiesEx(token)
+    finally:
+        # consumer stopped early, release the server side result set
+        if result and result.token:
+            pc.CancelRetrievePropertiesEx(result.token)
+
+def retrieve_properties(content, vimtype, path_set, root=None, recursive=True,
+                        objs=None, page_size=1000):
+    """
+    Bulk fetch path_set of vimtype objects in one RetrievePropertiesEx pass,
+    paging with ContinueRetrievePropertiesEx. Objects are either objs or
+    everything under root (default rootFolder). path_set is a list or a
+    {type: paths} dict. Yields {path: value} dicts, the MoRef is under 'obj'.
+    """
+    pc = vmodl.query.PropertyCollector
+    if objs is not None:
+        if not objs:
+            return
+        spec = pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=obj, skip=False) for obj in objs],
+                             propSet=_prop_specs(vimtype, path_set))
+        for props in _retrieve(content, spec, page_size):
+            yield props
+        return
+    view = content.viewManager.CreateContainerView(
+            root or content.rootFolder, vimtype, recursive)
+    try:
+        for props in _retrieve(content, _view_filter_spec(view, vimtype, path_set), page_size):
+            yield props
+    finally:
+        view.DestroyView()
+
+def query(content, vimtype, path_set, root=None, recursive=True, objs=None):
+    """
+    retrieve_properties(), answered from the inventory instead when it's
+    loaded and keeps every requested path.
+    """
+    inv = _inventories.get(content)
+    if (inv is not None and inv.ready.is_set() and inv.covers(vimtype, path_set) and
+            (objs is None or all(obj in inv.objects and obj not in inv.partial for obj in objs))):
+        return inv.select(vimtype, path_set, root, recursive, objs)
+    return retrieve_properties(content, vimtype, path_set, root, recursive, objs)
+
+TASK_PROPERTIES = ['info.state', 'info.result', 'info.error', 'info.progress',
+                   'info.entityName', 'info.descriptionId']
+
+class TaskMonitor(object):
+    """
+    One property collector following every task waited on over a stub, so
+    waiters don't each hold a pooled connection on WaitForUpdatesEx. add()
+    returns a concurrent.futures.Future of the task result, fed by a thread
+    that runs while there are tasks to follow.
+    """
+    def __init__(self, stub):
+        self.stub = stub
+        self.lock = threading.Lock()
+        self.collector = None
+        self.running = False
+        # task moId -> {'task', 'filter', 'info', 'waiters': [(future, progress)]}
+        self.tasks = {}
+
+    def add(self, task, progress=None):
+        """ future of task, progress(info) is called with the TASK_PROPERTIES of every update """
+        future = Future()
+        pc = vmodl.query.PropertyCollector
+        with self.lock:
+            if self.collector is None:
+                self.collector = vim.PropertyCollector('propertyCollector', self.stub).CreatePropertyCollector()
+            entry = self.tasks.get(task._moId)
+            if entry is None:
+                entry = self.tasks[task._moId] = {'task': task, 'info': {}, 'waiters': []}
+                entry['filter'] = self.collector.CreateFilter(pc.FilterSpec(
+                    objectSet=[pc.ObjectSpec(obj=task)],
+                    propSet=[pc.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES)]),
+                    partialUpdates=True)
+            entry['waiters'].append((future, progress))
+            if not self.running:
+                self.running = True
+                threading.Thread(target=self._run, daemon=True).start()
+        return future
+
+    def discard(self, task, future):
+        """ stop waiting on task for future, the task is dropped with its last waiter """
+        with self.lock:
+            entry = self.tasks.get(task._moId)
+            if entry is None:
+                return
+            entry['waiters'] = [w for w in entry['waiters'] if w[0] is not future]
+            if not entry['waiters']:
+                self._drop(task._moId)
+
+    def _drop(self, key):
+        entry = self.tasks.pop(key)
+        try:
+            entry['filter'].DestroyPropertyFilter()
+        except Exception:
+            pass
+        return entry
+
+    def _run(self):
+        pc = vmodl.query.PropertyCollector
+        version = ''
+        while True:
+            with self.lock:
+                if not self.tasks:
+                    self.running = False
+                    return
+                collector = self.collector
+            try:
+                update = collector.WaitForUpdatesEx(version, pc.WaitOptions(maxWaitSeconds=60))
+            except Exception as err:
+                # the collector is gone with the session, fail the waiters
+                with self.lock:
+                    entries = [self._drop(key) for key in list(self.tasks)]
+                    self.collector = None
+                    self.running = False
+                for entry in entries:
+                    for future, progress in entry['waiters']:
+                        future.set_exception(err)
+                return
+            if update is None:
+                continue
+            version = update.version
+            finished = []
+            with self.lock:
+                for filter_set in update.filterSet:
+                    for obj_update in filter_set.objectSet:
+                        entry = self.tasks.get(obj_update.obj._moId)
+                        if entry is None:
+                            continue
+                        for change in obj_update.changeSet:
+                            entry['info'][change.name] = change.val
+                        if entry['info'].get('info.state') in ('success', 'error'):
+                            finished.append(self._drop(obj_update.obj._moId))
+                        else:
+                            finished.append(dict(entry, waiters=list(entry['waiters']), running=True))
+            for entry in finished:
+                info = entry['info']
+                for future, progress in entry['waiters']:
+                    if progress:
+                        progress(dict(info))
+                    if entry.get('running'):
+                        continue
+                    if info['info.state'] == 'error':
+                        future.set_exception(info['info.error'])
+                    else:
+                        future.set_result(info.get('info.result'))
+
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+def task_monitor(stub):
+    """ the TaskMonitor of stub """
+    with _monitors_lock:
+        monitor = _monitors.get(stub)
+        if monitor is None:
+            monitor = _monitors[stub] = TaskMonitor(stub)
+        return monitor
+
+# progress callback of the tasks waited on in the current context, see run_async()
+_task_progress = contextvars.ContextVar('task_progress', default=None)
+
+def _in_context(func):
+    """ func run in a copy of the caller's context, so pool threads keep its task progress """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+def wait_for_tasks(tasks, timeout=TASK_TIMEOUT, raise_on_error=True):
+    """
+    Wait on the task monitor until all tasks are finished. Returns task
+    results in tasks order. A failed task raises its fault, or puts it in
+    place of the result with raise_on_error=False.
+    TimeoutError is raised when tasks are not done within timeout seconds.
+    """
+    if not tasks:
+        return []
+    monitor = task_monitor(tasks[0]._stub)
+    progress = _task_progress.get()
+    futures = [monitor.add(task, progress) for task in tasks]
+    start = time.time()
+    try:
+        done, pending = futures_wait(futures, timeout or None,
+                                     FIRST_EXCEPTION if raise_on_error else ALL_COMPLETED)
+        if raise_on_error:
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+        if pending:
+            raise TimeoutError('{} of {} tasks not finished in {}s'.format(
+                               len(pending), len(tasks), timeout))
+    finally:
+        for task, future in zip(tasks, futures):
+            if not future.done():
+                monitor.discard(task, future)
+        profiler = _profilers.get(tasks[0]._stub)
+        if profiler is not None:
+            with profiler.lock:
+                for stats in (profiler.total, profiler.current):
+                    if stats is not None:
+                        stats.task_wait += time.time() - start
+    return [future.exception() or future.result() for future in futures]
+
+def wait_for_task(task, timeout=TASK_TIMEOUT):
+    """ wait for vcenter task to complete, returns task result """
+    return wait_for_tasks([task], timeout)[0]
+
+# vm properties streamed by watch()
+WATCH_PROPERTIES = ['name', 'summary.runtime.powerState', 'summary.config.numCpu',
+                    'summary.config.memorySizeMB', 'guest.ipAddress']
+TASK_WATCH_PROPERTIES = ['info.descriptionId', 'info.entity', 'info.entityName',
+                         'info.state', 'info.progress']
+
+def watch(content, root, path_set=WATCH_PROPERTIES, tasks=True, duration=None, wait=30,
+          initial=False):
+    """
+    Stream the changes of the vms below root (folder, cluster, host or
+    resource pool) from a private property collector's WaitForUpdatesEx,
+    so only changed properties travel. Yields event dicts:
+    {'event': 'added' | 'changed' | 'removed', 'name', 'changes'} for vms and
+    {'event': 'task', 'name', 'task', 'state', 'progress'} for recent tasks
+    on them. A task is on its entity only, so a clone into root runs on
+    its source template and is left out, its vm comes as added when it's
+    done. The current state is skipped unless initial. Stops after
+    duration seconds, or when the consumer stops iterating.
+    """
+    pc = vmodl.query.PropertyCollector
+    collector = content.propertyCollector.CreatePropertyCollector()
+    view = content.viewManager.CreateContainerView(root, [vim.VirtualMachine], True)
+    try:
+        collector.CreateFilter(_view_filter_spec(view, [vim.VirtualMachine], path_set),
+                               partialUpdates=True)
+        if tasks:
+            traversal = pc.TraversalSpec(name='traverseTasks', path='recentTask', skip=False,
+                                         type=vim.TaskManager)
+            collector.CreateFilter(pc.FilterSpec(
+                objectSet=[pc.ObjectSpec(obj=content.taskManager, skip=True, selectSet=[traversal])],
+                propSet=[pc.PropertySpec(type=vim.Task, pathSet=TASK_WATCH_PROPERTIES)]),
+                partialUpdates=True)
+        deadline = time.time() + duration if duration else None
+        vms = {}
+        task_props = {}
+        version = ''
+        while True:
+            timeout = wait
+            if deadline is not None:
+                timeout = int(min(wait, deadline - time.time()) + 0.999)
+                if timeout <= 0:
+                    return
+            update = collector.WaitForUpdatesEx(version, pc.WaitOptions(maxWaitSeconds=timeout))
+            if update is None:
+                continue
+            first = not version
+            version = update.version
+            for filter_set in update.filterSet:
+                for obj_update in filter_set.objectSet:
+                    obj = obj_update.obj
+                    changes = {change.name: change.val for change in obj_update.changeSet}
+                    if isinstance(obj, vim.Task):
+                        props = task_props.setdefault(obj, {})
+                        props.update(changes)
+                        if obj_update.kind == 'leave':
+                            task_props.pop(obj, None)
+                        elif (props.get('info.entity') in vms or props.get('info.entity') == root) \
+                                and (initial or not first):
+                            yield {'event': 'task', 'name': props.get('info.entityName'),
+                                   'task': props.get('info.descriptionId'),
+                                   'state': props.get('info.state'),
+                                   'progress': props.get('info.progress')}
+                        continue
+                    if obj_update.kind == 'leave':
+                        props = vms.pop(obj, {})
+                        yield {'event': 'removed', 'name': props.get('name'), 'changes': {}}
+                        continue
+                    props = vms.setdefault(obj, {})
+                    # keep what really changed, whatever the server resends
+                    changes = {path: value for path, value in changes.items()
+                               if path not in props or props[path] != value}
+                    props.update(changes)
+                    if changes and (initial or not first):
+                        yield {'event': 'added' if obj_update.kind == 'enter' else 'changed',
+                               'name': props.get('name'), 'changes': changes}
+    finally:
+        collector.DestroyPropertyCollector()
+        view.DestroyView()
+
+class Session(object):
+    """
+    authenticated vcenter session
+    Requests go over a pool of POOL_SIZE connections, the session is kept
+    alive while idle and logged in again when vcenter reports NotAuthenticated.
+    The session cookie is saved to .session so the next process resumes it.
+    """
+    def __init__(self, creds, pool_size=POOL_SIZE, keepalive=KEEPALIVE,
+                 filename=__session__):
+        self.host = creds['VC_HOST']
+        self.user = creds['VC_USER']
+        self.password = creds['VC_PASS']
+        self.filename = filename
+        self.resumed = False
+        soap = SmartStubAdapter(host=self.host, port=int(creds['VC_PORT']),
+                                poolSize=pool_size,
+                                sslContext=ssl._create_unverified_context())
+        soap.cookie = self._load_cookie()
+        self.stub = VimSessionOrientedStub(soap, self._login)
+        self.si = vim.ServiceInstance('ServiceInstance', self.stub)
+        self.closed = threading.Event()
+        if keepalive:
+            threading.Thread(target=self._keepalive, args=(keepalive,),
+                             daemon=True).start()
+
+    def _load_cookie(self):
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f).get(self.host, {})
+        except (IOError, ValueError):
+            return ''
+        return saved.get('cookie', '') if saved.get('user') == self.user else ''
+
+    def _save_cookie(self, cookie):
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = {}
+        saved[self.host] = {'user': self.user, 'cookie': cookie}
+        fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(saved, f)
+
+    def _login(self, soap):
+        """ resume the saved session if vcenter still knows it, else log in """
+        sm = vim.ServiceInstance('ServiceInstance', soap).content.sessionManager
+        if sm.currentSession:
+            self.resumed = True
         else:
-            obj = c
-            break
-    return obj
-
-def wait_for_task(task):
-    """ wait for vcenter task to complete """
-    task_done = False
-    while not task_done:
-        if task.info.state == 'success':
-            return task.info.state
-
-        if task.info.state == 'error':
-            print("error occured")
-            task_done = True
-
-def connect_to_api(creds=vc_credentials):
+            self.resumed = False
+            sm.Login(self.user, self.password)
+        self._save_cookie(soap.cookie)
+
+    def _keepalive(self, interval):
+        while not self.closed.wait(interval):
+            try:
+                self.si.CurrentTime()
+            except Exception:
+                # network trouble, the next call logs in again
+                pass
+
+    def login(self):
+        """ authenticate now rather than on the first call """
+        if self.stub.state != self.stub.STATE_AUTHENTICATED:
+            self.si.content.sessionManager.currentSession
+        return self
+
+    def close(self, logout=False):
+        """ stop the keep-alive, logout also ends the saved session """
+        self.closed.set()
+        if logout:
+            try:
+                self.si.content.sessionManager.Logout()
+            except Exception:
+                pass
+            self._save_cookie('')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def connect_to_api(creds=None):
+    """
+    vcenter service instance for creds (default the first site of .credentials)
+    Sessions are shared per host and user within the process, the default
+    one is also kept under None so it's found without reading the file again.
+    """
+    with _sessions_lock:
+        session = _sessions.get(None) if creds is None else None
+        if session is None or session.closed.is_set():
+            site = creds if creds is not None else vc_sites()[0]
+            key = (site['VC_HOST'], site['VC_USER'])
+            session = _sessions.get(key)
+            if session is None or session.closed.is_set():
+                try:
+                    session = Session(site).login()
+                except IOError:
+                    raise SystemExit("Unable to connect to vcenter.")
+                _sessions[key] = session
+                atexit.register(session.close)
+            if creds is None:
+                _sessions[None] = session
+    return session.si
+
+_sites = {}
+
+def site_of(content):
+    """ .credentials entry content was connected with, the first one if unknown """
+    return _sites.get(content) or vc_sites()[0]
+
+def connect_sites(sites=None):
+    """
+    Log in to every configured vcenter (vc_sites() by default) at once.
+    Returns ([(site, content)] in configuration order, {name: error}), sites
+    on one vcenter share its session and content.
+    """
+    sites = sites if sites is not None else vc_sites()
+    if not sites:
+        return [], {}
+
+    def connect(site):
+        try:
+            return connect_to_api(site), None
+        except (Exception, SystemExit) as err:
+            return None, err
+
+    with ThreadPoolExecutor(max_workers=len(sites)) as pool:
+        results = list(pool.map(connect, sites))
+    connected, failed, contents = [], {}, {}
+    for site, (si, err) in zip(sites, results):
+        if err is not None:
+            failed[site['VC_NAME']] = err
+            continue
+        key = (site['VC_HOST'], site['VC_USER'])
+        if key not in contents:
+            contents[key] = si.RetrieveContent()
+            _sites[contents[key]] = site
+        connected.append((site, contents[key]))
+    return connected, failed
+
+def federate(sites, func, *args, **kwargs):
+    """
+    func(content, *args, datacenter=VC_DATACENTER, **kwargs) on every
+    (site, content) of connect_sites() concurrently. Yields (name, result) as
+    sites finish, a failed site yields its exception as result.
+    """
+    if not sites:
+        return
+
+    def call(site, content):
+        return func(content, *args, datacenter=site['VC_DATACENTER'], **kwargs)
+
+    with ThreadPoolExecutor(max_workers=len(sites)) as pool:
+        futures = {pool.submit(call, site, content): site['VC_NAME'] for site, content in sites}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as err:
+                yield futures[future], err
+
+# rows a streaming site may get ahead of the consumer
+STREAM_BUFFER = 1000
+
+def federate_stream(sites, func, *args, **kwargs):
+    """
+    federate() for generator functions: yields (name, item) as soon as any
+    site's func yields it, a failed site yields its exception as item. A
+    bounded queue holds sites back while the consumer is slower, closing
+    the generator stops them.
+    """
+    if not sites:
+        return
+    items = queue.Queue(maxsize=STREAM_BUFFER)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(site, content):
+        rows = None
+        try:
+            rows = func(content, *args, datacenter=site['VC_DATACENTER'], **kwargs)
+            for row in rows:
+                if not put((site['VC_NAME'], row)):
+                    break
+        except Exception as err:
+            put((site['VC_NAME'], err))
+        finally:
+            # cancel what's left of the site's paged retrieve
+            if hasattr(rows, 'close'):
+                rows.close()
+            put((site['VC_NAME'], done))
+
+    for site, content in sites:
+        threading.Thread(target=produce, args=(site, content), daemon=True).start()
+    running = len(sites)
     try:
-        creds = vc_credentials(__credentials__)
-    except FileNotFoundError:
-        raise SystemExit('No .credentials file found')
-    SI = None
+        while running:
+            name, item = items.get()
+            if item is done:
+                running -= 1
+            else:
+                yield name, item
+    finally:
+        stop.set()
+
+# rows sort_rows() keeps in memory before spilling a sorted run to disk
+SORT_CHUNK = 10000
+
+def sort_rows(rows, key=None, reverse=False, limit=None, chunk=SORT_CHUNK):
+    """
+    Yields rows sorted by key in bounded memory: with limit only the first
+    limit rows are kept, in a heap, without it sorted runs of chunk rows
+    are spilled to temporary files and merged.
+    """
+    if limit is not None:
+        pick = heapq.nlargest if reverse else heapq.nsmallest
+        for row in pick(limit, rows, key=key):
+            yield row
+        return
+    rows = iter(rows)
+    runs = []
     try:
-        SI = SmartConnectNoSSL(host=creds['VC_HOST'],
-                               user=creds['VC_USER'],
-                               pwd=creds['VC_PASS'],
-                               port=creds['VC_PORT'])
-        
-        atexit.register(Disconnect, SI)
-    except IOError as ex:
-        pass
+        while True:
+            run = sorted(itertools.islice(rows, chunk), key=key, reverse=reverse)
+            if not runs and len(run) < chunk:
+                for row in run:
+                    yield row
+                return
+            if run:
+                spill = tempfile.TemporaryFile()
+                for row in run:
+                    pickle.dump(row, spill, pickle.HIGHEST_PROTOCOL)
+                spill.seek(0)
+                runs.append(spill)
+            if len(run) < chunk:
+                break
+        for row in heapq.merge(*[_read_run(spill) for spill in runs], key=key, reverse=reverse):
+            yield row
+    finally:
+        for spill in runs:
+            spill.close()
+
+def _read_run(spill):
+    while True:
+        try:
+            yield pickle.load(spill)
+        except EOFError:
+            return
+
+# ---
+# ---
+
+# latency histogram buckets of the profiler, in seconds
+PROFILE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# calls that block until vcenter has something to say, their time is waiting, not network
+WAIT_METHODS = ('WaitForUpdatesEx', 'WaitForUpdates', 'CheckForUpdates')
+# calls whose property specs are profiled by path
+PROPERTY_METHODS = ('RetrievePropertiesEx', 'RetrieveProperties', 'RetrieveContents', 'CreateFilter')
+
+class ProfileStats(object):
+    """ calls, bytes, latency histograms and property path times of one command or all """
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+        self.sent = {}
+        self.received = {}
+        self.buckets = {}
+        self.slowest = {}
+        self.paths = {}
+        self.task_wait = 0.0
+
+    def add(self, method, seconds, sent, received, paths):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.seconds[method] = self.seconds.get(method, 0.0) + seconds
+        self.sent[method] = self.sent.get(method, 0) + sent
+        self.received[method] = self.received.get(method, 0) + received
+        self.slowest[method] = max(self.slowest.get(method, 0.0), seconds)
+        buckets = self.buckets.setdefault(method, [0] * (len(PROFILE_BUCKETS) + 1))
+        buckets[next((i for i, bound in enumerate(PROFILE_BUCKETS) if seconds <= bound),
+                     len(PROFILE_BUCKETS))] += 1
+        for path in paths:
+            stat = self.paths.setdefault(path, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+
+    def percentile(self, method, fraction):
+        """ upper bucket bound fraction of method calls took at most, the slowest call past the last """
+        buckets = self.buckets.get(method, [])
+        wanted = fraction * sum(buckets)
+        seen = 0
+        for i, count in enumerate(buckets):
+            seen += count
+            if count and seen >= wanted:
+                return PROFILE_BUCKETS[i] if i < len(PROFILE_BUCKETS) else self.slowest[method]
+        return None
+
+    def summary(self):
+        """ calls, bytes sent and received, seconds on the network, waiting for updates and on tasks """
+        wait = sum(seconds for method, seconds in self.seconds.items() if method in WAIT_METHODS)
+        return {'calls': sum(self.calls.values()), 'sent': sum(self.sent.values()),
+                'received': sum(self.received.values()),
+                'network': sum(self.seconds.values()) - wait, 'wait': wait, 'tasks': self.task_wait}
+
+class _CountingResponse(object):
+    """ http response counting the bytes read from it """
+    def __init__(self, response, count):
+        self._response = response
+        self._count = count
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self._count(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+class Profiler(object):
+    """
+    Records the vcenter calls made over the stubs it is attached to, in
+    total and by command (see command()): calls, bytes, latency histograms
+    by method, and the property paths asked for with the seconds of the calls
+    fetching them. Bytes are counted on the wire for SOAP stubs, other stubs
+    (the simulator) get the size of the SOAP messages the calls would be.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = ProfileStats()
+        self.commands = {}
+        self.current = None
+        self.stubs = []
+        self.local = threading.local()
+
+    def attach(self, stub):
+        """ profile calls over stub (content.rootFolder._stub) until detach() """
+        if any(attached is stub for attached in self.stubs):
+            return
+        self.stubs.append(stub)
+        stub.InvokeMethod = self._method(stub.InvokeMethod, stub)
+        stub.InvokeAccessor = self._accessor(stub.InvokeAccessor)
+        soap = getattr(stub, 'soapStub', stub)
+        if isinstance(soap, SoapAdapter.SoapStubAdapter):
+            soap.requestModifierList.append(self._request)
+            connect = soap.GetConnection
+
+            def get_connection():
+                conn = connect()
+                if not getattr(conn, 'profiled', False):
+                    conn.getresponse = self._response(conn.getresponse)
+                    conn.profiled = True
+                return conn
+            soap.GetConnection = get_connection
+        _profilers[stub] = self
+
+    def detach(self):
+        for stub in self.stubs:
+            del stub.InvokeMethod, stub.InvokeAccessor
+            soap = getattr(stub, 'soapStub', stub)
+            if isinstance(soap, SoapAdapter.SoapStubAdapter):
+                soap.requestModifierList.remove(self._request)
+                del soap.GetConnection
+            _profilers.pop(stub, None)
+        self.stubs = []
+
+    @contextlib.contextmanager
+    def command(self, line):
+        """ count the calls made meanwhile, from any thread, under command line """
+        with self.lock:
+            self.current = self.commands.setdefault(line, ProfileStats())
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.current = None
+
+    def reset(self):
+        with self.lock:
+            self.total = ProfileStats()
+            self.commands = {}
+
+    def _request(self, request):
+        call = getattr(self.local, 'call', None)
+        if call is not None:
+            call['sent'] += len(request)
+        return request
+
+    def _response(self, getresponse):
+        def counted():
+            call = getattr(self.local, 'call', None)
+            if call is None:
+                return getresponse()
+            return _CountingResponse(getresponse(), lambda size: call.__setitem__('received', call['received'] + size))
+        return counted
+
+    def _record(self, method, start, call, paths):
+        seconds = time.time() - start
+        with self.lock:
+            for stats in (self.total, self.current):
+                if stats is not None:
+                    stats.add(method, seconds, call['sent'], call['received'], paths)
+
+    def _method(self, invoke, stub):
+        soap = isinstance(getattr(stub, 'soapStub', stub), SoapAdapter.SoapStubAdapter)
+
+        def profiled(mo, info, args):
+            if getattr(self.local, 'call', None) is not None:
+                # inside a profiled accessor
+                return invoke(mo, info, args)
+            call = self.local.call = {'sent': 0, 'received': 0}
+            start = time.time()
+            try:
+                result = invoke(mo, info, args)
+                if not soap:
+                    call['sent'] = _soap_size(args, stub)
+                    call['received'] = _soap_size(result, stub)
+                return result
+            finally:
+                self.local.call = None
+                paths = []
+                if info.wsdlName in PROPERTY_METHODS:
+                    specs = args[0] if isinstance(args[0], list) else [args[0]]
+                    paths = ['{}.{}'.format(prop_spec.type.__name__.split('.')[-1], path)
+                             for spec in specs for prop_spec in spec.propSet or []
+                             for path in prop_spec.pathSet or []]
+                self._record(info.wsdlName, start, call, paths)
+        return profiled
+
+    def _accessor(self, invoke):
+        def profiled(mo, info):
+            call = self.local.call = {'sent': 0, 'received': 0}
+            start = time.time()
+            try:
+                return invoke(mo, info)
+            finally:
+                self.local.call = None
+                self._record('RetrieveContents', start, call,
+                             ['{}.{}'.format(type(mo).__name__.split('.')[-1], info.name)])
+        return profiled
+
+    def openmetrics(self):
+        """ the totals as OpenMetrics (Prometheus) text """
+        with self.lock:
+            stats = copy.deepcopy(self.total)
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.extend(samples)
+        methods = sorted(stats.calls)
+        family('vcenter_calls', 'counter', 'vcenter api calls',
+               ['vcenter_calls_total{{method="{}"}} {}'.format(m, stats.calls[m]) for m in methods])
+        family('vcenter_bytes', 'counter', 'bytes of vcenter api calls',
+               ['vcenter_bytes_total{{method="{}",direction="{}"}} {}'.format(m, direction, count[m])
+                for m in methods for direction, count in (('sent', stats.sent), ('received', stats.received))])
+        samples = []
+        for m in methods:
+            seen = 0
+            for bound, count in zip(PROFILE_BUCKETS + ('+Inf',), stats.buckets[m]):
+                seen += count
+                samples.append('vcenter_call_seconds_bucket{{method="{}",le="{}"}} {}'.format(m, bound, seen))
+            samples.append('vcenter_call_seconds_sum{{method="{}"}} {}'.format(m, stats.seconds[m]))
+            samples.append('vcenter_call_seconds_count{{method="{}"}} {}'.format(m, stats.calls[m]))
+        family('vcenter_call_seconds', 'histogram', 'vcenter api call latency', samples)
+        family('vcenter_task_wait_seconds', 'counter', 'seconds spent waiting on vcenter tasks',
+               ['vcenter_task_wait_seconds_total {}'.format(stats.task_wait)])
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address=''):
+        """ serve openmetrics() on http://address:port/metrics from a daemon thread """
+        profiler = self
 
-    if not SI:
-        raise SystemExit("Unable to connect to vcenter.")
-    return SI
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = profiler.openmetrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        server = http.server.ThreadingHTTPServer((address, int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+def _soap_size(obj, stub):
+    """ bytes obj takes in a SOAP message, for stubs that don't send any """
+    try:
+        if isinstance(obj, (list, tuple)):
+            return sum(_soap_size(item, stub) for item in obj)
+        return len(SoapAdapter.Serialize(obj, version=stub.version)) if obj is not None else 0
+    except Exception:
+        return 0
+
+_profilers = {}
 
 # ---
 # ---
 
-def vm_info(vm):
-    return list(map(str,[vm.name, vm.summary.config.numCpu,
-            vm.summary.config.memorySizeMB,
-            ','.join([str(i.capacityInKB) for i in vm.config.hardware.device if isinstance(i,vim.vm.device.VirtualDisk)]),
-            vm.summary.config.vmPathName.split()[0],
-            vm.summary.config.guestFullName,
-            ','.join([i.macAddress for i in vm.config.hardware.device if hasattr(i,'macAddress')]),
-            ','.join([i.name for i in vm.network]),
-            vm.summary.runtime.powerState]))
-
-def list_tenants(content,vmtype=[vim.Folder],name="Tenants"):
-    tn_obj = get_obj(content,vmtype,name)
-    return [tenant.name for tenant in tn_obj.childEntity if not hasattr(tenant,"PowerOff")]
-        
-def list_clusters(content,vmtype=[vim.ClusterComputeResource]):
-    cl_obj = get_obj(content,[vim.ClusterComputeResource])
-    cl_view = cl_obj.view
-    cl_obj.DestroyView()
-    return {cl.name:[cl.summary.numCpuCores,
-                     cl.summary.numCpuThreads,
-                     float(cl.summary.totalMemory)/GB,
-                     cl.summary.numHosts,
-                     cl.summary.overallStatus] for cl in cl_view}
-
-def list_datastores(content,vmtype=[vim.Datastore]):
-    out = {}
-    ds_obj = get_obj(content,[vim.Datastore])
-    ds_view = ds_obj.view
-    ds_obj.DestroyView()
-    out.update({ds.name:[int(ds.summary.capacity)/GB, 
-                    int(ds.summary.freeSpace)/GB, 
-                    ds.overallStatus,'DS'] for ds in ds_view})
-    # storege DRS
-    ds_obj = get_obj(content,[vim.StoragePod])
-    ds_view = ds_obj.view
-    ds_obj.DestroyView()
-    out.update({ds.name:[int(ds.summary.capacity)/GB, 
-                    int(ds.summary.freeSpace)/GB,
-                    ds.overallStatus,'DRS'] for ds in ds_view})
-    return out
-
-def list_vms(content,tenant,vmtype=[vim.Folder]):
-    ''' TODO:
-        list nested vms
+VM_PROPERTIES = ['name',
+                 'summary.config.numCpu',
+                 'summary.config.memorySizeMB',
+                 'summary.config.vmPathName',
+                 'summary.config.guestFullName',
+                 'summary.config.template',
+                 'summary.runtime.powerState',
+                 'config.hardware.device',
+                 'network']
+
+CLUSTER_PROPERTIES = ['name', 'summary.numCpuCores', 'summary.numCpuThreads',
+                      'summary.totalMemory', 'summary.numHosts', 'summary.overallStatus']
+
+DATASTORE_PROPERTIES = ['name', 'summary.capacity', 'summary.freeSpace', 'overallStatus']
+
+# vm properties behind the find_vm search index
+SEARCH_PROPERTIES = ['name', 'summary.config.uuid', 'summary.config.instanceUuid',
+                     'guest.net', 'config.hardware.device']
+SEARCH_FIELDS = ('name', 'ip', 'mac', 'uuid')
+
+# what a snapshot inventory keeps, enough to answer the read-only commands
+INVENTORY_PROPERTIES = {
+    vim.Datacenter: ['name', 'parent'],
+    vim.Folder: ['name', 'parent'],
+    vim.ComputeResource: CLUSTER_PROPERTIES + ['parent'],
+    vim.HostSystem: ['name', 'parent'],
+    vim.ResourcePool: ['name', 'parent'],
+    vim.Datastore: DATASTORE_PROPERTIES + ['parent'],
+    vim.StoragePod: DATASTORE_PROPERTIES + ['parent'],
+    vim.Network: ['name', 'parent'],
+    vim.DistributedVirtualSwitch: ['name', 'parent'],
+    vim.VirtualMachine: VM_PROPERTIES + ['parent', 'summary.config.uuid',
+                                         'summary.config.instanceUuid', 'guest.net'],
+}
+
+# names of the vm_info columns
+VM_COLUMNS = ['name', 'cpu', 'ram', 'disks', 'datastore', 'guest', 'macs', 'networks', 'power']
+
+def _vm_row(content, props):
+    """ vm_info columns from VM_PROPERTIES values, network names come from the inventory index """
+    devices = props.get('config.hardware.device', [])
+    names = inventory(content)
+    return list(map(str,[props['name'], props.get('summary.config.numCpu'),
+            props.get('summary.config.memorySizeMB'),
+            ','.join([str(i.capacityInKB) for i in devices if isinstance(i,vim.vm.device.VirtualDisk)]),
+            (props.get('summary.config.vmPathName') or '').split(' ')[0],
+            props.get('summary.config.guestFullName'),
+            ','.join([i.macAddress for i in devices if getattr(i,'macAddress',None)]),
+            ','.join([names.name(i) or i._moId for i in props.get('network', [])]),
+            props.get('summary.runtime.powerState')]))
+
+def _content_of(obj):
+    """ content of the connection obj came over, for calls made with a MoRef only """
+    for content in list(_sites) + list(_inventories):
+        if content.rootFolder._stub is obj._stub:
+            return content
+    return vim.ServiceInstance('ServiceInstance', obj._stub).RetrieveContent()
+
+def vm_info(content, vm=None):
+    """ VM_COLUMNS of vm, vm_info(vm) of callers that don't pass content still works """
+    if vm is None:
+        content, vm = _content_of(content), content
+    props = next(query(content, [vim.VirtualMachine], VM_PROPERTIES, objs=[vm]), None)
+    if props is None:
+        raise Exception("No vm {} found, it was removed".format(vm._moId))
+    return _vm_row(content, props)
+
+def list_tenants(content,vmtype=[vim.Folder],name="Tenants",datacenter=None):
+    """ tenant folders in the Tenants folder of datacenter (VC_DATACENTER by default) """
+    tn_obj = vm_folder(content, name, datacenter)
+    if tn_obj is None:
+        return []
+    return [tenant['name'] for tenant in
+            query(content, [vim.Folder], ['name'], root=tn_obj, recursive=False)]
+
+def _datacenter_root(content, datacenter):
+    """ (found, datacenter object or None for the whole vcenter) """
+    if not datacenter:
+        return True, None
+    root = get_obj(content, [vim.Datacenter], datacenter)
+    return root is not None, root
+
+def datacenter_of(content, obj):
+    """ name of the datacenter obj belongs to, one round trip up its parents """
+    inv = _inventories.get(content)
+    if inv is not None and inv.ready.is_set() and 'parent' in inv.paths(type(obj)):
+        parent = obj
+        while parent is not None and not isinstance(parent, vim.Datacenter):
+            parent = inv.objects.get(parent, {}).get('parent')
+        if parent is not None:
+            return inv.name(parent)
+        # added by hand without its parent, ask vcenter
+    pc = vmodl.query.PropertyCollector
+    traversal = pc.TraversalSpec(name='traverseParent', path='parent', skip=False,
+                                 type=vim.ManagedEntity,
+                                 selectSet=[pc.SelectionSpec(name='traverseParent')])
+    spec = pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=obj, skip=True, selectSet=[traversal])],
+                         propSet=[pc.PropertySpec(type=vim.Datacenter, pathSet=['name'])])
+    for row in _retrieve(content, spec, 100):
+        if isinstance(row['obj'], vim.Datacenter):
+            return row.get('name')
+    return None
+
+def list_clusters(content,vmtype=[vim.ClusterComputeResource],datacenter=None):
+    found, root = _datacenter_root(content, datacenter)
+    if not found:
+        return {}
+    return {cl['name']:[cl['summary.numCpuCores'],
+                        cl['summary.numCpuThreads'],
+                        float(cl['summary.totalMemory'])/GB,
+                        cl['summary.numHosts'],
+                        cl['summary.overallStatus']]
+            for cl in query(content, vmtype, CLUSTER_PROPERTIES, root=root)}
+
+def iter_datastores(content,vmtype=[vim.Datastore, vim.StoragePod],datacenter=None,name=None):
+    """
+    (name, [capacity GB, free GB, status, 'DS' or 'DRS']) of the datastores
+    and storage DRS pods whose name matches the name glob, as they come
+    """
+    found, root = _datacenter_root(content, datacenter)
+    if not found:
+        return
+    match = _matcher(name) if name else None
+    for ds in query(content, vmtype, DATASTORE_PROPERTIES, root=root):
+        if match is None or match(ds['name']):
+            yield ds['name'], [int(ds['summary.capacity'])/GB,
+                               int(ds['summary.freeSpace'])/GB,
+                               ds['overallStatus'],
+                               'DRS' if isinstance(ds['obj'], vim.StoragePod) else 'DS']
+
+def list_datastores(content,vmtype=[vim.Datastore, vim.StoragePod],datacenter=None):
+    # storage DRS pods come in the same pass, marked as DRS
+    return dict(iter_datastores(content, vmtype, datacenter))
+
+def _folder_filter_spec(root, path_set, recursive):
+    """
+    filter spec walking Folder.childEntity below root (a folder or a list
+    of them), to any depth with recursive
+    """
+    pc = vmodl.query.PropertyCollector
+    traversal = pc.TraversalSpec(name='traverseFolder', path='childEntity', skip=False,
+                                 type=vim.Folder)
+    if recursive:
+        traversal.selectSet = [pc.SelectionSpec(name='traverseFolder')]
+    roots = root if isinstance(root, list) else [root]
+    return pc.FilterSpec(objectSet=[pc.ObjectSpec(obj=folder, skip=True, selectSet=[traversal])
+                                    for folder in roots],
+                         propSet=_prop_specs(list(path_set), path_set))
+
+def walk_folder(content, root, path_set=['name'], recursive=True):
+    """
+    Folders, vms and templates under root in one RetrievePropertiesEx pass,
+    or from the inventory when it keeps the paths. path_set are the vm paths.
+    Returns rows with 'obj', 'name', 'type' ('d' folder, 'v' vm, 't' template)
+    and 'path', the folder path relative to root.
+    """
+    return list(iter_folder(content, root, path_set, recursive))
+
+def iter_folder(content, root, path_set=['name'], recursive=True):
+    """
+    walk_folder() as a generator, rows come as the inventory or the property
+    collector pages hand them over. Only rows whose parent folder hasn't
+    come yet are held back, until it does.
+    """
+    vm_paths = list(path_set) + [p for p in ('name', 'parent', 'summary.config.template')
+                                 if p not in path_set]
+    paths = {vim.Folder: ['name', 'parent'], vim.VirtualMachine: vm_paths}
+    inv = _inventories.get(content)
+    if inv is not None and inv.ready.is_set() and inv.covers(list(paths), paths):
+        rows = inv.select(list(paths), paths, root, recursive)
+    else:
+        rows = _retrieve(content, _folder_filter_spec(root, paths, recursive), 1000)
+    # folder moId -> path of the rows in it, MoRef hashing is slow
+    folders = {root._moId: ''}
+    # parent moId -> rows waiting for it
+    waiting = {}
+
+    def place(row):
+        ready = [row]
+        while ready:
+            row = ready.pop()
+            parent = row.get('parent')
+            key = parent._moId if parent is not None else None
+            if key not in folders:
+                waiting.setdefault(key, []).append(row)
+                continue
+            row['path'] = folders[key]
+            if isinstance(row['obj'], vim.Folder):
+                row['type'] = 'd'
+                folders[row['obj']._moId] = '/'.join(filter(None, [row['path'], row['name']]))
+                ready.extend(waiting.pop(row['obj']._moId, ()))
+            else:
+                row['type'] = 't' if row.get('summary.config.template') else 'v'
+            yield row
+
+    for row in rows:
+        for placed in place(row):
+            yield placed
+    # parents that never came are outside the walk, paths start below them
+    while waiting:
+        key = next(iter(waiting))
+        folders[key] = ''
+        for row in waiting.pop(key):
+            for placed in place(row):
+                yield placed
+
+def vm_folder(content, path, datacenter=None):
+    ''' folder path below the vm folder of datacenter (VC_DATACENTER by default) '''
+    datacenter = datacenter or site_of(content)['VC_DATACENTER']
+    return content.searchIndex.FindByInventoryPath(datacenter+'/vm/'+path)
+
+def tenant_folder(content, tenant, datacenter=None):
+    ''' Tenants/tenant vm folder of datacenter (VC_DATACENTER by default) '''
+    if tenant.startswith('/'):
+        tenant = tenant[1:]
+    return vm_folder(content, 'Tenants/'+tenant, datacenter)
+
+POWER_STATES = {'on': 'poweredOn', 'off': 'poweredOff', 'suspended': 'suspended'}
+
+def _matcher(pattern, substring=False):
+    """ case-insensitive match function of a glob, of *pattern* with substring """
+    if substring and not any(c in pattern for c in '*?['):
+        pattern = '*{}*'.format(pattern)
+    return re.compile(fnmatch.translate(pattern), re.I).match
+
+def vm_filter(power=None, guest=None, name=None):
+    """
+    Predicate on the (name, VM_PROPERTIES) of vm rows: power state on, off
+    or suspended, guest os glob or substring, name glob on the path/name or
+    the bare name. None without conditions.
+    """
+    if power is not None and power not in POWER_STATES and power not in POWER_STATES.values():
+        raise Exception("power is one of {}".format(', '.join(POWER_STATES)))
+    if power is None and guest is None and name is None:
+        return None
+    state = POWER_STATES.get(power, power)
+    guest = _matcher(guest, substring=True) if guest else None
+    pattern = _matcher(name) if name else None
+
+    def match(path, props):
+        if state is not None and props.get('summary.runtime.powerState') != state:
+            return False
+        if guest is not None and not guest(props.get('summary.config.guestFullName') or ''):
+            return False
+        return pattern is None or bool(pattern(path) or pattern(props['name']))
+    return match
+
+def _vm_listing(content, obj):
+    """ list_vms row of a walk_folder() row """
+    if obj['type'] == 't':
+        return ['t',obj.get('summary.config.numCpu'),
+                    obj.get('summary.config.memorySizeMB'),
+                    (obj.get('summary.config.vmPathName') or '').split(' ')[0],
+                    obj.get('summary.config.guestFullName')]
+    if obj['type'] == 'v':
+        return ['v']+_vm_row(content, obj)[1:]
+    return ['d']
+
+def iter_vms(content, tenant, recursive=False, datacenter=None, power=None, guest=None, name=None):
+    """
+    list_vms() as a generator of (name, row), rows come as they are fetched.
+    With power, guest or name (see vm_filter) only matching vms and templates
+    come, without folders.
+    """
+    match = vm_filter(power, guest, name)
+    tenant_obj = tenant_folder(content, tenant, datacenter)
+    if tenant_obj is None:
+        return
+    for obj in iter_folder(content, tenant_obj, VM_PROPERTIES, recursive):
+        path = '/'.join(filter(None, [obj['path'], obj['name']]))
+        if match is not None and (obj['type'] == 'd' or not match(path, obj)):
+            continue
+        yield path, _vm_listing(content, obj)
+
+def list_vms(content, tenant, recursive=False, datacenter=None):
+    ''' vms ('v'), templates ('t') and folders ('d') of tenant, by name,
+        or by path/name with recursive, None when there is no such tenant
+        TODO:
         show OS disk size and type
     '''
-    #vm_obj = get_obj(content,vmtype,name)
-    if tenant.startswith('/'):
-        tenant = vc_tenant[1:]
-    tenant_obj = content.searchIndex.FindByInventoryPath('DC01/vm/Tenants/'+tenant)
+    tenant_obj = tenant_folder(content, tenant, datacenter)
+    if tenant_obj is None:
+        return None
     vms = {}
-    for vm in tenant_obj.childEntity:
-        if hasattr(vm,"PowerOff"):
-            if vm.summary.config.template:
-                vms.update({vm.name:['t',vm.summary.config.numCpu,
-                                        vm.summary.config.memorySizeMB,
-                                        vm.summary.config.vmPathName.split()[0],
-                                        vm.summary.config.guestFullName
-                                        ]})
-            else:
-                info = vm_info(vm)
-                vms.update({info[0]:['v',' '.join(info[1:])]})
-                '''
-                vms.update({vm.name:['v',vm.summary.config.numCpu,
-                                        vm.summary.config.memorySizeMB,
-                                        vm.summary.config.vmPathName.split()[0],
-                                        vm.summary.config.guestFullName
-                                     ]})
-                '''
-        else:
-            vms.update({vm.name:['d']})
+    for obj in iter_folder(content, tenant_obj, VM_PROPERTIES, recursive):
+        name = '/'.join(filter(None, [obj['path'], obj['name']]))
+        vms[name] = _vm_listing(content, obj)
     return vms
-    #return [vm.name for vm in vm_obj.childEntity if hasattr(vm,"PowerOff")]
-
-def find_vm(content,name,vmtype=[vim.VirtualMachine]):
-    vm = get_obj(content,vmtype,name)
-    if vm:
-        config = vm_info(vm)
-        return {'v':[i for i in config]}
-        '''
-        return {'v':[vm.name,vm.summary.config.numCpu,
-                                vm.summary.config.memorySizeMB,
-                                vm.summary.config.vmPathName.split()[0],
-                                vm.summary.config.guestFullName]}
-        '''
-    else:
+
+UUID_RE = re.compile(r'^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$', re.I)
+MAC_RE = re.compile(r'^([0-9a-f]{2}[:-]){5}[0-9a-f]{2}$', re.I)
+
+class SearchIndex(object):
+    """
+    name, guest ip, mac and bios/instance uuid -> vms of one vcenter, for
+    find_vm pattern and attribute lookups without a round trip
+    """
+    def __init__(self, rows):
+        self.keys = {field: {} for field in SEARCH_FIELDS}
+        for row in rows:
+            self._index(row)
+
+    def _add(self, field, value, vm):
+        # lists, MoRef hashing is too slow to index tens of thousands of vms
+        if value:
+            vms = self.keys[field].setdefault(value, [])
+            if not vms or vms[-1] is not vm:
+                vms.append(vm)
+
+    def _index(self, row):
+        vm = row['obj']
+        self._add('name', row.get('name'), vm)
+        for path in ('summary.config.uuid', 'summary.config.instanceUuid'):
+            self._add('uuid', (row.get(path) or '').lower(), vm)
+        for nic in row.get('guest.net') or []:
+            self._add('mac', (nic.macAddress or '').lower(), vm)
+            for ip in nic.ipAddress or []:
+                self._add('ip', ip, vm)
+        for device in row.get('config.hardware.device') or []:
+            self._add('mac', (getattr(device, 'macAddress', None) or '').lower(), vm)
+
+    def match(self, field, pattern):
+        """ vms whose field is pattern, matches it as a glob, or as a compiled regex """
+        values = self.keys[field]
+        if isinstance(pattern, str) and not any(c in pattern for c in '*?['):
+            return set(values.get(pattern if field in ('name', 'ip') else pattern.lower(), ()))
+        if isinstance(pattern, str):
+            pattern = re.compile(fnmatch.translate(pattern), re.I)
+        return {vm for value, vms in values.items() if pattern.search(value) for vm in vms}
+
+_search_indexes = {}
+
+def search_index(content):
+    """
+    SearchIndex of content's vcenter. Derived from the inventory and rebuilt
+    only after it changed, or fetched in one bulk pass without an inventory.
+    """
+    inv = _inventories.get(content)
+    if inv is None or not inv.ready.is_set() or not inv.covers([vim.VirtualMachine], SEARCH_PROPERTIES):
+        return SearchIndex(retrieve_properties(content, [vim.VirtualMachine], SEARCH_PROPERTIES))
+    try:
+        inv.sync()
+    except vmodl.MethodFault:
+        pass
+    generation, index = _search_indexes.get(content, (None, None))
+    if generation != inv.generation:
+        generation = inv.generation
+        index = SearchIndex(inv.select([vim.VirtualMachine], SEARCH_PROPERTIES))
+        _search_indexes[content] = (generation, index)
+    return index
+
+def search_terms(text):
+    """
+    (field, pattern) of a find_vm query: ip:, mac:, uuid: or name: prefixed,
+    else a uuid, mac or ip address by its looks, else a vm name. A /regex/
+    pattern is compiled, other patterns are exact values or globs.
+    """
+    field, sep, value = text.partition(':')
+    if not (sep and field in SEARCH_FIELDS):
+        if UUID_RE.match(text):
+            field = 'uuid'
+        elif MAC_RE.match(text):
+            field = 'mac'
+        else:
+            try:
+                ipaddress.ip_address(text)
+                field = 'ip'
+            except ValueError:
+                field = 'name'
+        value = text
+    if len(value) > 1 and value.startswith('/') and value.endswith('/'):
+        return field, re.compile(value[1:-1])
+    if field == 'mac':
+        value = value.replace('-', ':')
+    elif field == 'uuid' and UUID_RE.match(value):
+        # vcenter only matches its own 8-4-4-4-12 form
+        digits = value.replace('-', '').lower()
+        value = '-'.join([digits[:8], digits[8:12], digits[12:16], digits[16:20], digits[20:]])
+    return field, value
+
+def find_vm(content,name,vmtype=[vim.VirtualMachine],datacenter=None):
+    """
+    find_vms() keyed by vm name as before, {name: ['v' or 't'] + vm_info
+    columns}, None when nothing matched. Same-name vms share a key, one of
+    them is kept.
+    """
+    matches = find_vms(content, name, vmtype, datacenter)
+    if matches is None:
         return None
+    return {key[0]: info for key, info in sorted(matches.items())}
+
+def find_vms(content,name,vmtype=[vim.VirtualMachine],datacenter=None):
+    """
+    vms matching name (see search_terms), {(name, moId): ['v' or 't'] +
+    vm_info columns}, None when nothing matched. Exact ips and uuids are looked up
+    by the vcenter searchIndex, exact names in the inventory, patterns and
+    macs in search_index().
+    """
+    field, pattern = search_terms(name)
+    found, root = _datacenter_root(content, datacenter)
+    if not found:
+        return None
+    exact = isinstance(pattern, str) and not any(c in pattern for c in '*?[')
+    if field == 'name' and exact:
+        vms = set(get_objs(content, vmtype, pattern))
+    elif field == 'ip' and exact:
+        vms = set(content.searchIndex.FindAllByIp(datacenter=root, ip=pattern, vmSearch=True) or [])
+        root = None
+    elif field == 'uuid' and exact:
+        vms = set()
+        for instance in (False, True):
+            vms.update(content.searchIndex.FindAllByUuid(datacenter=root, uuid=pattern,
+                                                         vmSearch=True, instanceUuid=instance) or [])
+        root = None
+    else:
+        vms = search_index(content).match(field, pattern)
+    if root is not None:
+        vms = {vm for vm in vms if datacenter_of(content, vm) == datacenter}
+    matches = {}
+    for props in query(content, [vim.VirtualMachine], VM_PROPERTIES, objs=list(vms)):
+        info = _vm_row(content, props)
+        # keyed by moId too, same-name vms are rows of their own
+        matches[(info[0], props['obj']._moId)] = ['t' if props.get('summary.config.template') else 'v'] + info[1:]
+    return matches or None
 
 def list_dvs(content,vmtype=[vim.DistributedVirtualSwitch]):
-    obj = get_obj(content,vmtype)
-    dvs = obj.view
-    return [ switch.name for switch in dvs ]
-       
+    return [switch['name'] for switch in query(content, vmtype, ['name'])]
 
 def dvs_info(content,vmtype=[vim.DistributedVirtualSwitch],name=None):
     if not name:
@@ -170,45 +1852,473 @@ def dvs_info(content,vmtype=[vim.DistributedVirtualSwitch],name=None):
         else:
             return dvs.summary.portgroupName
 
-    
-def get_templates_folder(content,vmtype=[vim.Folder],name='Templates'):
-    folder = get_obj(content,vmtype,name)
-    return folder
+def get_templates_folder(content,vmtype=[vim.Folder],name='Templates',datacenter=None):
+    """ the Templates folder of datacenter (VC_DATACENTER by default) """
+    return vm_folder(content, name, datacenter)
 
-def list_templates(folder,temp_dict):
-    if not hasattr(folder,'childEntity'):
-        return temp_dict
-    else:
-        for obj in folder.childEntity:
-            if hasattr(obj, 'PowerOff'):
-                temp_dict.update({obj.name:obj.summary.config.guestFullName})
+def list_templates(content, folder=None, recursive=True, datacenter=None):
+    """
+    {name: [guest, folder path, cpu, ram, disks, datastore, networks]} of the
+    templates under folder, served by the template catalog for the
+    Templates folder of datacenter. The older list_templates(folder, found)
+    still fills found with {name: guest} of the templates under folder.
+    """
+    if isinstance(content, vim.Folder):
+        folder, found = content, {} if folder is None else folder
+        found.update((name, row[0]) for name, row in
+                     list_templates(_content_of(folder), folder).items())
+        return found
+    if folder is None and recursive:
+        catalog = template_catalog(content, datacenter)
+        if catalog is None:
+            return {}
+        return {name: [entry['guest'], entry['path'], entry['cpu'], entry['ram'],
+                       [disk[1] for disk in entry['disks']], entry['datastore'], entry['networks']]
+                for name, entry in catalog.templates.items()}
+    folder = folder or get_templates_folder(content, datacenter=datacenter)
+    if folder is None:
+        return {}
+    return {row['name']: [row.get('summary.config.guestFullName'), row['path'],
+                          row.get('summary.config.numCpu'), row.get('summary.config.memorySizeMB'),
+                          None, _datastore_of(row.get('summary.config.vmPathName')), None]
+            for row in walk_folder(content, folder, ['summary.config.guestFullName', 'summary.config.numCpu',
+                                   'summary.config.memorySizeMB', 'summary.config.vmPathName'], recursive)
+            if row['type'] == 't'}
+
+def _datastore_of(path):
+    """ datastore name of a '[datastore] dir/file' path """
+    if not path or not path.startswith('['):
+        return None
+    return path[1:].split(']')[0]
+
+# seconds the template catalog is served before asking vcenter what changed
+TEMPLATE_REFRESH = 30
+# what the catalog follows of every template, the rest is read on config changes
+TEMPLATE_WATCH = {vim.Folder: ['name', 'parent'],
+                  vim.VirtualMachine: ['name', 'parent', 'config.template', 'config.changeVersion']}
+
+class TemplateCatalog(object):
+    """
+    MoRef, guest os, cpu/ram, disk layout, nics and datastore of the
+    templates below a folder. A private property collector follows their
+    name, folder and config.changeVersion through WaitForUpdatesEx deltas,
+    TEMPLATE_PROPERTIES are read again only for templates whose config
+    changed since.
+    """
+    def __init__(self, content, folder):
+        self.content = content
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.collector = None
+        self.version = ''
+        self.checked = 0
+        # moId -> TEMPLATE_WATCH values of the folders and vms below folder
+        self.objects = {}
+        # moId -> entry, built from the config.changeVersion it holds
+        self.entries = {}
+        self.templates = {}
+
+    def _attach(self):
+        self.collector = self.content.propertyCollector.CreatePropertyCollector()
+        self.collector.CreateFilter(_folder_filter_spec(self.folder, TEMPLATE_WATCH, True),
+                                    partialUpdates=True)
+        self.version = ''
+        self.objects = {}
+
+    def refresh(self, force=False):
+        """ pick up template changes, at most every TEMPLATE_REFRESH seconds unless forced """
+        with self.lock:
+            if not force and time.time() - self.checked < TEMPLATE_REFRESH:
+                return
+            try:
+                self._update()
+            except vmodl.MethodFault:
+                # collector went away with its session
+                self.collector = None
+                self._update()
+            self.checked = time.time()
+
+    def _update(self):
+        if self.collector is None:
+            self._attach()
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        while True:
+            update = self.collector.WaitForUpdatesEx(self.version, options)
+            if update is None:
+                break
+            self.version = update.version
+            for filter_set in update.filterSet:
+                for obj_update in filter_set.objectSet:
+                    key = obj_update.obj._moId
+                    if obj_update.kind == 'leave':
+                        self.objects.pop(key, None)
+                        continue
+                    props = self.objects.setdefault(key, {'obj': obj_update.obj})
+                    for change in obj_update.changeSet:
+                        props[change.name] = change.val
+            if not update.truncated:
+                break
+        templates = [props for props in self.objects.values()
+                     if isinstance(props['obj'], vim.VirtualMachine) and props.get('config.template')]
+        stale = [props for props in templates if props['obj']._moId not in self.entries or
+                 self.entries[props['obj']._moId]['version'] != props.get('config.changeVersion')]
+        if stale:
+            self._read(stale)
+        # gone while being read are picked up by the next delta
+        templates = [props for props in templates if props['obj']._moId in self.entries]
+        self.entries = {props['obj']._moId: self.entries[props['obj']._moId] for props in templates}
+        self.templates = {}
+        for props in templates:
+            entry = self.entries[props['obj']._moId]
+            entry.update(name=props.get('name'), path=self._path(props))
+            self.templates[entry['name']] = entry
+
+    def _path(self, props):
+        names = []
+        parent = props.get('parent')
+        while parent is not None and parent != self.folder and parent._moId in self.objects:
+            names.append(self.objects[parent._moId].get('name'))
+            parent = self.objects[parent._moId].get('parent')
+        return '/'.join(reversed(names))
+
+    def _read(self, stale):
+        rows = list(retrieve_properties(self.content, [vim.VirtualMachine], TEMPLATE_PROPERTIES,
+                                        objs=[props['obj'] for props in stale]))
+        networks = {}
+        for row in query(self.content, [vim.Network], ['name'],
+                         objs=[network for row in rows for network in row.get('network', [])]):
+            networks[row['obj']._moId] = row['name']
+        versions = {props['obj']._moId: props.get('config.changeVersion') for props in stale}
+        for row in rows:
+            devices = row.get('config.hardware.device', [])
+            disks = []
+            for device in devices:
+                if isinstance(device, vim.vm.device.VirtualDisk):
+                    disks.append((device.deviceInfo.label if device.deviceInfo else str(device.key),
+                                  device.capacityInKB // (1024*1024),
+                                  _datastore_of(getattr(device.backing, 'fileName', None)),
+                                  'thin' if getattr(device.backing, 'thinProvisioned', False) else 'thick'))
+            nics = [(device.deviceInfo.label if device.deviceInfo else str(device.key),
+                     getattr(device, 'macAddress', None))
+                    for device in devices if isinstance(device, vim.vm.device.VirtualEthernetCard)]
+            self.entries[row['obj']._moId] = {
+                'obj': row['obj'],
+                'version': versions[row['obj']._moId],
+                'guest': row.get('summary.config.guestFullName'),
+                'cpu': row.get('config.hardware.numCPU'),
+                'ram': row.get('config.hardware.memoryMB'),
+                'disks': disks,
+                'nics': nics,
+                'networks': [networks.get(network._moId) for network in row.get('network', [])],
+                'datastore': _datastore_of(row.get('summary.config.vmPathName')),
+                'hardware': row,
+            }
+
+    def get(self, name):
+        """ catalog entry of template name, None when there is no such template """
+        entry = self.templates.get(name)
+        if entry is None:
+            # unknown name, pick up templates created since the last refresh
+            self.refresh(force=True)
+            entry = self.templates.get(name)
+        return entry
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def template_catalog(content, datacenter=None):
+    """ current TemplateCatalog of the Templates folder of datacenter, None without one """
+    key = (content, datacenter or site_of(content)['VC_DATACENTER'])
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            folder = get_templates_folder(content, datacenter=key[1])
+            if folder is None:
+                return None
+            catalog = _catalogs[key] = TemplateCatalog(content, folder)
+    catalog.refresh()
+    return catalog
+
+def clone_sources(content, names, datacenter=None):
+    """
+    {name: (vm, TEMPLATE_PROPERTIES row)} of the clone sources called names,
+    templates straight from the catalog of datacenter, other vms of
+    datacenter in one round trip. (None, None) when there is no such vm.
+    """
+    catalog = template_catalog(content, datacenter)
+    datacenter = datacenter or site_of(content)['VC_DATACENTER']
+    sources, other = {}, {}
+    for name in set(names):
+        entry = catalog.get(name) if catalog else None
+        if entry:
+            sources[name] = (entry['obj'], entry['hardware'])
+        else:
+            other[name] = next((obj for obj in get_objs(content, [vim.VirtualMachine], name)
+                                if datacenter_of(content, obj) == datacenter), None)
+            sources[name] = (None, None)
+    rows = retrieve_properties(content, [vim.VirtualMachine], TEMPLATE_PROPERTIES,
+                               objs=[obj for obj in other.values() if obj])
+    found = {row['obj']._moId: row for row in rows}
+    for name, obj in other.items():
+        if obj is not None and obj._moId in found:
+            sources[name] = (obj, found[obj._moId])
+    return sources
+
+
+def _find_snapshot(snapshots, name):
+    for snapshot in snapshots or []:
+        if snapshot.name == name:
+            return snapshot.snapshot
+        found = _find_snapshot(snapshot.childSnapshotList, name)
+        if found:
+            return found
+    return None
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+def template_snapshot(content, template, pool, stale=None, convert=False):
+    """
+    LINKED_SNAPSHOT of template, looked up on first use and cached per
+    template. stale is a cached snapshot found deleted, it's looked up or
+    taken again. A vm without one gets it taken, a template only with
+    convert: it's turned into a vm on pool for the snapshot and always back
+    again, clones of it elsewhere fail meanwhile.
+    """
+    with _snapshots_lock:
+        if stale is not None and _snapshots.get(template) == stale:
+            del _snapshots[template]
+        if template in _snapshots:
+            return _snapshots[template]
+        props = next(retrieve_properties(content, [vim.VirtualMachine],
+                                         ['name', 'snapshot', 'config.template'], objs=[template]), None)
+        if props is None:
+            raise Exception("No template {} found, it was removed".format(template._moId))
+        snapshot = None
+        if props.get('snapshot'):
+            snapshot = _find_snapshot(props['snapshot'].rootSnapshotList, LINKED_SNAPSHOT)
+        if snapshot is None:
+            if props.get('config.template') and not convert:
+                raise Exception("Template {} has no {} snapshot for linked clones, take one or allow "
+                                "converting it to a vm for it".format(props['name'], LINKED_SNAPSHOT))
+            converted = False
+            try:
+                if props.get('config.template'):
+                    template.MarkAsVirtualMachine(pool=pool)
+                    converted = True
+                snapshot = wait_for_task(template.CreateSnapshot_Task(
+                           name=LINKED_SNAPSHOT, description='base of linked clones',
+                           memory=False, quiesce=False))
+            finally:
+                if converted:
+                    template.MarkAsTemplate()
+        _snapshots[template] = snapshot
+        return snapshot
+
+PLACEMENT_PROPERTIES = {
+    vim.ClusterComputeResource: ['name', 'host', 'datastore'],
+    vim.HostSystem: ['name', 'datastore', 'runtime.connectionState', 'runtime.inMaintenanceMode',
+                     'summary.hardware.memorySize', 'summary.quickStats.overallMemoryUsage'],
+    vim.StoragePod: ['name', 'childEntity'],
+    vim.Datastore: ['name', 'summary.freeSpace', 'summary.accessible', 'summary.maintenanceMode'],
+}
+
+def _clone_size(hardware, ram=None, hdd=None, mode='full'):
+    """ (memory, datastore space) in bytes a clone takes, hardware is its source's TEMPLATE_PROPERTIES row """
+    memory = int(ram) * GB if ram else hardware.get('config.hardware.memoryMB', 0) * 1024 * 1024
+    disks = [device.capacityInKB * 1024 for device in hardware.get('config.hardware.device', [])
+             if isinstance(device, vim.vm.device.VirtualDisk)]
+    if disks and hdd:
+        disks[0] = max(disks[0], int(hdd) * GB)
+    # only full clones copy the disks, every vm gets a swap file of its memory size
+    return memory, (sum(disks) if mode == 'full' else 0) + memory
+
+class Placement(object):
+    """
+    Free host memory and datastore space of one datacenter (the whole vcenter
+    without one), fetched in one pass. place() books every vm it places, so
+    a planned batch spreads over hosts and datastores.
+    """
+    def __init__(self, content, datacenter=None):
+        found, root = _datacenter_root(content, datacenter)
+        if not found:
+            raise Exception("No datacenter {} found".format(datacenter))
+        self.props = {}
+        self.names = {}
+        self.free = {}
+        self.lock = threading.Lock()
+        for row in retrieve_properties(content, list(PLACEMENT_PROPERTIES), PLACEMENT_PROPERTIES,
+                                       root=root):
+            obj = row['obj']
+            self.props[obj] = row
+            self.names[(type(obj), row.get('name'))] = obj
+            if isinstance(obj, vim.HostSystem):
+                if (row.get('runtime.connectionState') == 'connected' and
+                        not row.get('runtime.inMaintenanceMode')):
+                    self.free[obj] = (row.get('summary.hardware.memorySize', 0) -
+                                      row.get('summary.quickStats.overallMemoryUsage', 0) * 1024 * 1024)
+            elif isinstance(obj, vim.Datastore):
+                if (row.get('summary.accessible', True) and
+                        row.get('summary.maintenanceMode', 'normal') == 'normal'):
+                    self.free[obj] = row.get('summary.freeSpace', 0)
+
+    def name(self, obj):
+        return self.props[obj].get('name')
+
+    def _find(self, vimtype, name, kind):
+        obj = self.names.get((vimtype, name))
+        if obj is None:
+            raise Exception("No {} {} found".format(kind, name))
+        return obj
+
+    def place(self, memory, space, cluster=None, datastore=None):
+        """
+        (cluster, host, datastore) for a vm of memory and space bytes: the
+        connected host with the most free memory, then its datastore with the
+        most free space. cluster and datastore (or storage pod) names narrow
+        the choice. A named cluster or datastore is taken even short of
+        memory or space, only its best host or the best datastore is picked.
+        Raises when nothing fits.
+        """
+        with self.lock:
+            if cluster:
+                clusters = [self._find(vim.ClusterComputeResource, cluster, 'cluster')]
             else:
-                list_templates(obj,temp_dict)
-    return temp_dict
+                clusters = [obj for obj in self.props if isinstance(obj, vim.ClusterComputeResource)]
+            stores = None
+            named = False
+            if datastore:
+                pod = self.names.get((vim.StoragePod, datastore))
+                if pod is not None:
+                    stores = list(self.props[pod].get('childEntity', []))
+                else:
+                    stores = [self._find(vim.Datastore, datastore, 'datastore')]
+                    named = True
+            best = None
+            for cl in clusters:
+                candidates = stores if stores is not None else self.props[cl].get('datastore', [])
+                for host in self.props[cl].get('host', []):
+                    if host not in self.free or (self.free[host] < memory and not cluster):
+                        continue
+                    reachable = self.props[host].get('datastore', [])
+                    fits = [ds for ds in candidates if ds in reachable and ds in self.free
+                            and (named or self.free[ds] >= space)]
+                    if not fits:
+                        continue
+                    ds = max(fits, key=self.free.get)
+                    # what has room first, then what has the most of it
+                    rank = (self.free[host] >= memory, self.free[ds] >= space,
+                            self.free[host], self.free[ds])
+                    if best is None or rank > best[0]:
+                        best = (rank, cl, host, ds)
+            if best is None:
+                raise Exception("No host with {:.0f}GB free memory and datastore with {:.0f}GB "
+                                "free space in {}".format(memory / GB, space / GB,
+                                                          cluster or 'any cluster'))
+            _, cl, host, ds = best
+            self.free[host] -= memory
+            self.free[ds] -= space
+            return cl, host, ds
+
+def _wanted(name):
+    """ cluster / datastore name, None when the placement engine picks it """
+    return None if name is None or str(name).lower() == AUTO else name
 
-def clone(content,vm_name,vc_template,vc_tenant,vc_cluster,vc_datastore=None,power=False):
+def plan_placement(content, vms):
+    """
+    Place a batch of provision() vms at once, biggest first, so it spreads
+    over hosts and datastores. AUTO, a storage pod or a name as cluster /
+    datastore is replaced by the chosen cluster and datastore and the host
+    is added. Host memory counts for vms that are powered on only.
+    Returns {name: error} of the vms that can't be placed.
+    """
+    failed = {}
+    # templates of each datacenter's catalog
+    templates = {}
+    for vm in vms:
+        templates.setdefault(vm.get('datacenter'), []).append(vm['template'])
+    for datacenter, names in templates.items():
+        templates[datacenter] = clone_sources(content, names, datacenter)
+    sized = []
+    for vm in vms:
+        template, hardware = templates[vm.get('datacenter')][vm['template']]
+        if template is None:
+            failed[vm['name']] = Exception("No template {} found".format(vm['template']))
+            continue
+        memory, space = _clone_size(hardware, vm.get('ram'), vm.get('hdd'), vm.get('mode', 'full'))
+        sized.append(((memory if vm.get('power') else 0, space), vm))
+    placements = {}
+    default_datastore = None
+    for (memory, space), vm in sorted(sized, key=lambda item: item[0], reverse=True):
+        datastore = vm.get('datastore')
+        if not datastore:
+            default_datastore = default_datastore or site_of(content).get('VC_DATASTORE')
+            datastore = default_datastore
+        try:
+            datacenter = vm.get('datacenter')
+            if datacenter not in placements:
+                placements[datacenter] = Placement(content, datacenter)
+            placement = placements[datacenter]
+            cluster, host, datastore = placement.place(memory, space, _wanted(vm['cluster']),
+                                                       _wanted(datastore))
+        except Exception as err:
+            failed[vm['name']] = err
+            continue
+        vm.update(cluster=placement.name(cluster), host=placement.name(host),
+                  datastore=placement.name(datastore))
+    return failed
+
+def clone(content,vm_name,vc_template,vc_tenant,vc_cluster,vc_datastore=None,power=False,
+          cpu=None,ram=None,hdd=None,epg=None,mode='full',datacenter=None,vc_host=None,
+          convert_template=False):
+    """
+    Clone vc_template to vm_name. cpu, ram (GB), hdd (GB) and epg are applied
+    by the clone task itself, so the vm needs no follow-up reconfigure.
+    mode is one of CLONE_MODES: 'linked' creates child disks on the
+    LINKED_SNAPSHOT of the template, 'instant' forks a running source vm
+    (vSphere 6.7+) and applies cpu/ram afterwards. A template without the
+    snapshot is converted to a vm to take it only with convert_template.
+    AUTO as vc_cluster or vc_datastore leaves the choice to Placement.
+    """
     if not vm_name:
         raise Exception("no vm name supplied")
-    # desired cluster 
-    cluster = get_obj(content, [vim.ClusterComputeResource], vc_cluster)
+    if mode not in CLONE_MODES:
+        raise Exception("Unknown clone mode {}, use one of {}".format(mode, ', '.join(CLONE_MODES)))
+    template, hardware = clone_sources(content, [vc_template], datacenter)[vc_template]
+    if not template:
+        raise Exception("No template {} found".format(vc_template))
     # desired tenant
-    # tenant = get_obj(content, [vim.Folder], vc_tenant)
-    if vc_tenant.startswith('/'):
-        vc_tenant = vc_tenant[1:]
-    tenant = content.searchIndex.FindByInventoryPath('DC01/vm/Tenants/'+vc_tenant)
-    # cluster and config specs
+    tenant = tenant_folder(content, vc_tenant, datacenter)
+    vmconf, diff = config_changes(content, hardware, cpu, ram, hdd, epg)
+    if mode != 'full' and 'hdd' in [setting for setting, old, new in diff]:
+        raise Exception("Disk size can't be changed by a {} clone".format(mode))
+    # nic backing changes belong to the relocate spec
+    nic_changes = [change for change in vmconf.deviceChange
+                   if isinstance(change.device, vim.vm.device.VirtualEthernetCard)]
+    vmconf.deviceChange = [change for change in vmconf.deviceChange
+                           if change not in nic_changes]
+
+    memory, space = _clone_size(hardware, ram, hdd, mode)
+    # a powered off clone takes no host memory
+    memory = memory if power else 0
+    vc_datastore = vc_datastore or site_of(content).get('VC_DATASTORE') or AUTO
+    host = datastore = None
+    if _wanted(vc_cluster) is None or _wanted(vc_datastore) is None:
+        cluster, host, datastore = Placement(content, datacenter).place(
+                memory, space, _wanted(vc_cluster), _wanted(vc_datastore))
+    else:
+        # desired cluster
+        cluster = get_obj(content, [vim.ClusterComputeResource], vc_cluster)
+        if not cluster:
+            raise Exception("No cluster {} found".format(vc_cluster))
+        if vc_host:
+            host = get_obj(content, [vim.HostSystem], vc_host)
+            if not host:
+                raise Exception("No host {} found".format(vc_host))
     resource_pool = cluster.resourcePool
-    vmconf = vim.vm.ConfigSpec()
 
     # Storage DRS resourse
-    if not vc_datastore:
-        try:
-            creds = vc_credentials(__credentials__)
-        except FileNotFoundError:
-            raise SystemExit('No .credentials file found')
-        vc_datastore = creds['VC_DATASTORE']
- 
-    pod = get_obj(content, [vim.StoragePod], vc_datastore)
+    pod = get_obj(content, [vim.StoragePod], vc_datastore) if datastore is None else None
     if pod:
         podsel = vim.storageDrs.PodSelectionSpec()
         podsel.storagePod = pod
@@ -223,109 +2333,1064 @@ def clone(content,vm_name,vc_template,vc_tenant,vc_cluster,vc_datastore=None,pow
         try:
             rec = content.storageResourceManager.RecommendDatastores(storageSpec=storagespec)
             rec_action = rec.recommendations[0].action[0]
-            real_datastore_name = rec_action.destination.name
-        except:
-            real_datastore_name = template.datastore[0].info.name
-            datastore = get_obj(content, [vim.Datastore], real_datastore_name)
-    else:
-        real_datastore_name = vc_datastore
-    datastore = get_obj(content, [vim.Datastore], real_datastore_name)
+            datastore = rec_action.destination
+        except Exception:
+            # no recommendation, the pod member with room for the vm
+            datastore = Placement(content, datacenter).place(memory, space, vc_cluster, vc_datastore)[2]
+    elif datastore is None:
+        datastore = get_obj(content, [vim.Datastore], vc_datastore)
+        if not datastore:
+            raise Exception("No datastore {} found".format(vc_datastore))
 
     # clone specs preparation
     relospec = vim.vm.RelocateSpec()
     relospec.datastore = datastore
     relospec.pool = resource_pool
+    relospec.host = host
+    relospec.deviceChange = nic_changes
+
+    if mode == 'instant':
+        if tuple(map(int, content.about.apiVersion.split('.')[:2])) < (6, 7):
+            raise Exception("Instant clone needs vSphere 6.7 or later")
+        if hardware.get('runtime.powerState') != 'poweredOn':
+            raise Exception("Instant clone needs a powered on source vm, {} is not".format(vc_template))
+        relospec.folder = tenant
+        task = template.InstantClone_Task(spec=vim.vm.InstantCloneSpec(name=vm_name, location=relospec))
+        vm = wait_for_task(task)
+        inventory(content).add(vm, vm_name)
+        # instant clone spec can't carry hardware changes
+        if vmconf.numCPUs or vmconf.memoryMB:
+            wait_for_task(vm.ReconfigVM_Task(vim.vm.ConfigSpec(numCPUs=vmconf.numCPUs,
+                          numCoresPerSocket=vmconf.numCoresPerSocket, memoryMB=vmconf.memoryMB)))
+        return vm
+
     clonespec = vim.vm.CloneSpec()
+    if mode == 'linked':
+        relospec.diskMoveType = 'createNewChildDiskBacking'
+        clonespec.snapshot = template_snapshot(content, template, resource_pool, convert=convert_template)
+    else:
+        relospec.disk = [vim.vm.RelocateSpec.DiskLocator(diskId=device.key, datastore=datastore)
+                         for device in hardware.get('config.hardware.device', [])
+                         if isinstance(device, vim.vm.device.VirtualDisk)]
     clonespec.location = relospec
+    clonespec.config = vmconf
     clonespec.powerOn = power
 
-    template =  get_obj(content, [vim.VirtualMachine], vc_template)
-    task = template.Clone(folder=tenant,name=vm_name,spec=clonespec)
-    wait_for_task(task)
+    try:
+        vm = wait_for_task(template.Clone(folder=tenant,name=vm_name,spec=clonespec))
+    except vmodl.fault.ManagedObjectNotFound as err:
+        if mode != 'linked' or err.obj != clonespec.snapshot:
+            raise
+        # the cached snapshot was deleted since
+        clonespec.snapshot = template_snapshot(content, template, resource_pool, stale=clonespec.snapshot,
+                                               convert=convert_template)
+        vm = wait_for_task(template.Clone(folder=tenant,name=vm_name,spec=clonespec))
+    inventory(content).add(vm, vm_name)
+    return vm
+
+VM_HARDWARE_PROPERTIES = ['config.hardware.numCPU',
+                          'config.hardware.numCoresPerSocket',
+                          'config.hardware.memoryMB',
+                          'config.hardware.device']
+# what clones and the template catalog read of a template
+TEMPLATE_PROPERTIES = VM_HARDWARE_PROPERTIES + ['datastore', 'network', 'runtime.powerState',
+                                                'summary.config.guestFullName',
+                                                'summary.config.vmPathName']
+
+_portgroups = {}
+
+def portgroup_connection(content, epg):
+    """ dvs port connection of portgroup epg, cached as key and switch never change """
+    network = get_obj(content,[vim.dvs.DistributedVirtualPortgroup],epg)
+    if not network:
+        raise Exception("No portgroup {} found".format(epg))
+    if network not in _portgroups:
+        pg = next(retrieve_properties(content, [vim.dvs.DistributedVirtualPortgroup],
+                  ['key', 'config.distributedVirtualSwitch'], objs=[network]))
+        switch = next(retrieve_properties(content, [vim.DistributedVirtualSwitch],
+                      ['uuid'], objs=[pg['config.distributedVirtualSwitch']]))
+        _portgroups[network] = (pg['key'], switch['uuid'])
+    key, uuid = _portgroups[network]
+    return vim.dvs.PortConnection(portgroupKey=key, switchUuid=uuid)
+
+def portgroup_name(content, key):
+    """ current name of the dvs portgroup with key, the key when there's none """
+    for pg in retrieve_properties(content, [vim.dvs.DistributedVirtualPortgroup], ['key', 'name']):
+        if pg['key'] == key:
+            return pg['name']
+    return key
 
-def vm_settings(content,vm_name,cpu,ram,hdd,epg=None,config=None):
+def config_changes(content, hardware, cpu=None, ram=None, hdd=None, epg=None):
+    """
+    Merge cpu (count), ram (GB), hdd (first disk, GB) and epg (portgroup of the
+    first nic) edits of a vm with VM_HARDWARE_PROPERTIES values hardware into
+    one ConfigSpec. Returns (spec, diff), diff lists (setting, old, new) of
+    what actually changes, settings left as None are kept.
+    """
     GiB = 1024*1024
     MiB = 1024
+    spec = vim.vm.ConfigSpec()
+    diff = []
+    devices = hardware.get('config.hardware.device', [])
 
-    ## expand disk
-    disk = None
-    vm = get_obj(content, [vim.VirtualMachine], vm_name)
+    if cpu is not None and (int(cpu) != hardware.get('config.hardware.numCPU') or
+                            hardware.get('config.hardware.numCoresPerSocket') != 1):
+        spec.numCPUs = int(cpu)
+        spec.numCoresPerSocket = 1
+        diff.append(('cpu', hardware.get('config.hardware.numCPU'), int(cpu)))
+
+    if ram is not None and int(ram)*MiB != hardware.get('config.hardware.memoryMB'):
+        spec.memoryMB = int(ram)*MiB
+        diff.append(('ram', hardware.get('config.hardware.memoryMB'), int(ram)*MiB))
+
+    if hdd is not None:
+        disk = None
+        for device in devices:
+            if isinstance(device, vim.vm.device.VirtualDisk):
+                disk = device
+                break
+        if disk is None:
+            raise Exception("Failed to find disk for VM")
+        if int(hdd) * GiB < disk.capacityInKB:
+            raise Exception("Disk can't be shrunk below {}GB".format(disk.capacityInKB // GiB))
+        if int(hdd) * GiB != disk.capacityInKB:
+            diff.append(('hdd', disk.capacityInKB, int(hdd) * GiB))
+            disk = copy.copy(disk)
+            disk.capacityInKB = int(hdd) * GiB
+            spec.deviceChange.append(vim.vm.device.VirtualDeviceSpec(device=disk, operation="edit"))
 
-    for device in vm.config.hardware.device:
-        if isinstance(device, vim.vm.device.VirtualDisk):
-            disk = device
-            break
-    if disk is None:
-        raise Exception("Failed to find disk for VM")
-    disk.capacityInKB = int(hdd) * GiB
-    spec = vim.vm.ConfigSpec()
-    devSpec = vim.vm.device.VirtualDeviceSpec(device=disk, operation="edit")
-    spec.deviceChange.append(devSpec)
-    wait_for_task(vm.Reconfigure(spec))
-
-    """ Change cpu/ram settings """
-    cspec = vim.vm.ConfigSpec()
-    cspec.numCPUs = int(cpu)
-    cspec.numCoresPerSocket = 1
-    cspec.memoryMB = int(ram)*MiB
-    task = vm.Reconfigure(cspec)
-    wait_for_task(task)
-
-    ''' Changing EPG settings '''
     if epg:
-        device_change = []
-        for device in vm.config.hardware.device:
+        port = portgroup_connection(content, epg)
+        for device in devices:
             if isinstance(device, vim.vm.device.VirtualEthernetCard):
+                current = getattr(device.backing, 'port', None)
+                if current and current.portgroupKey == port.portgroupKey:
+                    break
                 nicspec = vim.vm.device.VirtualDeviceSpec()
                 nicspec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
-                nicspec.device = device
+                nicspec.device = copy.copy(device)
                 nicspec.device.wakeOnLanEnabled = True
-                network = get_obj(content,[vim.dvs.DistributedVirtualPortgroup],epg)
-                dvs_port_connection = vim.dvs.PortConnection()
-                dvs_port_connection.portgroupKey = network.key
-                dvs_port_connection.switchUuid = network.config.distributedVirtualSwitch.uuid
                 nicspec.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
-                nicspec.device.backing.port = dvs_port_connection
+                nicspec.device.backing.port = port
                 nicspec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
                 nicspec.device.connectable.startConnected = True
                 nicspec.device.connectable.allowGuestControl = True
-                device_change.append(nicspec)
+                spec.deviceChange.append(nicspec)
+                if current:
+                    diff.append(('epg', portgroup_name(content, current.portgroupKey), epg))
+                else:
+                    diff.append(('epg', getattr(device.backing, 'deviceName', None), epg))
                 break
-        config_spec = vim.vm.ConfigSpec(deviceChange=device_change)
-        task = vm.ReconfigVM_Task(config_spec)
-        wait_for_task(task)
+    return spec, diff
 
-def add_disk(content, vm_name, disk_size, disk_type='thin'):
+def vm_settings(content,vm_name,cpu,ram,hdd,epg=None,config=None,dry_run=False):
+    """
+    Apply cpu/ram/hdd/epg changes in one Reconfigure task.
+    Returns the (setting, old, new) diff, with dry_run nothing is applied.
+    """
     vm = get_obj(content, [vim.VirtualMachine], vm_name)
-    spec = vim.vm.ConfigSpec()
-    unit_number = 0
-    controller = None
-    for dev in vm.config.hardware.device:
-        if hasattr(dev.backing, 'fileName'):
-            unit_number = int(dev.unitNumber) + 1
-            if unit_number == 7:
-                unit_number += 1
-            if unit_number >= 16:
-                print("we don't support this many disks")
+    if not vm:
+        raise Exception("No vm with {} name found".format(vm_name))
+    hardware = next(retrieve_properties(content, [vim.VirtualMachine],
+                                        VM_HARDWARE_PROPERTIES, objs=[vm]), None)
+    if hardware is None:
+        raise Exception("No vm with {} name found, it was removed".format(vm_name))
+    spec, diff = config_changes(content, hardware, cpu, ram, hdd, epg)
+    if diff and not dry_run:
+        wait_for_task(vm.ReconfigVM_Task(spec))
+    return diff
+
+# scsi controllers add_disks can add, by name
+SCSI_CONTROLLERS = {'pvscsi': vim.vm.device.ParaVirtualSCSIController,
+                    'lsilogic': vim.vm.device.VirtualLsiLogicController,
+                    'lsisas': vim.vm.device.VirtualLsiLogicSASController}
+SCSI_BUSES = 4
+# unit 7 of every scsi bus is the controller itself
+SCSI_UNITS = [unit for unit in range(16) if unit != 7]
+DISK_TYPES = ('thin', 'thick', 'eager')
+
+def disk_changes(hardware, disks, controller='pvscsi', spread=1):
+    """
+    Device changes adding disks to a vm with VM_HARDWARE_PROPERTIES values
+    hardware. disks are dicts with size (GB) and optional type (DISK_TYPES,
+    thin by default) and datastore. Each disk goes on the scsi controller
+    with the fewest devices that has a free unit. controller type
+    controllers are added on free buses when all are full, or while there
+    are fewer than spread of them.
+    Returns (device changes, [(device, what)]), device is like scsi1:3.
+    """
+    GiB = 1024*1024
+    if controller not in SCSI_CONTROLLERS:
+        raise Exception("Unknown controller {}, use one of {}".format(controller, ', '.join(SCSI_CONTROLLERS)))
+    devices = hardware.get('config.hardware.device', [])
+    # [bus, key, used units]
+    buses = [[device.busNumber, device.key, set()] for device in devices
+             if isinstance(device, vim.vm.device.VirtualSCSIController)]
+    for bus in buses:
+        bus[2].update(device.unitNumber for device in devices
+                      if device.controllerKey == bus[1] and device.unitNumber is not None)
+    changes, layout = [], []
+    keys = iter(range(-100, -10000, -1))
+
+    def add_controller():
+        free = [number for number in range(SCSI_BUSES) if number not in [bus[0] for bus in buses]]
+        if not free:
+            return None
+        device = SCSI_CONTROLLERS[controller](key=next(keys), busNumber=free[0],
+                                              sharedBus='noSharing')
+        changes.append(vim.vm.device.VirtualDeviceSpec(operation='add', device=device))
+        layout.append(('scsi{}'.format(free[0]), 'new {} controller'.format(controller)))
+        buses.append([free[0], device.key, set()])
+        return buses[-1]
+
+    while len(buses) < spread and add_controller():
+        pass
+    for disk in disks:
+        kind = disk.get('type') or 'thin'
+        if kind not in DISK_TYPES:
+            raise Exception("Unknown disk type {}, use one of {}".format(kind, ', '.join(DISK_TYPES)))
+        free = [bus for bus in buses if len(bus[2]) < len(SCSI_UNITS)]
+        bus = min(free, key=lambda bus: (len(bus[2]), bus[0])) if free else add_controller()
+        if bus is None:
+            raise Exception("No free scsi unit for {} more disks".format(len(disks) - len(layout)))
+        unit = next(unit for unit in SCSI_UNITS if unit not in bus[2])
+        bus[2].add(unit)
+        backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            diskMode='persistent', thinProvisioned=kind == 'thin', eagerlyScrub=kind == 'eager',
+            fileName='[{}]'.format(disk['datastore']) if disk.get('datastore') else '')
+        device = vim.vm.device.VirtualDisk(key=next(keys), controllerKey=bus[1], unitNumber=unit,
+                                           capacityInKB=int(disk['size']) * GiB, backing=backing)
+        changes.append(vim.vm.device.VirtualDeviceSpec(operation='add', fileOperation='create',
+                                                       device=device))
+        layout.append(('scsi{}:{}'.format(bus[0], unit), '{}GB {}'.format(int(disk['size']), kind)))
+    return changes, layout
+
+def add_disks(content, vm_name, disks, controller='pvscsi', spread=1, dry_run=False):
+    """
+    Add disks (see disk_changes) and the scsi controllers they need in one
+    Reconfigure task. Returns the [(device, what)] layout, with dry_run
+    nothing is applied.
+    """
+    vm = get_obj(content, [vim.VirtualMachine], vm_name)
+    if not vm:
+        raise Exception("No vm with {} name found".format(vm_name))
+    hardware = next(retrieve_properties(content, [vim.VirtualMachine],
+                                        ['config.hardware.device'], objs=[vm]), None)
+    if hardware is None:
+        raise Exception("No vm with {} name found, it was removed".format(vm_name))
+    changes, layout = disk_changes(hardware, disks, controller, spread)
+    if changes and not dry_run:
+        wait_for_task(vm.ReconfigVM_Task(vim.vm.ConfigSpec(deviceChange=changes)))
+    return layout
+
+def add_disk(content, vm_name, disk_size, disk_type='thin'):
+    return add_disks(content, vm_name, [{'size': disk_size, 'type': disk_type}])
+
+def provision(content, vms, workers=8, cluster_tasks=CLUSTER_TASKS,
+              datastore_tasks=DATASTORE_TASKS, progress=None):
+    """
+    Clone many vms concurrently, each sized by its clone task. Every vm is a
+    dict with name, template, tenant, cluster, datastore, cpu, ram, hdd and
+    epg keys and optional clone mode, datacenter, power and convert_template.
+    The batch is placed first by plan_placement(), which fills in the
+    cluster, host and datastore of each vm.
+    No more than cluster_tasks / datastore_tasks vms are provisioned at once
+    on one cluster / datastore. progress(name, stage, err) is called when a vm
+    is placed, starts cloning, is done or failed.
+    Returns {name: error or None}, a failed vm does not stop the rest.
+    """
+    results = {}
+
+    def report(name, stage, err=None):
+        if progress:
+            progress(name, stage, err)
+
+    def build(vm):
+        try:
+            report(vm['name'], 'cloning')
+            clone(content, vm['name'], vm['template'], vm['tenant'],
+                  vm['cluster'], vm['datastore'], cpu=vm['cpu'], ram=vm['ram'],
+                  hdd=vm['hdd'], epg=vm['epg'], mode=vm.get('mode', 'full'),
+                  power=vm.get('power', False), datacenter=vm.get('datacenter'),
+                  vc_host=vm.get('host'), convert_template=vm.get('convert_template', False))
+        except Exception as err:
+            results[vm['name']] = err
+            report(vm['name'], 'failed', err)
+            return
+        results[vm['name']] = None
+        report(vm['name'], 'done')
+
+    failed = plan_placement(content, vms)
+    for vm in vms:
+        if vm['name'] in failed:
+            results[vm['name']] = failed[vm['name']]
+            report(vm['name'], 'failed', failed[vm['name']])
+        else:
+            report(vm['name'], 'placed on {}/{}/{}'.format(vm['cluster'], vm['host'], vm['datastore']))
+    pending = [vm for vm in vms if vm['name'] not in failed]
+    # in-flight vms by ('cluster', name) and ('datastore', name)
+    busy = {}
+    running = {}
+    run = _in_context(build)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # only vms whose cluster and datastore have room go to the pool, one
+            # waiting on a busy cluster would hold a worker an idle cluster could use
+            for vm in list(pending):
+                if len(running) >= workers:
+                    break
+                keys = [('cluster', vm['cluster']), ('datastore', vm['datastore'])]
+                if busy.get(keys[0], 0) >= cluster_tasks or busy.get(keys[1], 0) >= datastore_tasks:
+                    continue
+                pending.remove(vm)
+                for key in keys:
+                    busy[key] = busy.get(key, 0) + 1
+                running[pool.submit(run, vm)] = keys
+            done, _ = futures_wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                for key in running.pop(future):
+                    busy[key] -= 1
+    return results
+
+# ---
+# ---
+
+# default in-flight power tasks of a bulk power operation
+POWER_TASKS = 16
+# seconds a guest shutdown gets before the vm is powered off
+SHUTDOWN_TIMEOUT = 300
+POWER_ACTIONS = ('on', 'off', 'shutdown', 'reset', 'remove')
+POWER_PROPERTIES = ['name', 'runtime.powerState', 'summary.config.template']
+
+def select_vms(content, patterns=(), tenant=None, datacenter=None):
+    """
+    vms named by patterns (exact names or globs) plus every vm below tenant,
+    {name: row} with POWER_PROPERTIES. Templates are left out, names that
+    match nothing too.
+    """
+    vms = []
+    if tenant:
+        root = tenant_folder(content, tenant, datacenter)
+        if root is None:
+            raise Exception('No tenant {} found'.format(tenant))
+        vms.extend(row['obj'] for row in walk_folder(content, root) if row['type'] == 'v')
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            found = search_index(content).match('name', pattern)
+            if datacenter:
+                found = [vm for vm in found if datacenter_of(content, vm) == datacenter]
+            vms.extend(found)
+        else:
+            vms.extend(vm for vm in get_objs(content, [vim.VirtualMachine], pattern)
+                       if not datacenter or datacenter_of(content, vm) == datacenter)
+    return {row['name']: row for row in query(content, [vim.VirtualMachine], POWER_PROPERTIES, objs=vms)
+            if not row.get('summary.config.template')}
+
+def _wait_powered_off(vms, timeout):
+    """ vms still not poweredOff after timeout seconds, one property collector for all """
+    pc = vmodl.query.PropertyCollector
+    collector = vim.PropertyCollector('propertyCollector', vms[0]._stub).CreatePropertyCollector()
+    collector.CreateFilter(pc.FilterSpec(
+        objectSet=[pc.ObjectSpec(obj=vm) for vm in vms],
+        propSet=[pc.PropertySpec(type=vim.VirtualMachine, pathSet=['runtime.powerState'])]),
+        partialUpdates=True)
+    deadline = time.time() + timeout
+    running = list(vms)
+    version = ''
+    try:
+        while running:
+            wait = int(min(60, deadline - time.time()) + 0.999)
+            if wait <= 0:
+                break
+            update = collector.WaitForUpdatesEx(version, pc.WaitOptions(maxWaitSeconds=wait))
+            if update is None:
+                continue
+            version = update.version
+            off = [obj_update.obj for filter_set in update.filterSet
+                   for obj_update in filter_set.objectSet
+                   for change in obj_update.changeSet if change.val == 'poweredOff']
+            running = [vm for vm in running if vm not in off]
+    finally:
+        collector.DestroyPropertyCollector()
+    return running
+
+def _datacenters(content, vms):
+    """
+    {datacenter: [vm]} of vms, without a round trip per vm on a single
+    datacenter vcenter. vms whose datacenter can't be told are under None.
+    """
+    datacenters = list(query(content, [vim.Datacenter], ['name']))
+    if len(datacenters) == 1:
+        return {datacenters[0]['obj']: list(vms)}
+    named = {row['name']: row['obj'] for row in datacenters}
+    groups = {}
+    for vm in vms:
+        groups.setdefault(named.get(datacenter_of(content, vm)), []).append(vm)
+    return groups
+
+def power_vms(content, vms, action, workers=POWER_TASKS, timeout=SHUTDOWN_TIMEOUT, progress=None):
+    """
+    Run a POWER_ACTIONS action on the vms of select_vms() at once.
+    on goes through Datacenter.PowerOnMultiVM_Task, vms it leaves out (or
+    every vm, where it's not available) get their own power on task.
+    shutdown asks the guests to shut down and powers off the ones still
+    running after timeout seconds, or without vmware tools. remove powers
+    off and destroys. No more than workers tasks are started at once.
+    progress(name, outcome, err) is called as each vm is done.
+    Returns {name: outcome or exception}, a failed vm does not stop the rest.
+    """
+    if action not in POWER_ACTIONS:
+        raise Exception('Unknown power action {}, use one of {}'.format(action, ', '.join(POWER_ACTIONS)))
+    results = {}
+    names = {}
+    states = {}
+
+    def done(vm, outcome):
+        results[names[vm]] = outcome
+        if progress:
+            if isinstance(outcome, Exception):
+                progress(names[vm], 'failed', outcome)
+            else:
+                progress(names[vm], outcome, None)
+
+    def each(start, vms, outcome):
+        # a task per vm, workers of them in flight
+        def run(vm):
+            try:
+                task = start(vm)
+                # destroy has waited on its tasks already
+                if task is not None:
+                    wait_for_task(task)
+            except Exception as err:
+                done(vm, err)
                 return
-        if isinstance(dev, vim.vm.device.VirtualSCSIController):
-            controller = dev
-
-    # add disk here
-    dev_changes = []
-    new_disk_kb = int(disk_size) * 1024 * 1024
-    disk_spec = vim.vm.device.VirtualDeviceSpec()
-    disk_spec.fileOperation = "create"
-    disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-    disk_spec.device = vim.vm.device.VirtualDisk()
-    disk_spec.device.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
-    if disk_type == 'thin':
-        disk_spec.device.backing.thinProvisioned = True
-    disk_spec.device.backing.diskMode = 'persistent'
-    disk_spec.device.unitNumber = unit_number
-    disk_spec.device.capacityInKB = new_disk_kb
-    disk_spec.device.controllerKey = controller.key
-    dev_changes.append(disk_spec)
-    spec.deviceChange = dev_changes
-    task = vm.ReconfigVM_Task(spec=spec)
-    wait_for_task(task)
+            done(vm, outcome)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_in_context(run), vms))
+
+    def destroy(vm):
+        if states[vm] == 'poweredOn':
+            wait_for_task(vm.PowerOffVM_Task())
+        wait_for_task(vm.Destroy_Task())
+        inventory(content).forget(vm)
+
+    def shutdown(vm):
+        try:
+            vm.ShutdownGuest()
+        except Exception as err:
+            return vm, err
+        return vm, None
+
+    pending = []
+    for row in vms.values():
+        names[row['obj']] = row['name']
+        state = states[row['obj']] = row.get('runtime.powerState')
+        if action == 'on' and state == 'poweredOn' or \
+           action in ('off', 'shutdown') and state == 'poweredOff':
+            done(row['obj'], 'already {}'.format(state))
+        else:
+            pending.append(row['obj'])
+    if not pending:
+        return results
+
+    if action == 'on':
+        groups = _datacenters(content, pending)
+        single = groups.pop(None, [])
+        for datacenter, group in groups.items():
+            try:
+                result = datacenter.PowerOnMultiVM_Task(vm=group)
+                result = wait_for_task(result)
+            except Exception:
+                single.extend(group)
+                continue
+            attempted = [info for info in result.attempted or [] if info.task is not None]
+            started = [info.vm for info in attempted]
+            single.extend(vm for vm in group if vm not in started)
+            for info, outcome in zip(attempted, wait_for_tasks([info.task for info in attempted],
+                                                                raise_on_error=False)):
+                done(info.vm, outcome if isinstance(outcome, Exception) else 'poweredOn')
+        each(lambda vm: vm.PowerOnVM_Task(), single, 'poweredOn')
+    elif action == 'off':
+        each(lambda vm: vm.PowerOffVM_Task(), pending, 'poweredOff')
+    elif action == 'reset':
+        each(lambda vm: vm.ResetVM_Task(), pending, 'reset')
+    elif action == 'remove':
+        each(destroy, pending, 'removed')
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            asked = list(pool.map(_in_context(shutdown), pending))
+        hard = [vm for vm, err in asked if err is not None]
+        running = _wait_powered_off([vm for vm, err in asked if err is None], timeout) \
+                  if len(hard) < len(asked) else []
+        for vm, err in asked:
+            if err is None and vm not in running:
+                done(vm, 'shut down')
+        each(lambda vm: vm.PowerOffVM_Task(), hard,
+             'poweredOff, no guest shutdown')
+        each(lambda vm: vm.PowerOffVM_Task(), running,
+             'poweredOff, guest shutdown timed out after {}s'.format(timeout))
+    return results
+
+# ---
+# ---
+
+RECONCILE_ACTIONS = ('create', 'resize', 'network', 'delete')
+RECONCILE_PROPERTIES = ['name', 'runtime.powerState', 'summary.config.template'] + VM_HARDWARE_PROPERTIES
+
+def reconcile_plan(content, vms, prune=False):
+    """
+    What it takes to get from the vms below the tenants of vm specs (as
+    provision() takes them) to the specs, from one bulk fetch. Returns
+    (plan, failed): plan is a list of {'action', 'name', ...} entries, one
+    of RECONCILE_ACTIONS. create carries the 'vm' spec, resize (cpu, ram,
+    hdd) and network (epg) the (setting, old, new) 'changes' and the shared
+    'spec' of the vm's reconfigure, delete (only with prune) the 'row' of a
+    vm in those tenants no spec names. failed is {name: error} of specs
+    that can't be reached, like a disk to shrink.
+    """
+    tenants = {}
+    for vm in vms:
+        key = (vm['tenant'], vm.get('datacenter'))
+        if key not in tenants:
+            tenants[key] = tenant_folder(content, vm['tenant'], vm.get('datacenter'))
+    roots = [folder for folder in tenants.values() if folder is not None]
+    # (tenant folder moId, name) -> rows, same-name vms of other tenants are others
+    existing = {}
+    if roots:
+        rows = list(_retrieve(content, _folder_filter_spec(roots, {vim.Folder: ['name', 'parent'],
+                              vim.VirtualMachine: RECONCILE_PROPERTIES + ['parent']}, True), 1000))
+        # moId -> parent, MoRef hashing is slow
+        parents = {row['obj']._moId: row.get('parent') for row in rows}
+        root_ids = {folder._moId for folder in roots}
+        for row in rows:
+            if not isinstance(row['obj'], vim.VirtualMachine) or row.get('summary.config.template'):
+                continue
+            parent = row.get('parent')
+            while parent is not None and parent._moId not in root_ids:
+                parent = parents.get(parent._moId)
+            if parent is not None:
+                existing.setdefault((parent._moId, row['name']), []).append(row)
+    plan, failed = [], {}
+    wanted = set()
+    for vm in vms:
+        folder = tenants[(vm['tenant'], vm.get('datacenter'))]
+        key = (folder._moId if folder is not None else None, vm['name'])
+        wanted.add(key)
+        rows = existing.get(key, [])
+        if not rows:
+            plan.append({'action': 'create', 'name': vm['name'], 'vm': vm})
+            continue
+        if len(rows) > 1:
+            failed[vm['name']] = Exception("{} vms called {} in tenant {}".format(
+                                           len(rows), vm['name'], vm['tenant']))
+            continue
+        row = rows[0]
+        try:
+            spec, diff = config_changes(content, row, vm.get('cpu'), vm.get('ram'),
+                                        vm.get('hdd'), vm.get('epg'))
+        except Exception as err:
+            failed[vm['name']] = err
+            continue
+        for action, settings in (('resize', ('cpu', 'ram', 'hdd')), ('network', ('epg',))):
+            changes = [change for change in diff if change[0] in settings]
+            if changes:
+                plan.append({'action': action, 'name': vm['name'], 'obj': row['obj'],
+                             'changes': changes, 'spec': spec})
+    if prune:
+        plan.extend({'action': 'delete', 'name': key[1], 'row': row}
+                    for key, rows in sorted(existing.items(), key=lambda item: item[0][1])
+                    if key not in wanted for row in rows)
+    return plan, failed
+
+def apply_plan(content, plan, workers=8, cluster_tasks=CLUSTER_TASKS,
+               datastore_tasks=DATASTORE_TASKS, progress=None):
+    """
+    Carry out a reconcile_plan() at once: creates go through provision(),
+    each changed vm gets one Reconfigure task whatever its resize and
+    network entries, deletes power off and destroy. progress(name, stage,
+    err) as in provision(). Returns {name: error or None}.
+    """
+    results = {}
+
+    def report(name, stage, err=None):
+        if progress:
+            progress(name, stage, err)
+
+    def reconfigure(name, obj, spec):
+        try:
+            report(name, 'reconfiguring')
+            wait_for_task(obj.ReconfigVM_Task(spec))
+        except Exception as err:
+            results[name] = err
+            report(name, 'failed', err)
+            return
+        results[name] = None
+        report(name, 'done')
+
+    def deleted(name, outcome, err):
+        report(name, 'failed' if err else 'deleted', err)
+
+    # by moId, same-name vms of other tenants are others
+    changed = {}
+    for entry in plan:
+        if entry['action'] in ('resize', 'network'):
+            changed.setdefault(entry['obj']._moId, entry)
+    creates = [entry['vm'] for entry in plan if entry['action'] == 'create']
+    doomed = {entry['row']['obj']._moId: entry['row'] for entry in plan if entry['action'] == 'delete'}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_in_context(reconfigure), entry['name'], entry['obj'], entry['spec'])
+                   for entry in changed.values()]
+        deleting = pool.submit(_in_context(power_vms), content, doomed, 'remove', workers,
+                               progress=deleted) if doomed else None
+        if creates:
+            results.update(provision(content, creates, workers, cluster_tasks,
+                                     datastore_tasks, progress))
+        futures_wait(futures)
+        if deleting is not None:
+            for name, outcome in deleting.result().items():
+                results[name] = outcome if isinstance(outcome, Exception) else None
+    return results
+
+# ---
+# ---
+
+# PerformanceManager intervals: realtime samples or historical rollups, in seconds
+PERF_INTERVALS = {'realtime': 20, 'day': 300, 'week': 1800, 'month': 7200, 'year': 86400}
+# entity metrics vcenter accepts in one historical QueryPerf (vpxd.stats.maxQueryMetrics)
+PERF_QUERY_METRICS = 64
+# samples averaged per metric
+PERF_SAMPLES = 15
+
+# column: (counter, scale), a None scale turns a summation in ms into % of the sample
+VM_STATS = {
+    'cpu_usage_pct': ('cpu.usage.average', 0.01),
+    'cpu_ready_pct': ('cpu.ready.summation', None),
+    'mem_active_mb': ('mem.active.average', 1.0 / 1024),
+    'balloon_mb': ('mem.vmmemctl.average', 1.0 / 1024),
+    'disk_latency_ms': ('disk.maxTotalLatency.latest', 1),
+    'net_kbps': ('net.usage.average', 1),
+}
+HOST_STATS = {
+    'cpu_usage_pct': ('cpu.usage.average', 0.01),
+    'mem_usage_pct': ('mem.usage.average', 0.01),
+    'balloon_mb': ('mem.vmmemctl.average', 1.0 / 1024),
+    'disk_latency_ms': ('disk.maxTotalLatency.latest', 1),
+    'net_kbps': ('net.usage.average', 1),
+}
+# host counters per datastore instance, latencies are the worst host, iops the sum
+DATASTORE_STATS = {
+    'read_latency_ms': ('datastore.totalReadLatency.average', 1),
+    'write_latency_ms': ('datastore.totalWriteLatency.average', 1),
+    'read_iops': ('datastore.numberReadAveraged.average', 1),
+    'write_iops': ('datastore.numberWriteAveraged.average', 1),
+}
+# top_vms orderings
+TOP_METRICS = {'ready': 'cpu_ready_pct', 'balloon': 'balloon_mb',
+               'latency': 'disk_latency_ms', 'cpu': 'cpu_usage_pct'}
+
+_perf_counters = {}
+
+def perf_counters(content):
+    """ {'group.name.rollup': counter id} of content's vcenter, read once """
+    counters = _perf_counters.get(content)
+    if counters is None:
+        counters = _perf_counters[content] = {
+            '{}.{}.{}'.format(info.groupInfo.key, info.nameInfo.key, info.rollupType): info.key
+            for info in content.perfManager.perfCounter}
+    return counters
+
+def query_perf(content, entities, counters, interval='realtime', samples=PERF_SAMPLES, instance=''):
+    """
+    Average of the last samples of every counter ('group.name.rollup') of
+    every entity, {entity: {(counter, instance): value}}. Realtime stats come
+    in one QueryPerf, historical ones in batches of PERF_QUERY_METRICS.
+    instance '' is the entity aggregate, '*' every instance.
+    Counters vcenter doesn't collect are left out.
+    """
+    if interval not in PERF_INTERVALS:
+        raise Exception("Unknown interval {}, use one of {}".format(
+                        interval, ', '.join(sorted(PERF_INTERVALS))))
+    ids = perf_counters(content)
+    names = {ids[counter]: counter for counter in counters if counter in ids}
+    if not names or not entities:
+        return {}
+    pm = vim.PerformanceManager
+    metric_ids = [pm.MetricId(counterId=key, instance=instance) for key in names]
+    seconds = PERF_INTERVALS[interval]
+    if interval == 'realtime':
+        batch = len(entities)
+        window = dict(maxSample=samples)
+    else:
+        batch = max(1, PERF_QUERY_METRICS // len(metric_ids))
+        now = vim.ServiceInstance('ServiceInstance', content.rootFolder._stub).CurrentTime()
+        window = dict(startTime=now - datetime.timedelta(seconds=seconds * samples))
+    results = {}
+    for i in range(0, len(entities), batch):
+        specs = [pm.QuerySpec(entity=entity, metricId=metric_ids, intervalId=seconds,
+                              format='normal', **window)
+                 for entity in entities[i:i + batch]]
+        for metric in content.perfManager.QueryPerf(querySpec=specs) or []:
+            values = results.setdefault(metric.entity, {})
+            for series in metric.value:
+                # -1 marks a sample without data
+                found = [value for value in series.value if value >= 0]
+                if found:
+                    values[(names[series.id.counterId], series.id.instance)] = \
+                        float(sum(found)) / len(found)
+    return results
+
+def _scaled(value, scale, interval):
+    if value is None:
+        return None
+    if scale is None:
+        scale = 1.0 / (PERF_INTERVALS[interval] * 10)
+    return round(value * scale, 2)
+
+def _stats(content, entities, columns, interval, samples):
+    """ {entity: {column: value}} of columns ({column: (counter, scale)}) """
+    values = query_perf(content, entities, [counter for counter, scale in columns.values()],
+                        interval, samples)
+    return {entity: {column: _scaled(values.get(entity, {}).get((counter, '')), scale, interval)
+                     for column, (counter, scale) in columns.items()}
+            for entity in entities}
+
+def vm_stats(content, names=None, tenant=None, interval='realtime', samples=PERF_SAMPLES,
+             datacenter=None):
+    """
+    {vm name: VM_STATS columns} of the named vms, or of the powered on vms
+    of tenant and its nested folders. Stopped vms have no stats.
+    """
+    vms = {}
+    if tenant:
+        folder = tenant_folder(content, tenant, datacenter)
+        if folder is None:
+            raise Exception("No tenant {} found".format(tenant))
+        for row in walk_folder(content, folder, ['summary.runtime.powerState']):
+            if row['type'] == 'v' and row.get('summary.runtime.powerState') == 'poweredOn':
+                vms[row['obj']] = row['name']
+    for name in names or []:
+        vm = get_obj(content, [vim.VirtualMachine], name)
+        if not vm:
+            raise Exception("No vm {} found".format(name))
+        vms[vm] = name
+    return {vms[vm]: stats for vm, stats in
+            _stats(content, list(vms), VM_STATS, interval, samples).items()}
+
+def top_vms(content, tenant, by='ready', count=10, interval='realtime', samples=PERF_SAMPLES,
+            datacenter=None):
+    """ [(name, VM_STATS columns)] of the count tenant vms highest in TOP_METRICS by """
+    if by not in TOP_METRICS:
+        raise Exception("Unknown metric {}, use one of {}".format(by, ', '.join(sorted(TOP_METRICS))))
+    column = TOP_METRICS[by]
+    stats = vm_stats(content, tenant=tenant, interval=interval, samples=samples,
+                     datacenter=datacenter)
+    return sorted(stats.items(), key=lambda item: item[1][column] or 0, reverse=True)[:count]
+
+def host_stats(content, names=None, interval='realtime', samples=PERF_SAMPLES, datacenter=None):
+    """ {host name: HOST_STATS columns} of the named or all connected hosts """
+    found, root = _datacenter_root(content, datacenter)
+    if not found:
+        return {}
+    hosts = {row['obj']: row['name'] for row in
+             retrieve_properties(content, [vim.HostSystem], ['name', 'runtime.connectionState'], root=root)
+             if row.get('runtime.connectionState') == 'connected' and
+             (not names or row['name'] in names)}
+    return {hosts[host]: stats for host, stats in
+            _stats(content, list(hosts), HOST_STATS, interval, samples).items()}
+
+def datastore_stats(content, names=None, interval='realtime', samples=PERF_SAMPLES, datacenter=None):
+    """
+    {datastore name: DATASTORE_STATS columns} of the named or all datastores,
+    from the per datastore counters of the hosts mounting them
+    """
+    found, root = _datacenter_root(content, datacenter)
+    if not found:
+        return {}
+    datastores = {}
+    for row in retrieve_properties(content, [vim.Datastore], ['name', 'summary.url', 'host'], root=root):
+        if names and row['name'] not in names:
+            continue
+        # ds:///vmfs/volumes/<uuid>/, the uuid is the counter instance
+        uuid = (row.get('summary.url') or '').rstrip('/').split('/')[-1]
+        hosts = [mount.key for mount in row.get('host', [])
+                 if mount.mountInfo is None or mount.mountInfo.accessible is not False]
+        datastores[row['name']] = (uuid, hosts)
+    hosts = list({host for uuid, mounts in datastores.values() for host in mounts})
+    values = query_perf(content, hosts, [counter for counter, scale in DATASTORE_STATS.values()],
+                        interval, samples, instance='*')
+    stats = {}
+    for name, (uuid, mounts) in datastores.items():
+        row = {}
+        for column, (counter, scale) in DATASTORE_STATS.items():
+            found = [values[host][(counter, uuid)] for host in mounts
+                     if (counter, uuid) in values.get(host, {})]
+            value = None
+            if found:
+                value = max(found) if 'latency' in column else sum(found)
+            row[column] = _scaled(value, scale, interval)
+        stats[name] = row
+    return stats
+
+# ---
+# ---
+
+# vms a guest command runs on at once
+GUEST_TASKS = 16
+# seconds between looks at the output and state of a guest program
+GUEST_POLL = 1
+# seconds a guest program gets before it's terminated
+GUEST_TIMEOUT = 3600
+GUEST_PROPERTIES = ['name', 'runtime.powerState', 'guest.guestFamily', 'guest.guestOperationsReady']
+
+def _guest_transfer(content, url, data=None, offset=0):
+    """
+    GET a guest file transfer url from offset on, or PUT data to it. A *
+    host is the vcenter.
+    """
+    url = url.replace('://*', '://{}'.format(site_of(content)['VC_HOST']), 1)
+    request = urllib.request.Request(url, data=data, method='GET' if data is None else 'PUT')
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+    with urllib.request.urlopen(request, context=ssl._create_unverified_context()) as response:
+        body = response.read()
+    # a server ignoring the range sends the whole file
+    return body[offset:] if offset and response.status != 206 else body
+
+_guest_managers = {}
+
+def guest_managers(content):
+    """ (process, file, auth) managers of guest operations, fetched once per connection """
+    if content not in _guest_managers:
+        manager = content.guestOperationsManager
+        if manager is None:
+            raise Exception("Guest operations are not available on this vcenter")
+        _guest_managers[content] = (manager.processManager, manager.fileManager, manager.authManager)
+    return _guest_managers[content]
+
+class GuestSession(object):
+    """
+    Guest operations on one vm under one guest login. The login is checked
+    once, then the same authentication serves every program, process
+    listing and file transfer.
+    """
+    def __init__(self, content, vm, user, password, family=None):
+        self.content = content
+        self.vm = vm
+        self.family = family
+        self.processes, self.files, auth = guest_managers(content)
+        self.auth = vim.vm.guest.NamePasswordAuthentication(username=user, password=password,
+                                                            interactiveSession=False)
+        auth.ValidateCredentialsInGuest(vm, self.auth)
+
+    def start(self, command, output):
+        """ pid of command run by the guest shell, its stdout and stderr go to the guest file output """
+        if self.family == 'windowsGuest':
+            spec = vim.vm.guest.ProcessManager.ProgramSpec(
+                programPath='C:\\Windows\\System32\\cmd.exe',
+                arguments='/c {} > "{}" 2>&1'.format(command, output))
+        else:
+            spec = vim.vm.guest.ProcessManager.ProgramSpec(
+                programPath='/bin/sh',
+                arguments='-c {} > {} 2>&1'.format(shlex.quote(command), shlex.quote(output)))
+        return self.processes.StartProgramInGuest(self.vm, self.auth, spec)
+
+    def ps(self, pids=None):
+        """ ProcessInfo of the guest processes, or of pids """
+        return list(self.processes.ListProcessesInGuest(self.vm, self.auth, pids=pids) or [])
+
+    def read(self, path, offset=0):
+        """ content of guest file path from offset on """
+        info = self.files.InitiateFileTransferFromGuest(self.vm, self.auth, path)
+        if offset and info.size <= offset:
+            return b''
+        return _guest_transfer(self.content, info.url, offset=offset)
+
+    def write(self, path, data):
+        """ write data to guest file path, replacing what's there """
+        url = self.files.InitiateFileTransferToGuest(self.vm, self.auth, path,
+                                                     vim.vm.guest.FileManager.FileAttributes(),
+                                                     len(data), True)
+        _guest_transfer(self.content, url, data)
+
+    def run(self, command, output=None, timeout=GUEST_TIMEOUT, poll=GUEST_POLL):
+        """
+        Run command with the guest shell, output(line) gets its output lines
+        as they are written, each poll fetches only what's new. Returns the
+        exit code, the program is terminated after timeout seconds.
+        """
+        path = self.files.CreateTemporaryFileInGuest(self.vm, self.auth, 'vcenter_shell-', '.out')
+        try:
+            pid = self.start(command, path)
+            deadline = time.time() + timeout
+            seen, pending = 0, b''
+            while True:
+                info = self.ps([pid])
+                ended = not info or info[0].endTime is not None
+                if output is not None:
+                    data = self.read(path, seen)
+                    lines = (pending + data).split(b'\n')
+                    seen, pending = seen + len(data), lines.pop()
+                    if ended and pending:
+                        lines.append(pending)
+                    for line in lines:
+                        output(line.decode(errors='replace').rstrip('\r'))
+                if ended:
+                    return info[0].exitCode if info else None
+                if time.time() > deadline:
+                    self.processes.TerminateProcessInGuest(self.vm, self.auth, pid)
+                    raise Exception("{} still ran after {}s, terminated".format(command, timeout))
+                time.sleep(poll)
+        finally:
+            try:
+                self.files.DeleteFileInGuest(self.vm, self.auth, path)
+            except Exception:
+                pass
+
+_guest_sessions = {}
+_guest_lock = threading.Lock()
+
+def guest_session(content, vm, user, password, row=None):
+    """
+    GuestSession of vm for user, kept for later calls while the password
+    stays the same. row has the GUEST_PROPERTIES of vm, they're fetched
+    without it. Fails for vms that don't run or have no guest tools.
+    """
+    key = (content, vm._moId, user)
+    with _guest_lock:
+        session = _guest_sessions.get(key)
+    if session is not None and session.auth.password == password:
+        return session
+    if row is None:
+        row = next(query(content, [vim.VirtualMachine], GUEST_PROPERTIES, objs=[vm]), None)
+        if row is None:
+            raise Exception("No vm {} found, it was removed".format(vm._moId))
+    if row.get('runtime.powerState') != 'poweredOn':
+        raise Exception("{} is {}".format(row['name'], row.get('runtime.powerState')))
+    if not row.get('guest.guestOperationsReady'):
+        raise Exception("Guest operations aren't ready on {}, are vmware tools running?".format(row['name']))
+    session = GuestSession(content, vm, user, password, row.get('guest.guestFamily'))
+    with _guest_lock:
+        _guest_sessions[key] = session
+    return session
+
+def guest_run(content, vms, command, user, password, workers=GUEST_TASKS, timeout=GUEST_TIMEOUT,
+              upload=None, output=None, progress=None):
+    """
+    Run command in the guests of vms, the {name: row} of select_vms() or a
+    list of such rows, at once, no more than workers at a time. upload is
+    an optional (data, guest path) written first, a script to run say.
+    output(name, line) gets the output lines of every vm as they come,
+    progress(name, exit code, err) is called as each vm is done.
+    Returns {moId: exit code or exception}, same-name vms are kept apart.
+    """
+    selected = vms.values() if isinstance(vms, dict) else vms
+    rows = {row['obj']._moId: row for row in query(content, [vim.VirtualMachine], GUEST_PROPERTIES,
+                                                   objs=[row['obj'] for row in selected])}
+    results = {}
+
+    def run(moid):
+        row = rows[moid]
+        name = row['name']
+        try:
+            session = guest_session(content, row['obj'], user, password, row)
+            if upload:
+                session.write(upload[1], upload[0])
+            results[moid] = session.run(command, output and (lambda line: output(name, line)), timeout)
+        except Exception as err:
+            results[moid] = err
+            if progress:
+                progress(name, None, err)
+            return
+        if progress:
+            progress(name, results[moid], None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_in_context(run), sorted(rows, key=lambda moid: (rows[moid]['name'], moid))))
+    return results
+
+# ---
+# ---
+
+# threads per vcenter behind the awaitable api, a call holds one until func returns,
+# its task waits included; wait_for_task_async() and power_vm_async() wait without one
+ASYNC_WORKERS = 32
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def async_executor(content):
+    """ the bounded executor of content's vcenter, its calls share the session connection pool """
+    with _executors_lock:
+        executor = _executors.get(content)
+        if executor is None:
+            executor = _executors[content] = ThreadPoolExecutor(max_workers=ASYNC_WORKERS,
+                                                                thread_name_prefix='vcenter')
+        return executor
+
+def _task_reporter(loop, progress):
+    """ TaskMonitor progress callback calling progress(name, description, percent) on loop """
+    if progress is None:
+        return None
+    def report(info):
+        percent = 100 if info.get('info.state') == 'success' else info.get('info.progress')
+        loop.call_soon_threadsafe(progress, info.get('info.entityName'),
+                                  info.get('info.descriptionId'), percent)
+    return report
+
+async def run_async(content, func, *args, task_progress=None, **kwargs):
+    """
+    Await func(content, *args, **kwargs) run on async_executor(content).
+    task_progress(name, description, percent) is called on the event loop
+    for every vcenter task func waits on, in its own thread or the pools it starts.
+    """
+    loop = asyncio.get_running_loop()
+    report = _task_reporter(loop, task_progress)
+
+    def call():
+        _task_progress.set(report)
+        return func(content, *args, **kwargs)
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(async_executor(content), context.run, call)
+
+async def wait_for_task_async(task, progress=None):
+    """ result of task, awaited on its TaskMonitor without holding a thread """
+    report = _task_reporter(asyncio.get_running_loop(), progress)
+    return await asyncio.wrap_future(task_monitor(task._stub).add(task, report))
+
+POWER_TASK_METHODS = {'on': 'PowerOnVM_Task', 'off': 'PowerOffVM_Task', 'reset': 'ResetVM_Task'}
+
+async def power_vm_async(content, name, action, progress=None):
+    """ power on, off or reset vm name, only starting the task takes a thread """
+    if action not in POWER_TASK_METHODS:
+        raise Exception('Unknown power action {}, use one of {}'.format(action, ', '.join(POWER_TASK_METHODS)))
+    loop = asyncio.get_running_loop()
+    executor = async_executor(content)
+    vm = await loop.run_in_executor(executor, get_obj, content, [vim.VirtualMachine], name)
+    if vm is None:
+        raise Exception('No vm with {} name found'.format(name))
+    task = await loop.run_in_executor(executor, getattr(vm, POWER_TASK_METHODS[action]))
+    return await wait_for_task_async(task, progress)
+
+def _awaitable(func):
+    async def call(content, *args, task_progress=None, **kwargs):
+        return await run_async(content, func, *args, task_progress=task_progress, **kwargs)
+    call.__name__ = call.__qualname__ = func.__name__ + '_async'
+    call.__doc__ = 'awaitable {}(), see run_async()'.format(func.__name__)
+    return call
+
+clone_async = _awaitable(clone)
+vm_settings_async = _awaitable(vm_settings)
+add_disk_async = _awaitable(add_disk)
+add_disks_async = _awaitable(add_disks)
+provision_async = _awaitable(provision)
+power_vms_async = _awaitable(power_vms)
+guest_run_async = _awaitable(guest_run)
+select_vms_async = _awaitable(select_vms)
+find_vm_async = _awaitable(find_vm)
+find_vms_async = _awaitable(find_vms)
+list_tenants_async = _awaitable(list_tenants)
+list_clusters_async = _awaitable(list_clusters)
+list_datastores_async = _awaitable(list_datastores)
+list_vms_async = _awaitable(list_vms)
+list_templates_async = _awaitable(list_templates)
+list_dvs_async = _awaitable(list_dvs)
@@ -0,0 +1,850 @@
+#!/usr/bin/env python3
+#
+# Offline vcenter stand-in for benchmarks and trying things out
+
+from pyVmomi import vim, vmodl, VmomiSupport
+from pyVmomi.VmomiSupport import ManagedObject, DataObject, GetVmodlType
+import core
+import collections
+import datetime
+import http.server
+import itertools
+import re
+import shlex
+import threading
+import time
+import urllib.parse
+
+PC = vmodl.query.PropertyCollector
+
+# counters QueryPerf answers with made up samples
+PERF_COUNTERS = ['cpu.usage.average', 'cpu.ready.summation', 'mem.active.average',
+                 'mem.vmmemctl.average', 'disk.maxTotalLatency.latest', 'net.usage.average',
+                 'mem.usage.average', 'datastore.totalReadLatency.average',
+                 'datastore.totalWriteLatency.average', 'datastore.numberReadAveraged.average',
+                 'datastore.numberWriteAveraged.average']
+
+def _typed(val):
+    """ plain lists as the vmodl arrays pyVmomi returns """
+    if type(val) is list:
+        if not val:
+            return None
+        if isinstance(val[0], ManagedObject):
+            return ManagedObject.Array(val)
+        if isinstance(val[0], DataObject):
+            return DataObject.Array(val)
+        if isinstance(val[0], str):
+            return GetVmodlType('string[]')(val)
+    return val
+
+class SimulatorStub(object):
+    """
+    In-process pyVmomi stub serving the part of the vSphere api core uses:
+    property collector retrievals, filters and WaitForUpdatesEx, container
+    views, search index, tasks, vm power/clone/reconfigure, perf counters
+    and guest operations, whose programs echo and exit without running.
+    The inventory is one datacenter (DC01) with clusters, hosts, datastores
+    (two in the POD01 storage pod), a dvs with portgroups EPG0.., Templates
+    and vms spread over Tenants/tenantN folders nested depth levels deep.
+    Every call counts in calls and sleeps latency seconds, tasks take
+    task_time seconds.
+    """
+    def __init__(self, vms=50, tenants=3, depth=1, clusters=2, hosts=2, datastores=3,
+                 templates=('centos7', 'ubuntu18'), latency=0.0, task_time=0.05):
+        self.version = VmomiSupport.newestVersions.Get('vim')
+        self.latency = latency
+        self.task_time = task_time
+        self.calls = collections.Counter()
+        self.props = {}
+        self.mos = {}
+        # bumped whenever an object changes, WaitForUpdatesEx reports it then
+        self.gen = collections.Counter()
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+        self.tokens = {}
+        self.collectors = {}
+        self.filters = {}
+        self.views = {}
+        self.tasks = []
+        # running guest programs [(vm moId, pid, due, output path, output, exit code)]
+        self.programs = []
+        # vm moId -> {pid: ProcessInfo}, {path: bytes}
+        self.processes = collections.defaultdict(dict)
+        self.guest_files = collections.defaultdict(dict)
+        self.transfers = None
+        # guest file bytes sent by the transfer server
+        self.downloaded = 0
+        self._build(vms, tenants, depth, clusters, hosts, datastores, templates)
+
+    # object store
+
+    def new(self, cls, prefix, **props):
+        mo = cls('{}-{}'.format(prefix, next(self.ids)), self)
+        self.mos[mo._moId] = mo
+        self.props[mo._moId] = props
+        return mo
+
+    def p(self, mo):
+        return self.props[mo._moId]
+
+    def set(self, mo, **props):
+        self.props[mo._moId].update(props)
+        self.gen[mo._moId] += 1
+
+    def children(self, mo):
+        p = self.p(mo)
+        found = list(p.get('childEntity', []))
+        for key in ('vmFolder', 'hostFolder', 'datastoreFolder', 'networkFolder'):
+            if key in p:
+                found.append(p[key])
+        if isinstance(mo, vim.ClusterComputeResource):
+            found += list(p.get('host', []))
+        return found
+
+    def descendants(self, mo):
+        stack = list(reversed(self.children(mo)))
+        while stack:
+            child = stack.pop()
+            yield child
+            stack.extend(reversed(self.children(child)))
+
+    def resolve(self, mo, path):
+        parts = path.split('.')
+        val = self.p(mo).get(parts[0])
+        for part in parts[1:]:
+            if val is None:
+                return None
+            val = getattr(val, part)
+        return _typed(val)
+
+    def add_child(self, parent, child):
+        p = self.p(parent)
+        p['childEntity'] = list(p.get('childEntity', [])) + [child]
+        self.gen[parent._moId] += 1
+        self.p(child)['parent'] = parent
+
+    def remove_child(self, child):
+        parent = self.p(child).get('parent')
+        if parent is not None:
+            p = self.p(parent)
+            p['childEntity'] = [c for c in p['childEntity'] if c is not child]
+            self.gen[parent._moId] += 1
+        del self.props[child._moId]
+        del self.mos[child._moId]
+
+    # inventory
+
+    def _build(self, vms, tenants, depth, clusters, hosts, datastores, templates):
+        self.si = vim.ServiceInstance('ServiceInstance', self)
+        self.mos['ServiceInstance'] = self.si
+        self.props['ServiceInstance'] = {}
+        self.pc = vim.PropertyCollector('propertyCollector', self)
+        self.mos['propertyCollector'] = self.pc
+        self.props['propertyCollector'] = {}
+        self.collectors['propertyCollector'] = []
+        self.root = self.new(vim.Folder, 'group-d', name='Datacenters', childEntity=[])
+        self.perf = self.new(vim.PerformanceManager, 'PerfMgr')
+        self.task_manager = self.new(vim.TaskManager, 'TaskManager', recentTask=[])
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=self.root, propertyCollector=self.pc,
+            viewManager=self.new(vim.view.ViewManager, 'ViewManager'),
+            searchIndex=self.new(vim.SearchIndex, 'SearchIndex'),
+            storageResourceManager=self.new(vim.StorageResourceManager, 'StorageResourceManager'),
+            perfManager=self.perf, taskManager=self.task_manager,
+            sessionManager=self.new(vim.SessionManager, 'SessionManager'),
+            guestOperationsManager=self.new(vim.vm.guest.GuestOperationsManager, 'guestOperationsManager',
+                processManager=self.new(vim.vm.guest.ProcessManager, 'guestOperationsProcessManager'),
+                fileManager=self.new(vim.vm.guest.FileManager, 'guestOperationsFileManager'),
+                authManager=self.new(vim.vm.guest.AuthManager, 'guestOperationsAuthManager')),
+            about=vim.AboutInfo(name='simulator', apiVersion='6.7', instanceUuid='simulator',
+                                version='6.7.0'))
+
+        dc = self.dc = self.new(vim.Datacenter, 'datacenter', name='DC01')
+        self.add_child(self.root, dc)
+        folders = {}
+        for key, prefix in (('vmFolder', 'group-v'), ('hostFolder', 'group-h'),
+                            ('datastoreFolder', 'group-s'), ('networkFolder', 'group-n')):
+            folders[key] = self.new(vim.Folder, prefix, name=key[:-len('Folder')],
+                                    childEntity=[], parent=dc)
+        self.p(dc).update(folders)
+
+        self.clusters = []
+        for i in range(clusters):
+            members = []
+            for h in range(hosts):
+                members.append(self.new(vim.HostSystem, 'host', name='esx{}{}'.format(i, h),
+                    summary=vim.host.Summary(
+                        hardware=vim.host.Summary.HardwareSummary(memorySize=256 * 1024**3,
+                                                                  numCpuCores=32, cpuMhz=2000),
+                        quickStats=vim.host.Summary.QuickStats(overallMemoryUsage=1024 * (10 + h * 40),
+                                                               overallCpuUsage=1000 * (1 + h))),
+                    runtime=vim.host.RuntimeInfo(connectionState='connected', inMaintenanceMode=False)))
+            pool = self.new(vim.ResourcePool, 'resgroup', name='Resources')
+            cluster = self.new(vim.ClusterComputeResource, 'domain-c', name='CL{:02d}'.format(i + 1),
+                resourcePool=pool, host=members,
+                summary=vim.ClusterComputeResource.Summary(
+                    numCpuCores=32 * hosts, numCpuThreads=64 * hosts, totalMemory=256 * 1024**3 * hosts,
+                    numHosts=hosts, overallStatus='green', effectiveMemory=400 * 1024 * (i + 1),
+                    effectiveCpu=100000, totalCpu=128000))
+            self.p(pool)['owner'] = cluster
+            for host in members:
+                self.p(host)['parent'] = cluster
+            self.add_child(folders['hostFolder'], cluster)
+            self.clusters.append(cluster)
+        all_hosts = [host for cluster in self.clusters for host in self.p(cluster)['host']]
+
+        self.datastores = []
+        for i in range(datastores):
+            name = 'DS{:02d}'.format(i + 1)
+            ds = self.new(vim.Datastore, 'datastore', name=name, overallStatus='green',
+                summary=vim.Datastore.Summary(capacity=10 * 1024**4, freeSpace=(i + 1) * 1024**4,
+                                              name=name, accessible=True, type='VMFS'),
+                info=vim.host.VmfsDatastoreInfo(name=name))
+            self.p(ds)['summary'].url = 'ds:///vmfs/volumes/uuid-{}/'.format(ds._moId)
+            self.p(ds)['host'] = [vim.Datastore.HostMount(key=host, mountInfo=vim.host.MountInfo(accessible=True))
+                                  for host in all_hosts]
+            self.datastores.append(ds)
+        pod = self.new(vim.StoragePod, 'group-p', name='POD01', childEntity=[], overallStatus='green',
+            summary=vim.StoragePod.Summary(capacity=20 * 1024**4, freeSpace=5 * 1024**4, name='POD01'))
+        self.add_child(folders['datastoreFolder'], pod)
+        for ds in self.datastores:
+            self.add_child(pod if ds in self.datastores[:2] else folders['datastoreFolder'], ds)
+        for cluster in self.clusters:
+            self.p(cluster)['datastore'] = list(self.datastores)
+        for host in all_hosts:
+            self.p(host)['datastore'] = list(self.datastores)
+
+        switch = self.new(vim.dvs.VmwareDistributedVirtualSwitch, 'dvs', name='DVS01', uuid='dvs-uuid-1')
+        self.add_child(folders['networkFolder'], switch)
+        self.portgroups = []
+        for i in range(3):
+            pg = self.new(vim.dvs.DistributedVirtualPortgroup, 'dvportgroup', name='EPG{}'.format(i),
+                key='dvportgroup-key-{}'.format(i),
+                config=vim.dvs.DistributedVirtualPortgroup.ConfigInfo(distributedVirtualSwitch=switch,
+                                                                      name='EPG{}'.format(i)))
+            self.add_child(folders['networkFolder'], pg)
+            self.portgroups.append(pg)
+        self.p(switch)['summary'] = vim.DistributedVirtualSwitch.Summary(
+            name='DVS01', portgroupName=[self.p(pg)['name'] for pg in self.portgroups])
+
+        self.tenants_folder = self.new(vim.Folder, 'group-v', name='Tenants', childEntity=[])
+        self.templates_folder = self.new(vim.Folder, 'group-v', name='Templates', childEntity=[])
+        linux = self.new(vim.Folder, 'group-v', name='linux', childEntity=[])
+        self.add_child(folders['vmFolder'], self.tenants_folder)
+        self.add_child(folders['vmFolder'], self.templates_folder)
+        self.add_child(self.templates_folder, linux)
+        for name in templates:
+            self.add_child(linux, self.make_vm(name, template=True))
+        n = 0
+        for i in range(tenants):
+            levels = [self.new(vim.Folder, 'group-v', name='tenant{}'.format(i), childEntity=[])]
+            self.add_child(self.tenants_folder, levels[0])
+            for level in range(depth):
+                levels.append(self.new(vim.Folder, 'group-v', name='nested{}'.format(level), childEntity=[]))
+                self.add_child(levels[-2], levels[-1])
+            for j in range(vms // tenants + (i < vms % tenants)):
+                self.add_child(levels[j % len(levels)], self.make_vm('vm{:05d}'.format(n), powered=n % 2 == 0))
+                n += 1
+
+        counters = []
+        for i, name in enumerate(PERF_COUNTERS):
+            group, counter, rollup = name.split('.')
+            counters.append(vim.PerformanceManager.CounterInfo(key=100 + i, rollupType=rollup, statsType='rate',
+                groupInfo=vim.ElementDescription(key=group, label=group, summary=group),
+                nameInfo=vim.ElementDescription(key=counter, label=counter, summary=counter),
+                unitInfo=vim.ElementDescription(key='number', label='number', summary='number')))
+        self.p(self.perf)['perfCounter'] = counters
+
+    def make_vm(self, name, template=False, powered=False, cpu=2, ram=4096, disk_kb=20 * 1024 * 1024):
+        n = next(self.ids)
+        pg = self.portgroups[0]
+        disk = vim.vm.device.VirtualDisk(key=2000, unitNumber=0, controllerKey=1000, capacityInKB=disk_kb,
+            deviceInfo=vim.Description(label='Hard disk 1', summary=''),
+            backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                fileName='[DS01] {0}/{0}.vmdk'.format(name), thinProvisioned=True,
+                diskMode='persistent', datastore=self.datastores[0]))
+        controller = vim.vm.device.ParaVirtualSCSIController(key=1000, busNumber=0, device=[2000],
+                                                             sharedBus='noSharing')
+        mac = '00:50:56:{:02x}:{:02x}:{:02x}'.format((n >> 16) & 255, (n >> 8) & 255, n & 255)
+        nic = vim.vm.device.VirtualVmxnet3(key=4000, macAddress=mac,
+            deviceInfo=vim.Description(label='Network adapter 1', summary=''),
+            backing=vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo(
+                port=vim.dvs.PortConnection(portgroupKey=self.p(pg)['key'], switchUuid='dvs-uuid-1')))
+        ip = '10.{}.{}.{}'.format((n >> 16) & 255, (n >> 8) & 255, n & 255)
+        state = 'poweredOn' if powered else 'poweredOff'
+        uuid = '4200{:04x}-0000-0000-0000-{:012x}'.format(n & 0xffff, n)
+        return self.new(vim.VirtualMachine, 'vm', name=name,
+            summary=vim.vm.Summary(
+                config=vim.vm.Summary.ConfigSummary(name=name, numCpu=cpu, memorySizeMB=ram, template=template,
+                    vmPathName='[DS01] {0}/{0}.vmx'.format(name), guestFullName='CentOS 7 (64-bit)',
+                    uuid=uuid, instanceUuid='5000' + uuid[4:]),
+                runtime=vim.vm.RuntimeInfo(powerState=state),
+                quickStats=vim.vm.Summary.QuickStats(overallCpuUsage=100, guestMemoryUsage=ram // 4),
+                guest=vim.vm.Summary.GuestSummary(ipAddress=ip if powered else None,
+                                                  toolsRunningStatus='guestToolsRunning')),
+            config=vim.vm.ConfigInfo(name=name, template=template, guestFullName='CentOS 7 (64-bit)',
+                guestId='centos7_64Guest', uuid=uuid, changeVersion=str(n),
+                hardware=vim.vm.VirtualHardware(numCPU=cpu, memoryMB=ram, numCoresPerSocket=1,
+                                                device=[controller, disk, nic])),
+            runtime=vim.vm.RuntimeInfo(powerState=state),
+            guest=vim.vm.GuestInfo(ipAddress=ip if powered else None, toolsRunningStatus='guestToolsRunning',
+                                   net=[vim.vm.GuestInfo.NicInfo(macAddress=mac, ipAddress=[ip])],
+                                   guestFamily='linuxGuest', guestOperationsReady=powered),
+            network=[pg], datastore=[self.datastores[0]], snapshot=None,
+            resourcePool=self.p(self.clusters[0])['resourcePool'])
+
+    # pyVmomi stub interface
+
+    def InvokeMethod(self, mo, info, args):
+        self.calls[info.wsdlName] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, 'do_' + info.wsdlName, None)
+        if handler is None:
+            raise vmodl.fault.NotSupported(msg='{} is not simulated'.format(info.wsdlName))
+        with self.lock:
+            self.advance()
+            return handler(mo, *args)
+
+    def InvokeAccessor(self, mo, info):
+        spec = PC.FilterSpec(objectSet=[PC.ObjectSpec(obj=mo)],
+                             propSet=[PC.PropertySpec(type=mo.__class__, pathSet=[info.name])])
+        result = self.pc.RetrievePropertiesEx([spec], PC.RetrieveOptions(maxObjects=1))
+        if result and result.objects and result.objects[0].propSet:
+            return result.objects[0].propSet[0].val
+        return None
+
+    def do_RetrieveServiceContent(self, mo):
+        return self.content
+
+    def do_CurrentTime(self, mo):
+        return datetime.datetime.now()
+
+    # views
+
+    def _view_objects(self, container, types, recursive):
+        objs = list(self.descendants(container)) if recursive else self.children(container)
+        if types:
+            objs = [obj for obj in objs if isinstance(obj, tuple(types))]
+        return objs
+
+    def do_CreateContainerView(self, mo, container, type, recursive):
+        view = self.new(vim.view.ContainerView, 'session[0]view')
+        self.views[view._moId] = (container, type, recursive)
+        self.p(view)['view'] = self._view_objects(container, type, recursive)
+        return view
+
+    def do_DestroyView(self, mo):
+        self.views.pop(mo._moId, None)
+        self.props.pop(mo._moId, None)
+
+    # property collector
+
+    def select(self, spec):
+        """ [(obj, paths)] a filter spec selects """
+        named = {}
+
+        def names(selects):
+            for select in selects or []:
+                if isinstance(select, PC.TraversalSpec):
+                    named[select.name] = select
+                    names(select.selectSet)
+        for obj_spec in spec.objectSet:
+            names(obj_spec.selectSet)
+        # by moId, hashing MoRefs is slow
+        found = collections.OrderedDict()
+
+        def walk(obj, selects, seen):
+            for select in selects or []:
+                if not isinstance(select, PC.TraversalSpec):
+                    select = named[select.name]
+                if not isinstance(obj, select.type) or (obj._moId, select.name) in seen:
+                    continue
+                seen.add((obj._moId, select.name))
+                if obj._moId in self.views:
+                    self.p(obj)['view'] = self._view_objects(*self.views[obj._moId])
+                val = self.resolve(obj, select.path) if obj._moId in self.props else None
+                for target in val if isinstance(val, list) else ([val] if val is not None else []):
+                    if not isinstance(target, ManagedObject):
+                        continue
+                    if not select.skip:
+                        found[target._moId] = target
+                    walk(target, select.selectSet, seen)
+        for obj_spec in spec.objectSet:
+            if obj_spec.obj._moId not in self.props:
+                continue
+            if not obj_spec.skip:
+                found[obj_spec.obj._moId] = obj_spec.obj
+            walk(obj_spec.obj, obj_spec.selectSet, set())
+        selected = []
+        for obj in found.values():
+            if obj._moId not in self.props:
+                continue
+            specs = [prop_spec for prop_spec in spec.propSet if isinstance(obj, prop_spec.type)]
+            if specs:
+                paths = []
+                for prop_spec in specs:
+                    paths += [path for path in prop_spec.pathSet or [] if path not in paths]
+                selected.append((obj, paths))
+        return selected
+
+    def contents(self, specs):
+        found = []
+        for spec in specs:
+            for obj, paths in self.select(spec):
+                props = [vmodl.DynamicProperty(name=path, val=self.resolve(obj, path)) for path in paths]
+                found.append(PC.ObjectContent(obj=obj, propSet=[prop for prop in props if prop.val is not None]))
+        return found
+
+    def _page(self, objs, size):
+        size = size or 100
+        token = None
+        if objs[size:]:
+            token = 'token-{}'.format(next(self.ids))
+            self.tokens[token] = (objs[size:], size)
+        return PC.RetrieveResult(objects=objs[:size], token=token)
+
+    def do_RetrievePropertiesEx(self, mo, specSet, options):
+        objs = self.contents(specSet)
+        return self._page(objs, options.maxObjects if options else None) if objs else None
+
+    def do_ContinueRetrievePropertiesEx(self, mo, token):
+        return self._page(*self.tokens.pop(token))
+
+    def do_CancelRetrievePropertiesEx(self, mo, token):
+        self.tokens.pop(token, None)
+
+    def do_RetrieveContents(self, mo, specSet):
+        return self.contents(specSet)
+
+    def do_CreatePropertyCollector(self, mo):
+        collector = vim.PropertyCollector('session[0]pc-{}'.format(next(self.ids)), self)
+        self.mos[collector._moId] = collector
+        self.props[collector._moId] = {}
+        self.collectors[collector._moId] = []
+        return collector
+
+    def do_DestroyPropertyCollector(self, mo):
+        for filter in self.collectors.pop(mo._moId, []):
+            self.filters.pop(filter._moId, None)
+        self.props.pop(mo._moId, None)
+
+    def do_CreateFilter(self, mo, spec, partialUpdates):
+        filter = PC.Filter('session[0]filter-{}'.format(next(self.ids)), self)
+        self.mos[filter._moId] = filter
+        self.props[filter._moId] = {}
+        self.filters[filter._moId] = {'spec': spec, 'state': {}, 'partial': partialUpdates}
+        self.collectors.setdefault(mo._moId, []).append(filter)
+        return filter
+
+    def do_DestroyPropertyFilter(self, mo):
+        self.filters.pop(mo._moId, None)
+        for filters in self.collectors.values():
+            if mo in filters:
+                filters.remove(mo)
+
+    @staticmethod
+    def _changes(path, old, new, partial):
+        """
+        Changes of path from old to new. With partial updates a keyed array
+        such as config.hardware.device changes element by element, as
+        path[key] adds, assigns and removes.
+        """
+        keyed = lambda value: isinstance(value, list) and all(hasattr(item, 'key') for item in value)
+        if not partial or old is None or not (keyed(old) and keyed(new)):
+            return [PC.Change(name=path, op='assign', val=new)]
+        before = {item.key: item for item in old}
+        after = {item.key: item for item in new}
+        changes = [PC.Change(name='{}[{}]'.format(path, key), op='remove')
+                   for key in before if key not in after]
+        changes += [PC.Change(name='{}[{}]'.format(path, key), op='assign' if key in before else 'add',
+                              val=item) for key, item in after.items()]
+        return changes
+
+    def _diff(self, filter):
+        """ (new state, ObjectUpdates) of a filter since its last state """
+        state, updates = {}, []
+        for obj, paths in self.select(filter['spec']):
+            old = filter['state'].get(obj._moId)
+            if old is not None and old[1] == self.gen[obj._moId]:
+                state[obj._moId] = old
+                continue
+            values = {path: self.resolve(obj, path) for path in paths}
+            # copies, arrays edited in place still diff against what was sent
+            state[obj._moId] = (obj, self.gen[obj._moId],
+                                {path: list(val) if isinstance(val, list) else val
+                                 for path, val in values.items()})
+            changes = [change for path, val in values.items() for change in
+                       self._changes(path, old and old[2].get(path), val, filter['partial'])]
+            updates.append(PC.ObjectUpdate(kind='enter' if old is None else 'modify', obj=obj,
+                                           changeSet=changes))
+        for key, (obj, gen, values) in filter['state'].items():
+            if key not in state:
+                updates.append(PC.ObjectUpdate(kind='leave', obj=obj, changeSet=[]))
+        return state, updates
+
+    def do_WaitForUpdatesEx(self, mo, version, options):
+        wait = options.maxWaitSeconds if options and options.maxWaitSeconds is not None else None
+        deadline = None if wait is None else time.time() + wait
+        filters = self.collectors.get(mo._moId)
+        if filters is None:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        current = self.props[mo._moId].get('version', 0)
+        if not version:
+            for filter in filters:
+                self.filters[filter._moId]['state'] = {}
+        elif str(current) != version:
+            raise vmodl.query.InvalidCollectorVersion()
+        waiting = self.props[mo._moId]
+        waiting['canceled'] = False
+        while True:
+            if waiting.get('canceled'):
+                raise vmodl.fault.RequestCanceled()
+            if mo._moId not in self.collectors:
+                raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+            self.advance()
+            filter_sets = []
+            for filter in list(filters):
+                if filter._moId not in self.filters:
+                    continue
+                state, updates = self._diff(self.filters[filter._moId])
+                self.filters[filter._moId]['state'] = state
+                if updates:
+                    filter_sets.append(PC.FilterUpdate(filter=filter, objectSet=updates))
+            if filter_sets:
+                current += 1
+                self.props[mo._moId]['version'] = current
+                return PC.UpdateSet(version=str(current), filterSet=filter_sets, truncated=False)
+            if deadline is not None and time.time() >= deadline:
+                return None
+            self.lock.release()
+            time.sleep(0.005)
+            self.lock.acquire()
+
+    def do_CancelWaitForUpdates(self, mo):
+        if mo._moId not in self.collectors:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        self.props[mo._moId]['canceled'] = True
+
+    # tasks
+
+    def task(self, entity, effect=None, duration=None):
+        """ running Task on entity, effect() is applied and returned as result when it's due """
+        task = self.new(vim.Task, 'task', info=vim.TaskInfo(key='task', state='running', entity=entity,
+            entityName=self.p(entity).get('name') if entity is not None else None,
+            descriptionId='simulated', progress=0))
+        self.tasks.append((task, time.time() + (self.task_time if duration is None else duration), effect))
+        self.p(self.task_manager)['recentTask'] = self.p(self.task_manager)['recentTask'][-199:] + [task]
+        self.gen[self.task_manager._moId] += 1
+        return task
+
+    def advance(self):
+        """ finish the tasks that are due """
+        now = time.time()
+        for item in list(self.tasks):
+            task, due, effect = item
+            if due > now:
+                continue
+            self.tasks.remove(item)
+            info = self.p(task)['info']
+            try:
+                info.result = effect() if effect else None
+                info.state = 'success'
+                info.progress = 100
+            except vmodl.MethodFault as err:
+                info.error = err
+                info.state = 'error'
+            if task._moId in self.props:
+                self.gen[task._moId] += 1
+        for item in list(self.programs):
+            vm, pid, due, path, output, code = item
+            if due > now:
+                continue
+            self.programs.remove(item)
+            self.guest_files[vm][path] = self.guest_files[vm].get(path, b'') + output
+            info = self.processes[vm][pid]
+            info.endTime = datetime.datetime.now()
+            info.exitCode = code
+
+    # virtual machines
+
+    def do_CloneVM_Task(self, mo, folder, name, spec):
+        if spec.snapshot is not None and spec.snapshot._moId not in self.props:
+            raise vmodl.fault.ManagedObjectNotFound(obj=spec.snapshot)
+
+        def effect():
+            hardware = self.p(mo)['config'].hardware
+            vm = self.make_vm(name, powered=bool(spec.powerOn), cpu=hardware.numCPU, ram=hardware.memoryMB)
+            if spec.config:
+                self.reconfig(vm, spec.config)
+            if spec.location and spec.location.deviceChange:
+                self.reconfig(vm, vim.vm.ConfigSpec(deviceChange=spec.location.deviceChange))
+            if spec.location and spec.location.datastore:
+                self.p(vm)['datastore'] = [spec.location.datastore]
+            self.add_child(folder, vm)
+            return vm
+        return self.task(mo, effect)
+
+    def do_InstantClone_Task(self, mo, spec):
+        def effect():
+            vm = self.make_vm(spec.name, powered=True)
+            if spec.location.deviceChange:
+                self.reconfig(vm, vim.vm.ConfigSpec(deviceChange=spec.location.deviceChange))
+            self.add_child(spec.location.folder, vm)
+            return vm
+        return self.task(mo, effect)
+
+    def reconfig(self, vm, spec):
+        p = self.p(vm)
+        hardware = p['config'].hardware
+        if spec.numCPUs:
+            hardware.numCPU = p['summary'].config.numCpu = spec.numCPUs
+        if spec.memoryMB:
+            hardware.memoryMB = p['summary'].config.memorySizeMB = spec.memoryMB
+        for change in spec.deviceChange or []:
+            device = change.device
+            if change.operation == 'edit':
+                hardware.device = [device if d.key == device.key else d for d in hardware.device]
+                if isinstance(device, vim.vm.device.VirtualEthernetCard):
+                    key = device.backing.port.portgroupKey
+                    p['network'] = [pg for pg in self.portgroups if self.p(pg)['key'] == key]
+            elif change.operation == 'add':
+                if device.key is None or device.key < 0:
+                    device.key = 3000 + next(self.ids)
+                hardware.device = list(hardware.device) + [device]
+            elif change.operation == 'remove':
+                hardware.device = [d for d in hardware.device if d.key != device.key]
+        p['config'].changeVersion = str(next(self.ids))
+        self.gen[vm._moId] += 1
+
+    def do_ReconfigVM_Task(self, mo, spec):
+        return self.task(mo, lambda: self.reconfig(mo, spec))
+
+    def power(self, mo, state):
+        def effect():
+            p = self.p(mo)
+            p['runtime'].powerState = p['summary'].runtime.powerState = state
+            p['guest'].guestOperationsReady = state == 'poweredOn'
+            self.gen[mo._moId] += 1
+        return effect
+
+    def do_PowerOnVM_Task(self, mo, host):
+        return self.task(mo, self.power(mo, 'poweredOn'))
+
+    def do_PowerOffVM_Task(self, mo):
+        return self.task(mo, self.power(mo, 'poweredOff'))
+
+    def do_ResetVM_Task(self, mo):
+        return self.task(mo, self.power(mo, 'poweredOn'))
+
+    def do_ShutdownGuest(self, mo):
+        # not a task, the guest powers off a little later
+        self.tasks.append((self.new(vim.Task, 'task', info=vim.TaskInfo(state='running')),
+                           time.time() + self.task_time, self.power(mo, 'poweredOff')))
+
+    def do_PowerOnMultiVM_Task(self, mo, vm, option):
+        def effect():
+            return vim.cluster.PowerOnVmResult(attempted=[
+                vim.cluster.AttemptedVmInfo(vm=each, task=self.task(each, self.power(each, 'poweredOn')))
+                for each in vm])
+        return self.task(mo, effect, duration=0)
+
+    def do_Destroy_Task(self, mo):
+        return self.task(mo, lambda: self.remove_child(mo))
+
+    def do_CreateSnapshot_Task(self, mo, name, description, memory, quiesce):
+        if self.p(mo)['config'].template:
+            raise vim.fault.InvalidState(msg='{} is a template'.format(self.p(mo)['name']))
+
+        def effect():
+            snapshot = self.new(vim.vm.Snapshot, 'snapshot')
+            tree = vim.vm.SnapshotTree(name=name, snapshot=snapshot, childSnapshotList=[], vm=mo,
+                                       description=description or '', id=1, state='poweredOff',
+                                       createTime=datetime.datetime.now(), quiesced=False)
+            old = self.p(mo).get('snapshot')
+            self.p(mo)['snapshot'] = vim.vm.SnapshotInfo(currentSnapshot=snapshot,
+                rootSnapshotList=(list(old.rootSnapshotList) if old else []) + [tree])
+            self.gen[mo._moId] += 1
+            return snapshot
+        return self.task(mo, effect)
+
+    def do_RemoveSnapshot_Task(self, mo, removeChildren, consolidate=None):
+        vm = next(vm for vm in self._vms() if self.p(vm).get('snapshot') and
+                  mo in [tree.snapshot for tree in self.p(vm)['snapshot'].rootSnapshotList])
+
+        def effect():
+            info = self.p(vm)['snapshot']
+            trees = [tree for tree in info.rootSnapshotList if tree.snapshot != mo]
+            self.p(vm)['snapshot'] = vim.vm.SnapshotInfo(currentSnapshot=trees[-1].snapshot,
+                                                         rootSnapshotList=trees) if trees else None
+            self.props.pop(mo._moId, None)
+            self.gen[vm._moId] += 1
+        return self.task(vm, effect)
+
+    def _mark(self, mo, template):
+        self.p(mo)['config'].template = self.p(mo)['summary'].config.template = template
+        self.p(mo)['config'].changeVersion = str(next(self.ids))
+        self.gen[mo._moId] += 1
+
+    def do_MarkAsVirtualMachine(self, mo, pool, host=None):
+        self._mark(mo, False)
+
+    def do_MarkAsTemplate(self, mo):
+        self._mark(mo, True)
+
+    # search index
+
+    def do_FindByInventoryPath(self, mo, inventoryPath):
+        node = self.root
+        for part in inventoryPath.split('/'):
+            node = next((child for child in self.children(node) if self.p(child).get('name') == part), None)
+            if node is None:
+                return None
+        return node
+
+    def _vms(self):
+        return [obj for obj in self.mos.values() if isinstance(obj, vim.VirtualMachine)]
+
+    def do_FindAllByIp(self, mo, datacenter, ip, vmSearch):
+        return _typed([vm for vm in self._vms()
+                       if any(ip in (nic.ipAddress or []) for nic in self.p(vm)['guest'].net or [])])
+
+    def do_FindAllByUuid(self, mo, datacenter, uuid, vmSearch, instanceUuid):
+        key = 'instanceUuid' if instanceUuid else 'uuid'
+        return _typed([vm for vm in self._vms() if getattr(self.p(vm)['summary'].config, key) == uuid])
+
+    # guest operations
+
+    def _guest(self, vm, auth):
+        if self.p(vm)['runtime'].powerState != 'poweredOn':
+            raise vim.fault.InvalidPowerState(msg='{} is not running'.format(self.p(vm)['name']))
+        if not auth.password:
+            raise vim.fault.InvalidGuestLogin(msg='Failed to authenticate with the guest operating system')
+
+    def do_ValidateCredentialsInGuest(self, mo, vm, auth):
+        self._guest(vm, auth)
+
+    def do_StartProgramInGuest(self, mo, vm, auth, spec):
+        """ '-c COMMAND > OUTPUT 2>&1': echo prints, sleep N lasts, exit N and false fail """
+        self._guest(vm, auth)
+        words = shlex.split(spec.arguments)
+        command, path = words[1], words[3]
+        duration, code = self.task_time, 0
+        output = b'$ ' + command.encode() + b'\n'
+        self.guest_files[vm._moId][path] = output
+        output = b''
+        if command.startswith('echo '):
+            output = command[5:].encode() + b'\n'
+        match = re.search(r'sleep (\d+(\.\d+)?)', command)
+        if match:
+            duration = float(match.group(1))
+        match = re.search(r'exit (\d+)', command)
+        if match:
+            code = int(match.group(1))
+        elif command.strip() == 'false':
+            code = 1
+        pid = next(self.ids)
+        self.processes[vm._moId][pid] = vim.vm.guest.ProcessManager.ProcessInfo(
+            name=spec.programPath, pid=pid, owner=auth.username, cmdLine=spec.programPath + ' ' + spec.arguments,
+            startTime=datetime.datetime.now())
+        self.programs.append((vm._moId, pid, time.time() + duration, path, output, code))
+        return pid
+
+    def do_ListProcessesInGuest(self, mo, vm, auth, pids):
+        self._guest(vm, auth)
+        return _typed([info for pid, info in sorted(self.processes[vm._moId].items())
+                       if not pids or pid in pids])
+
+    def do_TerminateProcessInGuest(self, mo, vm, auth, pid):
+        self._guest(vm, auth)
+        self.programs = [item for item in self.programs if item[:2] != (vm._moId, pid)]
+        info = self.processes[vm._moId][pid]
+        info.endTime, info.exitCode = datetime.datetime.now(), 143
+
+    def do_CreateTemporaryFileInGuest(self, mo, vm, auth, prefix, suffix, directoryPath):
+        self._guest(vm, auth)
+        path = '/tmp/{}{}{}'.format(prefix, next(self.ids), suffix)
+        self.guest_files[vm._moId][path] = b''
+        return path
+
+    def do_DeleteFileInGuest(self, mo, vm, auth, filePath):
+        self._guest(vm, auth)
+        if self.guest_files[vm._moId].pop(filePath, None) is None:
+            raise vim.fault.FileNotFound(msg='{} not found'.format(filePath), file=filePath)
+
+    def transfer_url(self, vm, path):
+        """ url of a guest file on a local http server, started on first use """
+        if self.transfers is None:
+            stub = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    data = stub.guest_files[self.path.split('/')[2]].get(urllib.parse.unquote(self.path.split('/', 3)[3]))
+                    match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+                    if data is not None and match:
+                        data = data[int(match.group(1)):]
+                    self.send_response(404 if data is None else 206 if match else 200)
+                    self.end_headers()
+                    with stub.lock:
+                        stub.downloaded += len(data or b'')
+                    self.wfile.write(data or b'')
+
+                def do_PUT(self):
+                    vm, path = self.path.split('/')[2], urllib.parse.unquote(self.path.split('/', 3)[3])
+                    stub.guest_files[vm][path] = self.rfile.read(int(self.headers['Content-Length']))
+                    self.send_response(200)
+                    self.end_headers()
+
+                def log_message(self, *args):
+                    pass
+
+            self.transfers = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+            threading.Thread(target=self.transfers.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}/guestFile/{}/{}'.format(self.transfers.server_address[1], vm._moId,
+                                                              urllib.parse.quote(path, safe=''))
+
+    def do_InitiateFileTransferFromGuest(self, mo, vm, auth, guestFilePath):
+        self._guest(vm, auth)
+        data = self.guest_files[vm._moId].get(guestFilePath)
+        if data is None:
+            raise vim.fault.FileNotFound(msg='{} not found'.format(guestFilePath), file=guestFilePath)
+        return vim.vm.guest.FileManager.FileTransferInformation(
+            attributes=vim.vm.guest.FileManager.FileAttributes(), size=len(data),
+            url=self.transfer_url(vm, guestFilePath))
+
+    def do_InitiateFileTransferToGuest(self, mo, vm, auth, guestFilePath, fileAttributes, fileSize, overwrite):
+        self._guest(vm, auth)
+        if not overwrite and guestFilePath in self.guest_files[vm._moId]:
+            raise vim.fault.FileAlreadyExists(msg='{} exists'.format(guestFilePath), file=guestFilePath)
+        return self.transfer_url(vm, guestFilePath)
+
+    # performance manager
+
+    def do_QueryPerf(self, mo, querySpec):
+        metrics = []
+        for spec in querySpec:
+            n = int(spec.entity._moId.split('-')[-1])
+            series = []
+            for metric in spec.metricId:
+                instances = [metric.instance]
+                if metric.instance == '*':
+                    instances = ['uuid-' + ds._moId for ds in self.datastores]
+                for instance in instances:
+                    series.append(vim.PerformanceManager.IntSeries(
+                        id=vim.PerformanceManager.MetricId(counterId=metric.counterId, instance=instance),
+                        value=[(n * 7 + metric.counterId + k) % 50 for k in range(spec.maxSample or 12)]))
+            metrics.append(vim.PerformanceManager.EntityMetric(entity=spec.entity, value=series, sampleInfo=[]))
+        return metrics
+
+def connect(**kwargs):
+    """ (stub, content) of a new simulated vcenter, kwargs as SimulatorStub takes """
+    stub = SimulatorStub(**kwargs)
+    return stub, stub.si.RetrieveContent()
+
+SITE = {'VC_NAME': 'simulator', 'VC_HOST': 'simulator', 'VC_USER': 'simulator', 'VC_PASS': '',
+        'VC_PORT': 443, 'VC_DATACENTER': 'DC01', 'VC_DATASTORE': 'DS01'}
+
+def register(content, site=SITE):
+    """ make core treat content as connected to site (a .credentials entry) """
+    core._sites[content] = dict(site)
+    return core._sites[content]
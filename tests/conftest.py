@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core
+import simulator
+from vcenter_shell import VcenterShell
+
+
+@pytest.fixture
+def sim():
+    """ (stub, content) of a small simulated vcenter with a loaded inventory """
+    stub, content = simulator.connect(vms=20, tenants=2, depth=0, task_time=0.01)
+    simulator.register(content)
+    inv = core._inventories[content] = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES)
+    inv.follow()
+    yield stub, content
+    core._inventories.pop(content, None)
+    inv.close()
+    # keyed by MoRef, every simulator has the same moIds
+    core._snapshots.clear()
+    core._sites.pop(content, None)
+
+
+@pytest.fixture
+def shell(sim):
+    stub, content = sim
+    shell = VcenterShell()
+    shell.assume_yes = True
+    shell.sites = [(core.site_of(content), content)]
+    shell.use(*shell.sites[0])
+    return shell
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+import core
+
+
+def new_vm(name):
+    return {'name': name, 'template': 'centos7', 'tenant': 'tenant0', 'cluster': 'CL01',
+            'datastore': 'DS01', 'cpu': 4, 'ram': 8, 'hdd': None, 'epg': None}
+
+
+# every awaitable entry point that waits on vcenter tasks: (call, entities of its tasks)
+TASK_CALLS = {
+    'clone_async': (lambda content, **kw: core.clone_async(
+        content, 'new00', 'centos7', 'tenant0', 'CL01', 'DS01', **kw), ['centos7']),
+    'vm_settings_async': (lambda content, **kw: core.vm_settings_async(
+        content, 'vm00001', 4, 8, None, **kw), ['vm00001']),
+    'add_disk_async': (lambda content, **kw: core.add_disk_async(
+        content, 'vm00001', 10, **kw), ['vm00001']),
+    'add_disks_async': (lambda content, **kw: core.add_disks_async(
+        content, 'vm00001', [{'size': 10}, {'size': 20}], **kw), ['vm00001']),
+    'provision_async': (lambda content, **kw: core.provision_async(
+        content, [new_vm('new00'), new_vm('new01')], **kw), ['centos7', 'centos7']),
+    'power_vms_async': (lambda content, **kw: core.power_vms_async(
+        content, core.select_vms(content, ['vm0000[1-3]']), 'reset', **kw),
+        ['vm00001', 'vm00002', 'vm00003']),
+    'run_async(apply_plan)': (lambda content, **kw: core.run_async(
+        content, core.apply_plan, core.reconcile_plan(content, [new_vm('vm00001'), new_vm('new00')])[0], **kw),
+        ['centos7', 'vm00001']),
+}
+
+
+@pytest.mark.parametrize('name', sorted(TASK_CALLS))
+def test_task_progress(sim, name):
+    stub, content = sim
+    call, expected = TASK_CALLS[name]
+    events = []
+    asyncio.run(call(content, task_progress=lambda *event: events.append(event)))
+    assert sorted(vm for vm, description, percent in events if percent == 100) == expected
@@ -0,0 +1,39 @@
+import builtins
+import json
+
+import pytest
+
+import vcenter_shell
+
+
+@pytest.fixture
+def batch(sim, monkeypatch):
+    """ run_batch over the simulator, input() must not be called """
+    stub, content = sim
+
+    def connect(shell, line):
+        shell.sites = [(vcenter_shell.site_of(content), content)]
+        shell.use(*shell.sites[0])
+
+    def refuse(prompt=''):
+        raise AssertionError('batch mode read stdin')
+    monkeypatch.setattr(vcenter_shell.VcenterShell, 'do_connect_to_api', connect)
+    monkeypatch.setattr(builtins, 'input', refuse)
+    return stub
+
+
+@pytest.mark.parametrize('output', ['ndjson', 'text'])
+def test_confirmation_fails_without_yes(batch, capsys, output):
+    failed = vcenter_shell.run_batch(['power off vm00000', 'list_tenants'], output=output)
+    out = capsys.readouterr().out
+    assert failed == 1
+    assert 'tenant0' in out
+    assert batch.calls['PowerOffVM_Task'] == 0
+
+
+def test_yes_confirms(batch, capsys):
+    failed = vcenter_shell.run_batch(['power off vm00000'], output='ndjson', assume_yes=True)
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert failed == 0
+    assert batch.calls['PowerOffVM_Task'] == 1
+    assert records[-1]['outcome'] == 'poweredOff'
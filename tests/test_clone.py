@@ -0,0 +1,56 @@
+import pytest
+from pyVmomi import vim
+
+import core
+
+
+def vm(content, name):
+    return core.get_obj(content, [vim.VirtualMachine], name)
+
+
+def test_linked_clones_share_the_template_snapshot(sim):
+    stub, content = sim
+    for name in ('linked0', 'linked1'):
+        core.clone(content, name, 'centos7', 'tenant0', 'CL01', 'DS01', cpu=4, mode='linked',
+                   convert_template=True)
+    assert stub.calls['CreateSnapshot_Task'] == 1
+    centos = next(obj for obj in stub._vms() if stub.p(obj)['name'] == 'centos7')
+    trees = stub.p(centos)['snapshot'].rootSnapshotList
+    assert [tree.name for tree in trees] == [core.LINKED_SNAPSHOT]
+    assert stub.p(centos)['config'].template
+    assert stub.p(vm(content, 'linked1'))['config'].hardware.numCPU == 4
+
+
+def test_linked_clone_finds_an_existing_snapshot(sim):
+    stub, content = sim
+    core.clone(content, 'linked0', 'centos7', 'tenant0', 'CL01', 'DS01', mode='linked',
+               convert_template=True)
+    # another process, nothing cached
+    core._snapshots.clear()
+    core.clone(content, 'linked1', 'centos7', 'tenant0', 'CL01', 'DS01', mode='linked')
+    assert stub.calls['CreateSnapshot_Task'] == 1
+
+
+def test_linked_clone_keeps_the_disk_size(sim):
+    stub, content = sim
+    with pytest.raises(Exception, match="Disk size can't be changed by a linked clone"):
+        core.clone(content, 'linked0', 'centos7', 'tenant0', 'CL01', 'DS01', hdd=40, mode='linked')
+
+
+def test_instant_clone_needs_a_powered_on_source(sim):
+    stub, content = sim
+    # even vms are powered on
+    with pytest.raises(Exception, match='needs a powered on source vm, vm00001 is not'):
+        core.clone(content, 'fork0', 'vm00001', 'tenant0', 'CL01', 'DS01', mode='instant')
+    assert stub.calls['InstantClone_Task'] == 0
+    fork = core.clone(content, 'fork1', 'vm00000', 'tenant0', 'CL01', 'DS01', cpu=4, ram=8, mode='instant')
+    assert stub.calls['InstantClone_Task'] == 1
+    hardware = stub.p(fork)['config'].hardware
+    assert (hardware.numCPU, hardware.memoryMB) == (4, 8192)
+
+
+def test_instant_clone_needs_vsphere_67(sim):
+    stub, content = sim
+    content.about.apiVersion = '6.5'
+    with pytest.raises(Exception, match='needs vSphere 6.7'):
+        core.clone(content, 'fork0', 'vm00000', 'tenant0', 'CL01', 'DS01', mode='instant')
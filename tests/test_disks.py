@@ -0,0 +1,80 @@
+import pytest
+from pyVmomi import vim
+
+import core
+
+
+def hardware(buses):
+    """ VM_HARDWARE_PROPERTIES of a vm with pvscsi controllers {bus: used units} """
+    devices = []
+    for bus, units in buses.items():
+        devices.append(vim.vm.device.ParaVirtualSCSIController(key=1000 + bus, busNumber=bus))
+        devices.extend(vim.vm.device.VirtualDisk(key=2000 + bus * 16 + unit, controllerKey=1000 + bus,
+                                                 unitNumber=unit, capacityInKB=1024 * 1024)
+                       for unit in units)
+    return {'config.hardware.device': devices}
+
+
+FULL = core.SCSI_UNITS
+
+
+@pytest.mark.parametrize('buses, count, spread, layout', [
+    # next free unit, 7 is the controller's own
+    ({0: [0]}, 1, 1, ['scsi0:1']),
+    ({0: range(7)}, 2, 1, ['scsi0:8', 'scsi0:9']),
+    # a full controller gets a neighbour
+    ({0: FULL}, 2, 1, ['scsi1 new', 'scsi1:0', 'scsi1:1']),
+    ({0: FULL[:-1]}, 2, 1, ['scsi0:15', 'scsi1 new', 'scsi1:0']),
+    # no controller at all
+    ({}, 1, 1, ['scsi0 new', 'scsi0:0']),
+    # spread adds controllers up front, disks go to the least used one
+    ({0: [0]}, 3, 3, ['scsi1 new', 'scsi2 new', 'scsi1:0', 'scsi2:0', 'scsi0:1']),
+    ({0: [0], 2: [0, 1]}, 2, 4, ['scsi1 new', 'scsi3 new', 'scsi1:0', 'scsi3:0']),
+    ({0: [0]}, 0, 9, ['scsi1 new', 'scsi2 new', 'scsi3 new']),
+    # the fourth bus is the last
+    ({0: FULL, 1: FULL, 2: FULL}, 1, 1, ['scsi3 new', 'scsi3:0']),
+])
+def test_layout(buses, count, spread, layout):
+    changes, placed = core.disk_changes(hardware(buses), [{'size': 10}] * count, spread=spread)
+    assert [device + ' new' if what.endswith('controller') else device
+            for device, what in placed] == layout
+    assert len(changes) == len(placed)
+
+
+def test_bus_limit():
+    with pytest.raises(Exception, match='No free scsi unit for 2 more disks'):
+        core.disk_changes(hardware({0: FULL, 1: FULL, 2: FULL, 3: FULL[:-1]}), [{'size': 10}] * 3)
+
+
+@pytest.mark.parametrize('kind, thin, eager', [
+    (None, True, False),
+    ('thin', True, False),
+    ('thick', False, False),
+    ('eager', False, True),
+])
+def test_backing(kind, thin, eager):
+    changes, placed = core.disk_changes(hardware({0: [0]}), [{'size': 20, 'type': kind, 'datastore': 'DS02'}])
+    (change,) = changes
+    assert change.operation == 'add' and change.fileOperation == 'create'
+    backing = change.device.backing
+    assert (backing.thinProvisioned, backing.eagerlyScrub) == (thin, eager)
+    assert backing.fileName == '[DS02]'
+    assert change.device.capacityInKB == 20 * 1024 * 1024
+    assert change.device.controllerKey == 1000
+    assert placed == [('scsi0:1', '20GB {}'.format(kind or 'thin'))]
+
+
+def test_controller_type():
+    changes, placed = core.disk_changes(hardware({}), [{'size': 10}], controller='lsilogic')
+    assert isinstance(changes[0].device, vim.vm.device.VirtualLsiLogicController)
+    assert changes[1].device.controllerKey == changes[0].device.key
+    assert placed[0] == ('scsi0', 'new lsilogic controller')
+
+
+@pytest.mark.parametrize('disks, controller, error', [
+    ([{'size': 10, 'type': 'sparse'}], 'pvscsi', 'Unknown disk type sparse'),
+    ([{'size': 10}], 'ide', 'Unknown controller ide'),
+])
+def test_errors(disks, controller, error):
+    with pytest.raises(Exception, match=error):
+        core.disk_changes(hardware({0: [0]}), disks, controller)
@@ -0,0 +1,91 @@
+from pyVmomi import vim
+
+import core
+
+
+def other_datacenter(stub):
+    """ DC00 ahead of DC01, with Tenants/tenantX/vm00001 and Templates/other7 of its own """
+    with stub.lock:
+        dc = stub.new(vim.Datacenter, 'datacenter', name='DC00')
+        vm_folder = stub.new(vim.Folder, 'group-v', name='vm', childEntity=[], parent=dc)
+        stub.p(dc)['vmFolder'] = vm_folder
+        stub.p(stub.root)['childEntity'] = [dc] + list(stub.p(stub.root)['childEntity'])
+        stub.p(dc)['parent'] = stub.root
+        stub.gen[stub.root._moId] += 1
+        for name, child in (('Tenants', stub.new(vim.Folder, 'group-v', name='tenantX', childEntity=[])),
+                            ('Templates', stub.make_vm('other7', template=True))):
+            folder = stub.new(vim.Folder, 'group-v', name=name, childEntity=[])
+            stub.add_child(vm_folder, folder)
+            stub.add_child(folder, child)
+            if name == 'Tenants':
+                stub.add_child(child, stub.make_vm('vm00001'))
+
+
+def test_folders_of_the_selected_datacenter(sim):
+    stub, content = sim
+    other_datacenter(stub)
+    core._inventories[content] = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES)
+    assert core.list_tenants(content) == ['tenant0', 'tenant1']
+    assert core.list_tenants(content, datacenter='DC00') == ['tenantX']
+    assert sorted(core.list_templates(content)) == ['centos7', 'ubuntu18']
+    assert sorted(core.list_templates(content, datacenter='DC00')) == ['other7']
+
+
+def test_same_name_vms_in_both_datacenters(sim, shell, capsys):
+    stub, content = sim
+    other_datacenter(stub)
+    core._inventories[content] = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES)
+    found = core.find_vms(content, 'vm00001')
+    assert sorted(name for name, moid in found) == ['vm00001', 'vm00001']
+    for datacenter in ('DC00', 'DC01'):
+        (key,) = core.find_vms(content, 'vm00001', datacenter=datacenter)
+        assert core.datacenter_of(content, vim.VirtualMachine(key[1], stub)) == datacenter
+        vms = core.select_vms(content, ['vm00001'], datacenter=datacenter)
+        assert core.datacenter_of(content, vms['vm00001']['obj']) == datacenter
+    # a second site for DC00 on the same vcenter
+    site = dict(shell.site, VC_NAME='other', VC_DATACENTER='DC00')
+    shell.sites = shell.sites + [(site, content)]
+    capsys.readouterr()
+    shell.onecmd('find_vm vm00001')
+    assert capsys.readouterr().out.count('-- vm00001 ') == 2
+
+
+def use_other_datacenter(stub, content, shell):
+    other_datacenter(stub)
+    core._inventories[content] = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES)
+    site = dict(shell.site, VC_NAME='other', VC_DATACENTER='DC00')
+    shell.sites = shell.sites + [(site, content)]
+    shell.use(site, content)
+
+
+def test_power_in_the_selected_datacenter(sim, shell, capsys):
+    stub, content = sim
+    use_other_datacenter(stub, content, shell)
+    shell.onecmd('power on --tenant tenantX')
+    out = capsys.readouterr().out
+    assert 'ERR' not in out and '[vm00001] poweredOn' in out
+
+
+def test_run_in_the_selected_datacenter(sim, shell, capsys):
+    stub, content = sim
+    use_other_datacenter(stub, content, shell)
+    shell.onecmd('power on --tenant tenantX')
+    shell.guest_passwords['root'] = 'secret'
+    capsys.readouterr()
+    shell.onecmd('run --tenant tenantX -- echo hi')
+    out = capsys.readouterr().out
+    assert 'ERR' not in out and '[vm00001] hi' in out and '[vm00001] exit 0' in out
+
+
+def test_power_on_without_a_known_datacenter(sim, monkeypatch):
+    stub, content = sim
+    other_datacenter(stub)
+    core._inventories[content] = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES)
+    vms = core.select_vms(content, ['vm0000[1-2]'], datacenter='DC01')
+    monkeypatch.setattr(core, 'datacenter_of', lambda content, obj: None)
+    views = stub.calls['CreateContainerView']
+    off = [name for name, row in vms.items() if row['runtime.powerState'] == 'poweredOff']
+    results = core.power_vms(content, vms, 'on')
+    assert off and {name: results[name] for name in off} == dict.fromkeys(off, 'poweredOn')
+    assert stub.calls['CreateContainerView'] == views
+    assert stub.calls['PowerOnMultiVM_Task'] == 0
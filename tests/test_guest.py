@@ -0,0 +1,30 @@
+from pyVmomi import vim
+
+import core
+
+
+def test_run_fetches_output_once(sim):
+    stub, content = sim
+    vm = core.get_obj(content, [vim.VirtualMachine], 'vm00001')
+    with stub.lock:
+        stub.power(vm, 'poweredOn')()
+    session = core.guest_session(content, vm, 'root', 'secret')
+    lines = []
+    assert session.run('echo done; sleep 0.1', lines.append, poll=0.005) == 0
+    assert lines == ['$ echo done; sleep 0.1', 'done; sleep 0.1']
+    assert stub.downloaded == len('\n'.join(lines)) + 1
+
+
+def test_run_keeps_same_name_vms_apart(sim):
+    stub, content = sim
+    vms = [core.get_obj(content, [vim.VirtualMachine], name) for name in ('vm00001', 'vm00003')]
+    with stub.lock:
+        stub.set(vms[1], name='vm00001')
+        for vm in vms:
+            stub.power(vm, 'poweredOn')()
+    rows = list(core.query(content, [vim.VirtualMachine], core.POWER_PROPERTIES, objs=vms))
+    lines = []
+    results = core.guest_run(content, rows, 'echo hi', 'root', 'secret',
+                             output=lambda name, line: lines.append((name, line)))
+    assert results == {vm._moId: 0 for vm in vms}
+    assert lines.count(('vm00001', 'hi')) == 2
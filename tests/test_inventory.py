@@ -0,0 +1,177 @@
+import time
+
+import pytest
+from pyVmomi import vim
+
+import core
+
+
+def recreate(stub, name):
+    """ delete vm name and create another one of that name, behind the shell's back """
+    with stub.lock:
+        old = next(vm for vm in stub._vms() if stub.p(vm)['name'] == name)
+        folder = stub.p(old)['parent']
+        stub.remove_child(old)
+        new = stub.make_vm(name, powered=True)
+        stub.add_child(folder, new)
+    return old, new
+
+
+def eventually(check, timeout=5):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_get_obj_follows_recreated_vm(sim):
+    stub, content = sim
+    assert core.get_obj(content, [vim.VirtualMachine], 'vm00003') is not None
+    old, new = recreate(stub, 'vm00003')
+    # the follower brings the new vm in, no lookup has to ask
+    eventually(lambda: core.get_obj(content, [vim.VirtualMachine], 'vm00003')._moId == new._moId)
+    assert new._moId != old._moId
+    assert core.vm_settings(content, 'vm00003', 4, None, None) == [('cpu', 2, 4)]
+
+
+def test_lookups_are_local(sim):
+    stub, content = sim
+    core.get_obj(content, [vim.VirtualMachine], 'vm00001')
+    calls = sum(stub.calls.values())
+    for i in range(20):
+        assert core.get_obj(content, [vim.VirtualMachine], 'vm{:05}'.format(i)) is not None
+    assert sum(stub.calls.values()) == calls
+
+
+def test_missing_name_syncs(sim):
+    stub, content = sim
+    assert core.get_obj(content, [vim.VirtualMachine], 'fresh') is None
+    with stub.lock:
+        vm = stub.make_vm('fresh')
+        stub.add_child(stub.p(core.get_obj(content, [vim.VirtualMachine], 'vm00001'))['parent'], vm)
+    # in right away, whether or not the follower got to it
+    assert core.get_obj(content, [vim.VirtualMachine], 'fresh')._moId == vm._moId
+
+
+def test_same_name_sibling_stays_indexed():
+    inv = core.Inventory(None, fill=False)
+    first, second = vim.VirtualMachine('vm-1'), vim.VirtualMachine('vm-2')
+    inv.add(first, {'name': 'twin'})
+    inv.add(second, {'name': 'twin'})
+    inv.forget(first)
+    assert inv.lookup([vim.VirtualMachine], 'twin') is second
+
+
+def test_add_replaces_properties():
+    inv = core.Inventory(None, path_set=['name', 'parent'], fill=False)
+    vm = vim.VirtualMachine('vm-1')
+    inv.add(vm, {'name': 'a', 'parent': 'folder'})
+    inv.add(vm, {'name': 'b'})
+    assert inv.objects[vm] == {'name': 'b'}
+    assert inv.lookup([vim.VirtualMachine], 'a') is None
+    inv.add(vm, 'c')
+    assert inv.objects[vm] == {'name': 'c'}
+
+
+def test_reads_follow_changes(sim, shell, capsys):
+    stub, content = sim
+    shell.onecmd('vm_info vm00002')
+    assert '\t2\t4096\t' in capsys.readouterr().out
+    vm = core.get_obj(content, [vim.VirtualMachine], 'vm00002')
+    with stub.lock:
+        stub.reconfig(vm, vim.vm.ConfigSpec(numCPUs=6, memoryMB=16384))
+        stub.power(vm, 'poweredOff')()
+    # listings and searches that don't look a name up first
+    listed = core.list_vms(content, 'tenant0')['vm00002']
+    assert listed[1:3] == ['6', '16384'] and listed[-1] == 'poweredOff'
+    info = core.find_vms(content, 'vm0000[2]')[('vm00002', vm._moId)]
+    assert info[1:3] == ['6', '16384'] and info[-1] == 'poweredOff'
+    shell.onecmd('set vm00002 4 8 default')
+    capsys.readouterr()
+    shell.onecmd('vm_info vm00002')
+    out = capsys.readouterr().out
+    assert '\t4\t8192\t' in out and 'poweredOff' in out
+
+
+def test_reads_follow_device_changes(shell, sim):
+    stub, content = sim
+    vm = core.get_obj(content, [vim.VirtualMachine], 'vm00002')
+    before = core.vm_info(content, vm)
+    core.add_disks(content, 'vm00002', [{'size': 10}])
+    with stub.lock:
+        stub.reconfig(vm, vim.vm.ConfigSpec(deviceChange=[vim.vm.device.VirtualDeviceSpec(
+            operation='remove', device=next(device for device in stub.p(vm)['config'].hardware.device
+                                            if isinstance(device, vim.vm.device.VirtualEthernetCard)))]))
+    after = core.vm_info(content, vm)
+    assert after[3] == before[3] + ',{}'.format(10 * 1024 * 1024)
+    assert before[6] and not after[6]
+
+
+def test_vm_info_without_content(sim):
+    stub, content = sim
+    vm = core.get_obj(content, [vim.VirtualMachine], 'vm00002')
+    assert core.vm_info(vm) == core.vm_info(content, vm)
+
+
+def test_snapshot_with_dead_collector_serves_at_once(sim, tmp_path):
+    stub, content = sim
+    filename = str(tmp_path / 'inventory.db')
+    core._inventories[content].save('vc', filename)
+    inv = core.Inventory.load(content, 'vc', core.INVENTORY_PROPERTIES, filename)
+    with stub.lock:
+        stub.set(core.get_obj(content, [vim.VirtualMachine], 'vm00004'), name='renamed')
+        # the session that owned it is gone
+        stub.do_DestroyPropertyCollector(inv.collector)
+    stub.latency = 0.05
+    core._inventories[content] = inv
+    try:
+        start = time.time()
+        rows = [row['name'] for row in inv.select([vim.VirtualMachine], ['name'])]
+        # one failed WaitForUpdatesEx, not the full retrieve behind the rename
+        assert time.time() - start < 0.2
+        assert 'vm00004' in rows and 'renamed' not in rows
+        # the follower reloads behind it
+        assert inv.loaded.wait(5)
+        assert 'renamed' in [row['name'] for row in inv.select([vim.VirtualMachine], ['name'])]
+    finally:
+        inv.close()
+
+
+def test_find_vm_keyed_by_name(sim):
+    stub, content = sim
+    found = core.find_vm(content, 'vm0000[23]')
+    assert sorted(found) == ['vm00002', 'vm00003']
+    assert found['vm00002'] == core.find_vms(content, 'vm00002')[
+        ('vm00002', core.get_obj(content, [vim.VirtualMachine], 'vm00002')._moId)]
+    assert core.find_vm(content, 'nope') is None
+
+
+def test_find_vm_by_uuid_with_or_without_dashes(sim):
+    stub, content = sim
+    vm = core.get_obj(content, [vim.VirtualMachine], 'vm00003')
+    uuid = stub.p(vm)['summary'].config.uuid
+    for text in (uuid, uuid.upper(), uuid.replace('-', ''), 'uuid:' + uuid.replace('-', '').upper(),
+                 stub.p(vm)['summary'].config.instanceUuid.replace('-', '')):
+        assert list(core.find_vms(content, text)) == [('vm00003', vm._moId)]
+    assert core.search_terms(uuid.replace('-', ''))[1] == uuid
+
+
+def test_lookups_survive_a_failed_first_fill(sim, monkeypatch):
+    stub, content = sim
+
+    def expired(inv):
+        raise vim.fault.NotAuthenticated()
+    monkeypatch.setattr(core.Inventory, '_attach', expired)
+    inv = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES, fill=False)
+    core._inventories[content] = inv
+    inv.follow()
+    try:
+        start = time.time()
+        # straight from vcenter, not stuck on data that never comes
+        assert core.get_obj(content, [vim.VirtualMachine], 'vm00001') is not None
+        assert time.time() - start < 1
+        assert isinstance(inv.error, vim.fault.NotAuthenticated)
+        with pytest.raises(vim.fault.NotAuthenticated):
+            list(inv.select([vim.VirtualMachine], ['name']))
+    finally:
+        inv.close()
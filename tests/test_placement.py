@@ -0,0 +1,138 @@
+import pytest
+from pyVmomi import vim
+
+import core
+
+GB = core.GB
+TB = 1024 * GB
+
+# simulator hosts have 256GB, esx00 and esx10 use 10GB, esx01 and esx11 50GB;
+# DS01, DS02 and DS03 have 1, 2 and 3TB free, POD01 holds DS01 and DS02
+
+
+def names(placement, placed):
+    return tuple(placement.name(obj) for obj in placed)
+
+
+def host(stub, name):
+    return next(obj for obj in stub.mos.values()
+                if isinstance(obj, vim.HostSystem) and stub.p(obj)['name'] == name)
+
+
+def datastore(stub, name):
+    return next(obj for obj in stub.mos.values()
+                if isinstance(obj, vim.Datastore) and stub.p(obj)['name'] == name)
+
+
+@pytest.mark.parametrize('cluster, datastore, expected', [
+    (None, None, ('CL01', 'esx00', 'DS03')),
+    ('CL02', None, ('CL02', 'esx10', 'DS03')),
+    (None, 'DS01', ('CL01', 'esx00', 'DS01')),
+    (None, 'POD01', ('CL01', 'esx00', 'DS02')),
+])
+def test_place(sim, cluster, datastore, expected):
+    stub, content = sim
+    placement = core.Placement(content)
+    assert names(placement, placement.place(4 * GB, 100 * GB, cluster, datastore)) == expected
+
+
+def test_place_books_capacity(sim):
+    stub, content = sim
+    placement = core.Placement(content)
+    placed = [names(placement, placement.place(4 * GB, 1200 * GB)) for _ in range(3)]
+    # hosts and datastores take turns as their free memory and space drop
+    assert [p[1] for p in placed] == ['esx00', 'esx10', 'esx00']
+    assert [p[2] for p in placed] == ['DS03', 'DS02', 'DS03']
+    # 672, 848 and 1024GB are left
+    with pytest.raises(Exception, match='1200GB free space'):
+        placement.place(4 * GB, 1200 * GB)
+    assert names(placement, placement.place(4 * GB, 1000 * GB))[2] == 'DS01'
+
+
+def test_place_skips_hosts_in_maintenance(sim):
+    stub, content = sim
+    with stub.lock:
+        for name in ('esx00', 'esx10'):
+            stub.p(host(stub, name))['runtime'].inMaintenanceMode = True
+    placement = core.Placement(content)
+    assert names(placement, placement.place(4 * GB, 100 * GB))[1] in ('esx01', 'esx11')
+
+
+@pytest.mark.parametrize('memory, space, cluster, datastore, error', [
+    (300 * GB, GB, None, None, 'No host with 300GB free memory'),
+    (GB, 4 * TB, None, None, 'datastore with 4096GB free space in any cluster'),
+    (GB, 2.5 * TB, 'CL01', 'POD01', 'in CL01'),
+    (GB, GB, 'CL09', None, 'No cluster CL09 found'),
+    (GB, GB, None, 'DS09', 'No datastore DS09 found'),
+])
+def test_place_fails(sim, memory, space, cluster, datastore, error):
+    stub, content = sim
+    with pytest.raises(Exception, match=error):
+        core.Placement(content).place(memory, space, cluster, datastore)
+
+
+def test_place_takes_named_targets_short_of_room(sim):
+    stub, content = sim
+    placement = core.Placement(content)
+    # the best host and datastore of what's named, not an error
+    placed = placement.place(300 * GB, 4 * TB, 'CL02', 'DS01')
+    assert names(placement, placed) == ('CL02', 'esx10', 'DS01')
+    # an automatic choice still has to fit
+    with pytest.raises(Exception, match='No host with 300GB free memory'):
+        placement.place(300 * GB, GB, None, 'DS01')
+
+
+def clone_spec(name, ram, template='centos7', cluster='auto', datastore='auto', power=True):
+    return {'name': name, 'template': template, 'tenant': 'tenant0', 'cluster': cluster,
+            'datastore': datastore, 'cpu': 2, 'ram': ram, 'hdd': None, 'epg': None, 'power': power}
+
+
+def test_plan_placement(sim):
+    stub, content = sim
+    vms = [clone_spec('small', 8), clone_spec('big', 64), clone_spec('pod', 8, datastore='POD01'),
+           clone_spec('huge', 512), clone_spec('lost', 8, template='nope')]
+    failed = core.plan_placement(content, vms)
+    assert sorted(failed) == ['huge', 'lost']
+    assert 'No template nope found' in str(failed['lost'])
+    placed = {vm['name']: (vm['cluster'], vm['host'], vm['datastore']) for vm in vms
+              if vm['name'] not in failed}
+    # biggest first: big takes esx00, the 8GB vms then go where most memory is left
+    assert placed == {'big': ('CL01', 'esx00', 'DS03'),
+                      'small': ('CL02', 'esx10', 'DS03'),
+                      'pod': ('CL02', 'esx10', 'DS02')}
+
+
+def test_plan_placement_takes_templates_of_each_datacenter(sim):
+    from test_folders import other_datacenter
+    stub, content = sim
+    # DC00 has template other7 and no hosts
+    other_datacenter(stub)
+    core._inventories[content] = core.Inventory(content, path_set=core.INVENTORY_PROPERTIES)
+    vms = [clone_spec('here', 8, template='other7'), dict(clone_spec('there', 8, template='other7'),
+                                                           datacenter='DC00'),
+           dict(clone_spec('nope', 8), datacenter='DC00')]
+    failed = core.plan_placement(content, vms)
+    assert 'No template other7 found' in str(failed['here'])
+    assert 'No host with 8GB free memory' in str(failed['there'])
+    assert 'No template centos7 found' in str(failed['nope'])
+
+
+def test_plan_placement_counts_memory_of_powered_on_vms(sim):
+    stub, content = sim
+    vms = [clone_spec('off', 512, power=False), clone_spec('on', 512)]
+    failed = core.plan_placement(content, vms)
+    assert list(failed) == ['on']
+    assert vms[0]['host'] == 'esx00'
+
+
+def test_clone_to_a_named_datastore_short_of_space(sim):
+    stub, content = sim
+    with stub.lock:
+        stub.p(datastore(stub, 'DS01'))['summary'].freeSpace = GB
+        for name in ('esx00', 'esx01', 'esx10', 'esx11'):
+            stub.p(host(stub, name))['summary'].quickStats.overallMemoryUsage = 256 * 1024
+    vm = core.clone(content, 'new00', 'centos7', 'tenant0', 'auto', 'DS01')
+    assert stub.p(vm)['datastore'] == [datastore(stub, 'DS01')]
+    results = core.provision(content, [clone_spec('new01', 8, cluster='CL01', datastore='DS01',
+                                                  power=False)])
+    assert results == {'new01': None}
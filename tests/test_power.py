@@ -0,0 +1,13 @@
+import core
+
+
+def test_remove_waits_once_per_task(sim):
+    stub, content = sim
+    vms = core.select_vms(content, ['vm0000[1-3]'])
+    before = stub.calls['CreateFilter']
+    results = core.power_vms(content, vms, 'remove')
+    assert results == dict.fromkeys(vms, 'removed')
+    # one task filter per Destroy_Task and per power off of a running vm
+    running = sum(row['runtime.powerState'] == 'poweredOn' for row in vms.values())
+    assert stub.calls['CreateFilter'] - before == 3 + running
+    assert core.select_vms(content, ['vm0000[1-3]']) == {}
@@ -0,0 +1,24 @@
+def test_profile_counts_calls_by_command_and_method(shell, sim, capsys):
+    stub, content = sim
+    shell.onecmd('profile on')
+    shell.onecmd('set vm00002 4 8 default')
+    shell.onecmd('find_vm 10.0.0.5')
+    shell.onecmd('profile show')
+    profiler = shell.profiler
+    # profile commands aren't profiled themselves
+    assert sorted(profiler.commands) == ['find_vm 10.0.0.5', 'set vm00002 4 8 default']
+    set_calls = profiler.commands['set vm00002 4 8 default'].calls
+    assert (set_calls['RetrievePropertiesEx'], set_calls['ReconfigVM_Task']) == (1, 1)
+    assert profiler.commands['find_vm 10.0.0.5'].calls['FindAllByIp'] == 1
+    assert 'ReconfigVM_Task' not in profiler.commands['find_vm 10.0.0.5'].calls
+    assert profiler.total.calls['ReconfigVM_Task'] == profiler.total.calls['FindAllByIp'] == 1
+    assert profiler.commands['set vm00002 4 8 default'].task_wait > 0
+    text = profiler.openmetrics()
+    assert 'vcenter_calls_total{method="ReconfigVM_Task"} 1\n' in text
+    assert 'vcenter_call_seconds_count{method="FindAllByIp"} 1\n' in text
+    assert 'vcenter_call_seconds_bucket{method="FindAllByIp",le="+Inf"} 1\n' in text
+    assert text.endswith('# EOF\n')
+    shell.onecmd('profile off')
+    assert shell.profiler is None
+    shell.onecmd('list_clusters')
+    assert profiler.total.calls['ReconfigVM_Task'] == 1 and len(profiler.commands) == 2
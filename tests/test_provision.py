@@ -0,0 +1,43 @@
+import core
+
+
+def spec(name, cluster, datastore):
+    return {'name': name, 'template': 'centos7', 'tenant': 'tenant0', 'cluster': cluster,
+            'datastore': datastore, 'cpu': 2, 'ram': 4, 'hdd': None, 'epg': None}
+
+
+def test_busy_cluster_leaves_workers_to_idle_ones(sim):
+    stub, content = sim
+    stub.task_time = 0.1
+    # skewed: most vms go to one cluster and datastore
+    vms = [spec('busy{}'.format(i), 'CL01', 'DS01') for i in range(4)]
+    vms += [spec('idle{}'.format(i), 'CL02', 'DS03') for i in range(2)]
+    events = []
+    results = core.provision(content, vms, workers=2, cluster_tasks=1, datastore_tasks=1,
+                             progress=lambda name, stage, err: events.append((name, stage)))
+    assert results == {vm['name']: None for vm in vms}
+    started = [name for name, stage in events if stage == 'cloning']
+    # the idle cluster's vms don't queue up behind the busy ones
+    assert set(started[:2]) == {'busy0', 'idle0'}
+    assert started.index('idle1') < started.index('busy2')
+
+
+def test_limits_hold(sim):
+    stub, content = sim
+    stub.task_time = 0.05
+    vms = [spec('vm-new{}'.format(i), 'CL01', 'DS0{}'.format(1 + i % 2)) for i in range(6)]
+    running, peak = set(), {'CL01': 0, 'DS01': 0, 'DS02': 0}
+
+    def progress(name, stage, err):
+        if stage == 'cloning':
+            running.add(name)
+        elif stage in ('done', 'failed'):
+            running.discard(name)
+        vm = next(vm for vm in vms if vm['name'] == name)
+        for key in (vm['cluster'], vm['datastore']):
+            peak[key] = max(peak[key], len([other for other in vms if other['name'] in running and
+                                            key in (other['cluster'], other['datastore'])]))
+    results = core.provision(content, vms, workers=8, cluster_tasks=3, datastore_tasks=2,
+                             progress=progress)
+    assert all(err is None for err in results.values())
+    assert peak == {'CL01': 3, 'DS01': 2, 'DS02': 2}
@@ -0,0 +1,103 @@
+from pyVmomi import vim
+
+import core
+
+# tenant0 holds vm00000..vm00009 and tenant1 vm00010..vm00019, 2 cpu, 4GB ram, 20GB disk, EPG0
+
+
+def spec(name, tenant='tenant0', cpu=2, ram=4, hdd=20, epg='EPG0'):
+    return {'name': name, 'template': 'centos7', 'tenant': tenant, 'cluster': 'CL01',
+            'datastore': 'DS01', 'cpu': cpu, 'ram': ram, 'hdd': hdd, 'epg': epg}
+
+
+def tenant0(changes={}):
+    """ specs of tenant0 as it is, but for {index: spec changes} """
+    return [spec('vm0000{}'.format(i), **changes.get(i, {})) for i in range(10)]
+
+
+def test_unchanged_is_a_no_op(sim):
+    stub, content = sim
+    assert core.reconcile_plan(content, tenant0(), prune=True) == ([], {})
+    assert core.apply_plan(content, []) == {}
+    assert stub.calls['ReconfigVM_Task'] == stub.calls['CloneVM_Task'] == 0
+
+
+def test_second_run_is_a_no_op(sim):
+    stub, content = sim
+    vms = tenant0({1: {'cpu': 4}, 2: {'epg': 'EPG1'}}) + [spec('new00')]
+    plan, failed = core.reconcile_plan(content, vms)
+    assert not failed
+    assert sorted((entry['action'], entry['name']) for entry in plan) == [
+        ('create', 'new00'), ('network', 'vm00002'), ('resize', 'vm00001')]
+    assert core.apply_plan(content, plan) == dict.fromkeys(['new00', 'vm00001', 'vm00002'])
+    calls = dict(stub.calls)
+    assert (calls['ReconfigVM_Task'], calls['CloneVM_Task']) == (2, 1)
+    assert core.reconcile_plan(content, vms) == ([], {})
+    assert stub.calls['ReconfigVM_Task'] == calls['ReconfigVM_Task']
+    assert stub.calls['CloneVM_Task'] == calls['CloneVM_Task']
+
+
+def test_resize_and_network_in_one_reconfigure(sim):
+    stub, content = sim
+    plan, failed = core.reconcile_plan(content, tenant0({3: {'cpu': 4, 'ram': 8, 'epg': 'EPG1'}}))
+    assert [(entry['action'], entry['changes']) for entry in plan] == [
+        ('resize', [('cpu', 2, 4), ('ram', 4096, 8192)]), ('network', [('epg', 'EPG0', 'EPG1')])]
+    assert plan[0]['spec'] is plan[1]['spec']
+    assert core.apply_plan(content, plan) == {'vm00003': None}
+    assert stub.calls['ReconfigVM_Task'] == 1
+    row = core.list_vms(content, 'tenant0')['vm00003']
+    assert row[1:3] == ['4', '8192'] and row[7] == 'EPG1'
+
+
+def test_shrinking_disk_fails(sim):
+    stub, content = sim
+    plan, failed = core.reconcile_plan(content, tenant0({4: {'hdd': 10}}))
+    assert plan == [] and "can't be shrunk" in str(failed['vm00004'])
+
+
+def test_prune_deletes_only_unnamed_vms_of_the_tenants(sim):
+    stub, content = sim
+    vms = tenant0()[:7]
+    plan, failed = core.reconcile_plan(content, vms, prune=True)
+    assert [(entry['action'], entry['name']) for entry in plan] == [
+        ('delete', 'vm00007'), ('delete', 'vm00008'), ('delete', 'vm00009')]
+    assert core.reconcile_plan(content, vms) == ([], {})
+    results = core.apply_plan(content, plan)
+    assert results == dict.fromkeys(['vm00007', 'vm00008', 'vm00009'])
+    assert sorted(core.list_vms(content, 'tenant0')) == ['vm0000{}'.format(i) for i in range(7)]
+    assert len(core.list_vms(content, 'tenant1')) == 10
+    assert core.get_obj(content, [vim.VirtualMachine], 'centos7') is not None
+
+
+def add_vm(stub, content, name, tenant):
+    with stub.lock:
+        vm = stub.make_vm(name)
+        stub.add_child(core.tenant_folder(content, tenant), vm)
+    return vm
+
+
+def test_same_name_in_another_tenant_is_another_vm(sim):
+    stub, content = sim
+    # tenant1 holds a vm called like the spec's, tenant0 doesn't
+    other = add_vm(stub, content, 'web', 'tenant1')
+    plan, failed = core.reconcile_plan(content, tenant0() + [spec('web', cpu=4)])
+    assert not failed
+    assert [(entry['action'], entry['name']) for entry in plan] == [('create', 'web')]
+    mine = add_vm(stub, content, 'web', 'tenant0')
+    plan, failed = core.reconcile_plan(content, tenant0() + [spec('web', cpu=4),
+                                                             spec('web', tenant='tenant1', cpu=6)])
+    assert not failed
+    assert sorted((entry['name'], entry['obj']._moId, entry['changes']) for entry in plan) == sorted([
+        ('web', mine._moId, [('cpu', 2, 4)]), ('web', other._moId, [('cpu', 2, 6)])])
+    core.apply_plan(content, plan)
+    assert stub.calls['ReconfigVM_Task'] == 2
+
+
+def test_same_name_twice_in_a_tenant_fails(sim):
+    stub, content = sim
+    add_vm(stub, content, 'vm00005', 'tenant0')
+    plan, failed = core.reconcile_plan(content, tenant0())
+    assert plan == [] and '2 vms called vm00005' in str(failed['vm00005'])
+    plan, failed = core.reconcile_plan(content, tenant0()[:5], prune=True)
+    assert [entry['name'] for entry in plan] == ['vm00005', 'vm00005', 'vm00006', 'vm00007',
+                                                 'vm00008', 'vm00009']
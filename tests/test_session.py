@@ -0,0 +1,32 @@
+import threading
+
+import core
+
+SITE = {'VC_HOST': 'vc1', 'VC_USER': 'admin', 'VC_PASS': 'secret', 'VC_PORT': 443}
+
+
+class FakeSession(object):
+    def __init__(self, creds):
+        self.si = object()
+        self.closed = threading.Event()
+
+    def login(self):
+        return self
+
+    def close(self, logout=False):
+        pass
+
+
+def test_default_session_reads_credentials_once(monkeypatch):
+    reads = []
+    monkeypatch.setattr(core, '_sessions', {})
+    monkeypatch.setattr(core, 'Session', FakeSession)
+    monkeypatch.setattr(core, 'vc_sites', lambda: reads.append(1) or [dict(SITE)])
+    si = core.connect_to_api()
+    assert core.connect_to_api() is si
+    assert core.connect_to_api(dict(SITE)) is si
+    assert len(reads) == 1
+    # a closed session is replaced, the file is read again for it
+    core._sessions[None].closed.set()
+    assert core.connect_to_api() is not si
+    assert len(reads) == 2
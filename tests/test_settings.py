@@ -0,0 +1,23 @@
+import pytest
+
+import core
+
+
+def test_epg_diff_names_both_portgroups(sim):
+    stub, content = sim
+    diff = core.vm_settings(content, 'vm00001', None, None, None, epg='EPG1', dry_run=True)
+    assert diff == [('epg', 'EPG0', 'EPG1')]
+
+
+def test_removed_vm_is_not_found(sim, monkeypatch):
+    stub, content = sim
+    vm = core.get_obj(content, [core.vim.VirtualMachine], 'vm00004')
+    with stub.lock:
+        stub.remove_child(vm)
+    # the name still resolves, the vm is gone by the time its properties are read
+    monkeypatch.setattr(core, 'get_obj', lambda *args: vm)
+    for call in (lambda: core.vm_info(content, vm),
+                 lambda: core.vm_settings(content, 'vm00004', 4, None, None),
+                 lambda: core.add_disks(content, 'vm00004', [{'size': 10}])):
+        with pytest.raises(Exception, match='No vm .* found'):
+            call()
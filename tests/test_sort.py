@@ -0,0 +1,55 @@
+import random
+import tempfile
+
+import pytest
+
+import core
+
+
+def rows(count):
+    generator = random.Random(count)
+    return [{'name': 'vm{:05d}'.format(i), 'ready': generator.randint(0, 9)} for i in range(count)]
+
+
+@pytest.mark.parametrize('count', [0, 6, 7, 14, 50])
+@pytest.mark.parametrize('reverse', [False, True])
+def test_spilled_runs_merge_in_order(count, reverse, monkeypatch):
+    spills = []
+
+    def spill():
+        spills.append(tempfile.SpooledTemporaryFile())
+        return spills[-1]
+    monkeypatch.setattr(core.tempfile, 'TemporaryFile', spill)
+    key = lambda row: row['ready']
+    data = rows(count)
+    # ties keep their input order, as with sorted()
+    assert list(core.sort_rows(iter(data), key, reverse, chunk=7)) == sorted(data, key=key, reverse=reverse)
+    # one run per chunk, the last one partial, nothing spills below a chunk
+    assert len(spills) == (-(-count // 7) if count >= 7 else 0)
+    assert all(spill.closed for spill in spills)
+
+
+def test_stopped_early_closes_runs(monkeypatch):
+    spills = []
+
+    def spill():
+        spills.append(tempfile.SpooledTemporaryFile())
+        return spills[-1]
+    monkeypatch.setattr(core.tempfile, 'TemporaryFile', spill)
+    sorted_rows = core.sort_rows(rows(50), lambda row: row['name'], reverse=True, chunk=7)
+    assert next(sorted_rows)['name'] == 'vm00049'
+    sorted_rows.close()
+    assert len(spills) == 8 and all(spill.closed for spill in spills)
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_limit(reverse):
+    data = rows(50)
+    key = lambda row: (row['ready'], row['name'])
+    assert list(core.sort_rows(data, key, reverse, limit=5)) == sorted(data, key=key, reverse=reverse)[:5]
+
+
+def test_template_without_a_vmx_path_in_a_listing():
+    # an inaccessible or orphaned template has no summary.config.vmPathName
+    row = core._vm_listing(None, {'type': 't', 'name': 'centos7', 'summary.config.numCpu': 2})
+    assert row == ['t', 2, None, '', None]
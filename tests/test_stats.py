@@ -0,0 +1,99 @@
+import pytest
+from pyVmomi import vim
+
+import core
+
+PM = vim.PerformanceManager
+
+
+def answer(stub, samples):
+    """
+    Make QueryPerf answer samples {(entity, counter, instance): [values]}.
+    Returns the list the query specs of every call go to.
+    """
+    queries = []
+    names = {info.key: '{}.{}.{}'.format(info.groupInfo.key, info.nameInfo.key, info.rollupType)
+             for info in stub.p(stub.perf)['perfCounter']}
+
+    def query_perf(mo, querySpec):
+        queries.append(querySpec)
+        metrics = []
+        for spec in querySpec:
+            series = [PM.IntSeries(id=PM.MetricId(counterId=metric.counterId, instance=instance), value=values)
+                      for metric in spec.metricId
+                      for (entity, counter, instance), values in samples.items()
+                      if entity == spec.entity._moId and counter == names[metric.counterId] and
+                      metric.instance in ('*', instance)]
+            metrics.append(PM.EntityMetric(entity=spec.entity, value=series, sampleInfo=[]))
+        return metrics
+    stub.do_QueryPerf = query_perf
+    return queries
+
+
+def vm(content, name):
+    return core.get_obj(content, [vim.VirtualMachine], name)
+
+
+@pytest.mark.parametrize('interval, ready', [('realtime', 2000), ('day', 30000)])
+def test_ready_summation_is_percent_of_the_interval(sim, interval, ready):
+    stub, content = sim
+    answer(stub, {(vm(content, 'vm00001')._moId, 'cpu.ready.summation', ''): [ready, ready]})
+    stats = core.vm_stats(content, ['vm00001'], interval=interval)
+    # ms of ready time per 20s / 300s sample
+    assert stats['vm00001']['cpu_ready_pct'] == 10.0
+    assert stats['vm00001']['cpu_usage_pct'] is None
+
+
+def test_missing_samples_are_left_out(sim):
+    stub, content = sim
+    moid = vm(content, 'vm00001')._moId
+    answer(stub, {(moid, 'cpu.usage.average', ''): [-1, 1000, 3000, -1],
+                  (moid, 'mem.active.average', ''): [-1, -1]})
+    stats = core.vm_stats(content, ['vm00001'])['vm00001']
+    assert stats['cpu_usage_pct'] == 20.0
+    assert stats['mem_active_mb'] is None
+
+
+def test_historical_queries_are_batched(sim):
+    stub, content = sim
+    names = ['vm{:05}'.format(i) for i in range(20)]
+    queries = answer(stub, {})
+    core.vm_stats(content, names, interval='week')
+    # 6 metrics each, no more than PERF_QUERY_METRICS (64) in one call
+    assert [len(specs) for specs in queries] == [10, 10]
+    assert all(spec.intervalId == 1800 and spec.startTime and not spec.maxSample
+               for specs in queries for spec in specs)
+    del queries[:]
+    core.vm_stats(content, names)
+    assert [len(specs) for specs in queries] == [20]
+    assert queries[0][0].maxSample == core.PERF_SAMPLES
+
+
+def test_datastore_stats_take_the_worst_latency_and_all_iops(sim):
+    stub, content = sim
+    hosts = [host for cluster in stub.clusters for host in stub.p(cluster)['host']]
+    uuid = 'uuid-' + stub.datastores[0]._moId
+    samples = {}
+    for i, host in enumerate(hosts):
+        samples[(host._moId, 'datastore.totalReadLatency.average', uuid)] = [i + 1]
+        samples[(host._moId, 'datastore.numberReadAveraged.average', uuid)] = [10 * (i + 1)]
+    answer(stub, samples)
+    stats = core.datastore_stats(content)
+    assert stats['DS01']['read_latency_ms'] == len(hosts)
+    assert stats['DS01']['read_iops'] == 10 * sum(range(1, len(hosts) + 1))
+    assert stats['DS01']['write_iops'] is None
+    assert stats['DS02'] == dict.fromkeys(core.DATASTORE_STATS)
+
+
+def test_top_vms_orders_by_the_metric(sim):
+    stub, content = sim
+    # the powered on vms of tenant0 are vm00000, vm00002 .. vm00008
+    ready = {'vm00000': 200, 'vm00002': 1000, 'vm00004': 600, 'vm00006': 1200}
+    answer(stub, {(vm(content, name)._moId, 'cpu.ready.summation', ''): [value]
+                  for name, value in ready.items()})
+    top = core.top_vms(content, 'tenant0', by='ready', count=3)
+    assert [(name, stats['cpu_ready_pct']) for name, stats in top] == [
+        ('vm00006', 6.0), ('vm00002', 5.0), ('vm00004', 3.0)]
+    assert len(core.top_vms(content, 'tenant0', count=10)) == 5
+    with pytest.raises(Exception, match='Unknown metric'):
+        core.top_vms(content, 'tenant0', by='nope')
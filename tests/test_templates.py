@@ -0,0 +1,103 @@
+import pytest
+from pyVmomi import vim
+
+import core
+
+
+def template(stub, name):
+    return next(vm for vm in stub._vms() if stub.p(vm)['name'] == name)
+
+
+def test_catalog_reads_only_changed_templates(sim):
+    stub, content = sim
+    catalog = core.template_catalog(content)
+    assert sorted(catalog.templates) == ['centos7', 'ubuntu18']
+    centos = catalog.get('centos7')
+    assert (centos['cpu'], centos['ram'], centos['path'], centos['datastore']) == (2, 4096, 'linux', 'DS01')
+    assert centos['disks'] == [('Hard disk 1', 20, 'DS01', 'thin')]
+    assert centos['networks'] == ['EPG0']
+    reads = stub.calls['RetrievePropertiesEx']
+    catalog.refresh(force=True)
+    assert stub.calls['RetrievePropertiesEx'] == reads
+    with stub.lock:
+        stub.reconfig(template(stub, 'ubuntu18'), vim.vm.ConfigSpec(numCPUs=8))
+        # a rename leaves config.changeVersion as it is
+        stub.set(template(stub, 'centos7'), name='centos7.9')
+    # checked every TEMPLATE_REFRESH seconds
+    catalog.refresh()
+    assert catalog.get('ubuntu18')['cpu'] == 2
+    catalog.refresh(force=True)
+    assert catalog.get('ubuntu18')['cpu'] == 8
+    assert stub.calls['RetrievePropertiesEx'] == reads + 1
+    assert catalog.get('centos7.9') is centos and catalog.templates.get('centos7') is None
+
+
+def test_catalog_picks_up_new_templates_on_a_miss(sim):
+    stub, content = sim
+    catalog = core.template_catalog(content)
+    with stub.lock:
+        stub.add_child(stub.templates_folder, stub.make_vm('debian10', template=True))
+    assert catalog.get('debian10')['path'] == ''
+    assert catalog.get('nope') is None
+
+
+def test_template_snapshot_is_cached(sim):
+    stub, content = sim
+    centos = template(stub, 'centos7')
+    pool = stub.p(stub.clusters[0])['resourcePool']
+    snapshot = core.template_snapshot(content, centos, pool, convert=True)
+    assert core.template_snapshot(content, centos, pool) is snapshot
+    assert stub.calls['CreateSnapshot_Task'] == 1
+    assert stub.p(centos)['config'].template
+
+
+def test_deleted_snapshot_is_taken_again(sim):
+    stub, content = sim
+    core.clone(content, 'linked0', 'centos7', 'tenant0', 'CL01', 'DS01', mode='linked',
+               convert_template=True)
+    snapshot = core._snapshots[template(stub, 'centos7')]
+    core.wait_for_task(snapshot.RemoveSnapshot_Task(removeChildren=False))
+    core.clone(content, 'linked1', 'centos7', 'tenant0', 'CL01', 'DS01', mode='linked',
+               convert_template=True)
+    assert stub.calls['CreateSnapshot_Task'] == 2
+    assert core._snapshots[template(stub, 'centos7')] != snapshot
+    assert core.get_obj(content, [vim.VirtualMachine], 'linked1') is not None
+
+
+def test_template_is_converted_only_when_asked(sim):
+    stub, content = sim
+    centos = template(stub, 'centos7')
+    with pytest.raises(Exception, match='centos7 has no {} snapshot'.format(core.LINKED_SNAPSHOT)):
+        core.clone(content, 'linked0', 'centos7', 'tenant0', 'CL01', 'DS01', mode='linked')
+    assert stub.calls['MarkAsVirtualMachine'] == stub.calls['CreateSnapshot_Task'] == 0
+    assert stub.p(centos)['config'].template
+
+
+def test_template_is_restored_when_the_snapshot_fails(sim):
+    stub, content = sim
+    centos = template(stub, 'centos7')
+
+    def fail(mo, name, description, memory, quiesce):
+        raise vim.fault.InvalidState(msg='snapshots are disabled')
+    stub.do_CreateSnapshot_Task = fail
+    with pytest.raises(vim.fault.InvalidState):
+        core.template_snapshot(content, centos, stub.p(stub.clusters[0])['resourcePool'], convert=True)
+    assert stub.calls['MarkAsVirtualMachine'] == stub.calls['MarkAsTemplate'] == 1
+    assert stub.p(centos)['config'].template
+
+
+def test_removed_template_has_no_snapshot(sim):
+    stub, content = sim
+    centos = template(stub, 'centos7')
+    with stub.lock:
+        stub.remove_child(centos)
+    with pytest.raises(Exception, match='it was removed'):
+        core.template_snapshot(content, centos, stub.p(stub.clusters[0])['resourcePool'])
+
+
+def test_list_templates_of_a_folder_as_before(sim):
+    stub, content = sim
+    folder = core.get_templates_folder(content)
+    found = {'kept': 'Other'}
+    assert core.list_templates(folder, found) is found
+    assert found == {'kept': 'Other', 'centos7': 'CentOS 7 (64-bit)', 'ubuntu18': 'CentOS 7 (64-bit)'}
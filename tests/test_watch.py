@@ -0,0 +1,37 @@
+import threading
+import time
+
+from pyVmomi import vim
+
+import core
+
+
+def test_watch_streams_changes_and_tasks(sim):
+    stub, content = sim
+    tenant = core.tenant_folder(content, 'tenant0')
+    events = []
+    consumer = threading.Thread(target=lambda: events.extend(core.watch(content, tenant, duration=1.5)))
+    consumer.start()
+    time.sleep(0.3)
+    vm = core.get_obj(content, [vim.VirtualMachine], 'vm00000')
+    core.wait_for_task(vm.PowerOffVM_Task())
+    core.clone(content, 'new00', 'centos7', 'tenant0', 'CL01', 'DS01')
+    with stub.lock:
+        stub.remove_child(core.get_obj(content, [vim.VirtualMachine], 'vm00001'))
+        # elsewhere, not in the feed
+        stub.set(core.get_obj(content, [vim.VirtualMachine], 'vm00010'), name='renamed')
+    consumer.join()
+    assert {'event': 'changed', 'name': 'vm00000',
+            'changes': {'summary.runtime.powerState': 'poweredOff'}} in events
+    # the clone runs on centos7, outside the tenant
+    tasks = [event for event in events if event['event'] == 'task']
+    assert {(event['name'], event['state']) for event in tasks} == {('vm00000', 'running'),
+                                                                  ('vm00000', 'success')}
+    assert [event['name'] for event in events if event['event'] == 'added'] == ['new00']
+    assert [event['name'] for event in events if event['event'] == 'removed'] == ['vm00001']
+    assert 'renamed' not in [event['name'] for event in events]
+
+
+def test_watch_rejects_a_bad_duration(shell, capsys):
+    shell.onecmd('watch tenant0 --for abc')
+    assert 'ERR: --for takes a number of seconds' in capsys.readouterr().out
@@ -3,7 +3,15 @@
 
 from cmd import Cmd
 from core import *
+import argparse
+import contextlib
+import getpass
+import io
+import itertools
 import os
+import sys
+import threading
+import time
 import yaml
 
 class VcenterShell(Cmd):
@@ -12,6 +20,120 @@ class VcenterShell(Cmd):
         self.intro =  '####\n#### Welcome to vcenter shell. Type help or ? to list commands. ####\n####\n'
         self.doc_header = 'To find info and example fo particular command please type \'help command\''
         self.prompt = '[vc001]$ '
+        # batch mode: 'json'/'ndjson' makes commands emit records to writer
+        self.output = 'text'
+        self.writer = None
+        self.command = None
+        self.emitted = 0
+        self.assume_yes = False
+        # batch mode never reads stdin, the script may come from there
+        self.batch = False
+        # set when a batch command needed an answer it couldn't get
+        self.refused = False
+        # [(site, content)] of the connected vcenters, commands that change
+        # things work on self.site, picked with use
+        self.sites = []
+        self.site = None
+        # set by profile on, records the vcenter calls of every command
+        self.profiler = None
+        # guest user -> password of run and shell, asked once
+        self.guest_passwords = {}
+
+    def emit(self, **record):
+        '''send one machine readable record of the running command'''
+        self.emitted += 1
+        self.writer(dict(command=self.command, **record))
+
+    def run(self, line):
+        '''
+        run one batch command, records go to writer as they are emitted.
+        Plain printed output becomes one record. Returns (ok, stop).
+        '''
+        self.command = line
+        self.emitted = 0
+        self.refused = False
+        captured = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(captured):
+                stop = self.onecmd(line)
+        except Exception as err:
+            self.emit(error=str(getattr(err,'msg',err)))
+            return False, False
+        lines = captured.getvalue().splitlines()
+        if not self.emitted:
+            self.emit(output=lines)
+        return not self.refused and not any(l.startswith('ERR') for l in lines), stop
+
+    def confirm(self):
+        '''
+        y/n confirmation of a change, yes with assume_yes. In batch mode the
+        command fails instead of reading stdin.
+        '''
+        if self.assume_yes:
+            return True
+        if self.batch:
+            self.refused = True
+            print("ERR: needs a confirmation, run the batch with -y to answer yes")
+            return False
+        return input("##=> proceed? y/n ") == 'y'
+
+    def fan_out(self, func, *args):
+        '''
+        func on every connected vcenter at once. Returns the merged {key: value}
+        results as [(source, key, value)] sorted by key. Failed vcenters print ERR.
+        '''
+        order = [site['VC_NAME'] for site,content in self.sites]
+        rows = []
+        for source,result in federate(self.sites, func, *args):
+            if isinstance(result, Exception):
+                print("ERR: {}: {}".format(source,getattr(result,'msg',result)))
+            elif result:
+                rows.extend((source,key,value) for key,value in result.items())
+        return sorted(rows, key=lambda row: (row[1], order.index(row[0])))
+
+    def stream(self, func, *args, **kwargs):
+        '''
+        fan_out() for generator funcs, yields (source, key, value) as soon as
+        any vcenter has them, unsorted. Failed vcenters print ERR.
+        '''
+        results = federate_stream(self.sites, func, *args, **kwargs)
+        try:
+            for source,item in results:
+                if isinstance(item, Exception):
+                    print("ERR: {}: {}".format(source,getattr(item,'msg',item)))
+                else:
+                    yield (source,)+tuple(item)
+        finally:
+            results.close()
+
+    def listing(self, rows, values, sort=None, limit=None):
+        '''
+        the first limit rows of stream(), with sort ordered by that key of
+        values(row) (descending with a - prefix) in bounded memory
+        '''
+        limit = int(limit) if limit is not None else None
+        if not sort:
+            return itertools.islice(rows, limit)
+        field = sort.lstrip('-')
+        numeric = field in ('cpu','ram','disks','capacity_gb','free_gb')
+
+        def key(row):
+            value = values(row).get(field)
+            if numeric:
+                try:
+                    value = sum(float(v) for v in str(value).split(',') if v)
+                except ValueError:
+                    value = 0.0
+            else:
+                value = str(value or '')
+            return value,row[1],row[0]
+        return sort_rows(rows, key=key, reverse=sort.startswith('-'), limit=limit)
+
+    def onecmd(self, line):
+        if self.profiler is None or not line.strip() or line.split()[0] == 'profile':
+            return Cmd.onecmd(self, line)
+        with self.profiler.command(line.strip()):
+            return Cmd.onecmd(self, line)
 
     def default(self, line):
         print("{}: Command not found".format(line))
@@ -26,41 +148,101 @@ class VcenterShell(Cmd):
         os.system('clear')
 
     def do_connect_to_api(self, line):
-        '''connect to vcenter api service'''
+        '''
+        connect to vcenter api service
+        Inventory is served from the on-disk snapshot (.inventory.db) at once
+        and brought up to date in the background.
+        '''
         print("Connecting to vcenter...")
-        self.content = connect_to_api().RetrieveContent()
+        self.sites, failed = connect_sites()
+        for source,err in failed.items():
+            print("ERR: {}: {}".format(source,getattr(err,'msg',err)))
+        if not self.sites:
+            raise SystemExit("Unable to connect to vcenter.")
+        opened = set()
+        for site,content in self.sites:
+            if content in opened:
+                continue
+            opened.add(content)
+            inv = open_inventory(content, host=site['VC_HOST'])
+            if inv.ready.is_set():
+                print("Loaded {} objects from {} inventory snapshot".format(len(inv.objects),site['VC_NAME']))
+        self.use(*self.sites[0])
         print("Connected")
 
+    def use(self, site, content):
+        self.site, self.content = site, content
+        self.prompt = '[{}]$ '.format(site['VC_NAME'])
+
+    def do_use(self, line):
+        '''
+        pick the vcenter clone, set and power commands work on
+        Example: use SOURCE, without SOURCE lists the connected vcenters
+        '''
+        name = line.strip()
+        for site,content in self.sites:
+            if not name:
+                print("{} {} ({})".format('*' if site is self.site else ' ',site['VC_NAME'],site['VC_DATACENTER']))
+            elif site['VC_NAME'] == name:
+                self.use(site, content)
+                return
+        if name:
+            print("ERR: {} is not connected".format(name))
+
     def do_list_clusters(self, line):
-        '''list configured clusters'''
-        HEADER = ['NAME','CPU','THREADS','MEMORY','HOSTS','STATUS']
-        HBODY = "{0:<10s} {1:<10s} {2:<10s} {3:<10s} {4:<10s} {5:<10s}"
-        BODY = "{0:<10s} {1:<10d} {2:<10d} {3:<10.0f} {4:<10d} {5:<10s}"
-        clusters = list_clusters(self.content)
-        clusters.update({HEADER[0]:HEADER[1:]})
-        for cluster,info in sorted(clusters.items(),reverse=True):
-            if cluster == 'NAME':
-                print(HBODY.format(cluster,*info))
-                print("-"*len(HEADER[0]))
-            else:
-                print(BODY.format(cluster,*info))
+        '''list configured clusters of every connected vcenter'''
+        HEADER = ['NAME','CPU','THREADS','MEMORY','HOSTS','STATUS','SOURCE']
+        HBODY = "{0:<10s} {1:<10s} {2:<10s} {3:<10s} {4:<10s} {5:<10s} {6:<10s}"
+        BODY = "{0:<10s} {1:<10d} {2:<10d} {3:<10.0f} {4:<10d} {5:<10s} {6:<10s}"
+        clusters = self.fan_out(list_clusters)
+        if self.output != 'text':
+            for source,cluster,info in clusters:
+                self.emit(source=source,**dict(zip(['name','cpu','threads','memory_gb','hosts','status'],[cluster]+info)))
+            return
+        print(HBODY.format(*HEADER))
+        print("-"*len(HEADER[0]))
+        for source,cluster,info in clusters:
+            print(BODY.format(cluster,*info,source))
 
     def do_list_datastores(self, line):
-        '''list configured datastores'''
-        HEADER = ['NAME','CAPACITY','FREE','STATUS','TYPE']
-        HBODY = "{0:<35s} {1:<15s} {2:<15s} {3:<15s} {4:<15s}"
-        BODY = "{0:<35s} {1:<15.0f} {2:<15.0f} {3:<15s} {4:<15s}"
-        datastores = list_datastores(self.content)
+        '''
+        list configured datastores of every connected vcenter
+        Example: list_datastores [--name GLOB] [--sort [-]COLUMN] [--limit N]
+        COLUMN is one of name, capacity_gb, free_gb, status, type, - sorts descending
+        '''
+        HEADER = ['NAME','CAPACITY','FREE','STATUS','TYPE','SOURCE']
+        HBODY = "{0:<35s} {1:<15s} {2:<15s} {3:<15s} {4:<15s} {5:<15s}"
+        BODY = "{0:<35s} {1:<15.0f} {2:<15.0f} {3:<15s} {4:<15s} {5:<15s}"
+        COLUMNS = ['name','capacity_gb','free_gb','status','type']
+        args,opts = self.options(line,name=None,sort=None,limit=None)
+        if opts['sort'] and opts['sort'].lstrip('-') not in COLUMNS:
+            print("ERR: sort by one of {}".format(', '.join(COLUMNS)))
+            return
+        try:
+            datastores = self.listing(self.stream(iter_datastores,name=opts['name']),
+                                      lambda row: dict(zip(COLUMNS,[row[1]]+row[2])),
+                                      opts['sort'],opts['limit'])
+        except ValueError:
+            print("ERR: --limit takes a number")
+            return
+        if self.output != 'text':
+            for source,datastore,info in datastores:
+                self.emit(source=source,**dict(zip(COLUMNS,[datastore]+info)))
+            return
         print(HBODY.format(*HEADER))
         print("-"*len(''.join(HEADER[0])))
-        for datastore,info in sorted(datastores.items()):
-            print(BODY.format(datastore,*info))
+        for source,datastore,info in datastores:
+            print(BODY.format(datastore,*info,source))
 
     def do_list_tenants(self, line):
         '''list existing tenants'''
         HEADER = ['NAME']
         HBODY = "{0:<10s}"
-        tenants = list_tenants(self.content)
+        tenants = list_tenants(self.content,datacenter=self.site['VC_DATACENTER'])
+        if self.output != 'text':
+            for tenant in tenants:
+                self.emit(name=tenant)
+            return
         tenants.append(HEADER[0])
         tenants.reverse()
         for index,tenant in enumerate(tenants):
@@ -72,46 +254,78 @@ class VcenterShell(Cmd):
     
     def do_list_vms(self, line):
         '''
-        list vms in tenant
-        Example: list_vms TENANT_NAME 
+        list vms in tenant on every connected vcenter, -r also lists nested folders
+        Example: list_vms TENANT_NAME [-r] [--power on|off|suspended] [--guest OS]
+                 [--name GLOB] [--sort [-]COLUMN] [--limit N]
+        vms are printed as they are fetched. --guest matches a glob or part of
+        the guest os, --name a glob; with a filter folders are left out. --sort
+        orders by name, cpu, ram, disks, datastore, guest or power, - descending.
         '''
+        KINDS = {'v':VM_COLUMNS,'t':['name','cpu','ram','datastore','guest'],'d':['name']}
+        args,opts = self.options(line,power=None,guest=None,name=None,sort=None,limit=None)
+        recursive = '-r' in args or '--recursive' in args
+        args = [arg for arg in args if arg not in ('-r', '--recursive')]
+        if not args:
+            return
+        if opts['sort'] and opts['sort'].lstrip('-') not in VM_COLUMNS:
+            print("ERR: sort by one of {}".format(', '.join(VM_COLUMNS)))
+            return
         try:
-            args = line.split()
-            vms = list_vms(self.content,args[0])
-            for vm,info in sorted(vms.items()):
-                if info[0] == 'v' or info[0] == 't':
-                    #print("{0} -- {1:<20} {2:>5} {3:>5} {4:>5} {5:>5}".format(info[0],vm,*info[1:]))
-                    #print("{} -- {} {} {} {} {} {} {}".format(info[0],vm,*info[1:]))
-                    print(info[0],'--',vm,*info[1:])
-                elif info[0] == 'd':
-                    print("{0} -- {1}".format(info[0],vm))
-        except AttributeError:
+            vm_filter(opts['power'],opts['guest'],opts['name'])
+            vms = self.listing(self.stream(iter_vms,args[0],recursive,power=opts['power'],
+                                           guest=opts['guest'],name=opts['name']),
+                               lambda row: dict(zip(KINDS[row[2][0]],[row[1]]+row[2][1:])),
+                               opts['sort'],opts['limit'])
+        except ValueError:
+            print("ERR: --limit takes a number")
+            return
+        except Exception as err:
+            print("ERR: {}".format(err))
+            return
+        found = 0
+        for source,vm,info in vms:
+            found += 1
+            if self.output != 'text':
+                self.emit(kind=info[0],source=source,**dict(zip(KINDS[info[0]],[vm]+info[1:])))
+            elif info[0] == 'v' or info[0] == 't':
+                print(info[0],'--',vm,*info[1:],source)
+            elif info[0] == 'd':
+                print("{0} -- {1} {2}".format(info[0],vm,source))
+        if not found:
             print("Not found")
-        except IndexError:
-            pass
-   
+
     def do_list_templates(self, line):
         '''
-        list available templates in Templates\linux
+        list available templates in Templates and its subfolders
+        with their guest os, cpu, ram (MB), disks (GB), datastore and networks
         '''
-        folder = get_templates_folder(self.content)
-        templates = list_templates(folder,{})
-        for name,guest in sorted(templates.items()):
-            print("t -- {}  ['{}']".format(name,guest))
+        templates = list_templates(self.content,datacenter=self.site['VC_DATACENTER'])
+        for name,(guest,path,cpu,ram,disks,datastore,networks) in sorted(templates.items()):
+            if self.output != 'text':
+                self.emit(name=name,guest=guest,folder=path,cpu=cpu,ram=ram,disks=disks,
+                          datastore=datastore,networks=networks)
+            else:
+                print("t -- {}  ['{}'] {} {} {} {} {}".format(name,guest,cpu,ram,
+                      '+'.join(map(str,disks or [])) or '-',datastore or '-',','.join(map(str,networks or [])) or '-'))
        
     def do_find_vm(self,line):
         '''
-        find virtual machine by name
-        Example: find_vm NAME
+        find virtual machines on every connected vcenter by name, name glob
+        or /regex/, guest ip, mac or bios/instance uuid
+        Example: find_vm NAME, find_vm 'web*', find_vm 10.0.0.5
+        Prefix ip:, mac:, uuid: or name: to search one field by pattern, e.g. ip:10.0.1.*
         '''
         try:
             args = line.split()
-            vm = find_vm(self.content,args[0])
-            if vm:
-                for key,val in vm.items():
-                    print("{} -- {} {} {} {} {} {} {} {}".format(key,*val))
+            vms = self.fan_out(find_vms,args[0])
+            if vms:
+                for source,(name,moid),info in vms:
+                    if self.output != 'text':
+                        self.emit(kind=info[0],source=source,**dict(zip(VM_COLUMNS,[name]+info[1:])))
+                    else:
+                        print(info[0],'--',name,*info[1:],source)
             else:
-                print('No vm with {} name found'.format(args[0]))
+                print('No vm matching {} found'.format(args[0]))
         except:
             return
 
@@ -121,7 +335,10 @@ class VcenterShell(Cmd):
         '''
         dvs = list_dvs(self.content)
         for i,switch in enumerate(dvs,1):
-            print("[{}] {}".format(i,switch))
+            if self.output != 'text':
+                self.emit(name=switch)
+            else:
+                print("[{}] {}".format(i,switch))
 
     def do_dvs_info(self, line):
         '''
@@ -130,99 +347,167 @@ class VcenterShell(Cmd):
         '''
         args = line.split()
         dvs = dvs_info(self.content,name=args[0])
-        print(dvs)
+        if self.output != 'text' and not isinstance(dvs,str):
+            self.emit(name=args[0],portgroups=list(dvs))
+        else:
+            print(dvs)
            
     def do_clone(self, line):
         '''
         Clone virtual machine from template
-        Example: clone NAME TEMPLATE TENANT CLUSTER DATASTORE CPU RAM HDD EPG
+        Example: clone NAME TEMPLATE TENANT CLUSTER DATASTORE CPU RAM HDD EPG [MODE] [--convert-template]
         You can use \'default\' as parameter, to use default settings.
         Currently supported only for DATASTORE(taken from .credentials config)
-        and for EPG(taken from template).
+        and for CPU, RAM, HDD and EPG(taken from template).
+        The vm is created on the vcenter picked with use.
+        CLUSTER and DATASTORE can be auto, to place the vm on the host and
+        datastore with the most free memory and space.
+        MODE is full(default), linked (child disks on a template snapshot,
+        HDD must stay the template size) or instant (running source vm).
+        A linked clone of a template without the snapshot fails, unless
+        --convert-template lets the template become a vm while it's taken.
         '''
-        try:
-            args = line.split()
-            if len(args) < 9:
-                raise SystemExit('Please provide right numbers of arguments')
-            vm_name,template,tenant,cluster,datastore,cpu,ram,hdd,epg = args
-            if datastore.lower() == 'default':
-                datastore = None
-            if epg.lower() == 'default':
-                epg = None
-        except ValueError:
+        args = line.split()
+        convert = '--convert-template' in args
+        args = [arg for arg in args if arg != '--convert-template']
+        if len(args) not in (9, 10):
             print('Please provide arguments as in help')
+            return
+        vm_name,template,tenant,cluster,datastore,cpu,ram,hdd,epg = args[:9]
+        mode = args[9].lower() if len(args) == 10 else 'full'
+        if datastore.lower() == 'default':
+            datastore = None
+        if epg.lower() == 'default':
+            epg = None
+        cpu,ram,hdd = [None if value.lower() == 'default' else value for value in (cpu,ram,hdd)]
         try:
             print("Cloning {} to {}...".format(template,vm_name))
-            clone(self.content,vm_name,template,tenant,cluster,datastore)
+            clone(self.content,vm_name,template,tenant,cluster,datastore,
+                  cpu=cpu,ram=ram,hdd=hdd,epg=epg,mode=mode,
+                  datacenter=self.site['VC_DATACENTER'],convert_template=convert)
             print("Completed")
         except Exception as err:
-            print("Could not clone {} :-(\nERR: {}".format(vm_name,err))
-        try:
-            print("Changing {} settings...".format(vm_name))
-            vm_settings(self.content,vm_name,cpu,ram,hdd,epg)
-            print("Completed")
-        except Exception as err:
-            print("Could not change settings to {} :-(\nERR: {}".format(vm_name,err))
+            print("Could not clone {} :-(\nERR: {}".format(vm_name,getattr(err,'msg',err)))
 
     def do_clone_from_file(self, line):
         '''
         Clone virtual machine from template but take config from the file
-        Examples: clone_from_file FILENAME
+        Examples: clone_from_file FILENAME [--reconcile [--prune]]
         FILENAME syntax yaml style. Please check examples
+        VMs are provisioned in parallel, optional default keys workers,
+        cluster_tasks and datastore_tasks limit the tasks in flight.
+        Optional mode key (default section or per vm) picks full, linked
+        or instant clones, convert_template: yes lets linked clones take the
+        snapshot of a template that has none.
+        The whole batch is placed by free host memory and datastore space
+        before cloning starts, cluster and datastore can be auto.
+        --reconcile compares the file with the vms in its tenants and only
+        creates missing vms and resizes or re-networks vms that differ,
+        --prune also deletes vms of those tenants the file doesn't name.
         '''
+        args = line.split()
+        prune = '--prune' in args
+        reconcile = prune or '--reconcile' in args
+        args = [arg for arg in args if arg not in ('--reconcile', '--prune')]
         try:
-            args = line.split()
             with open(args[0]) as stream:
-                data = yaml.load(stream)
+                data = yaml.safe_load(stream)
         except Exception as err:
             print(err)
-        
-        try:
-            print("####\nFollowing configuration would be provisioned\n")
-            print('DEFAULT:')
-            print(' Datacenter={}\n Datastore={}\n Cluster={}\n'.format(
-                                                data['default']['datacenter'],
-                                                data['default']['datastore'],
-                                                data['default']['cluster'])) 
-       
-            print('VMS:')
-            for vm in data['vm']:
-                print(' name={}\n tenant={}\n template={}\n cpu={}\n ram={}\n hdd={}\n datastore={}\n epg={}\n cluster={}\n'.format(
-                        vm['name'],vm['tenant'],vm['template'],vm['cpu'],vm['ram'],vm['hdd'],vm['datastore'],vm['epg'],vm['cluster']))
-
-        except KeyError as err:
-            print('ERR: {} not found'.format(err))
             return
-   
-        answer = input("##=> proceed? y/n ")
-        if answer == 'y':
+
+        def complete(vm):
+            vm.setdefault('mode',data['default'].get('mode','full'))
+            vm.setdefault('convert_template',data['default'].get('convert_template',False))
+            vm.setdefault('datacenter',data['default']['datacenter'])
+            for key in ('cluster','datastore','epg','template','tenant'):
+                if str(vm[key]).lower() == 'default':
+                    vm[key] = data['default'][key]
+
+        # provision and apply_plan report from their pool threads
+        lock = threading.Lock()
+
+        def progress(name, stage, err):
+            with lock:
+                if self.output != 'text':
+                    self.emit(name=name,stage=stage,error=str(getattr(err,'msg',err)) if err else None)
+                elif err:
+                    print("[{}] {} :-(\nERR: {}".format(name,stage,getattr(err,'msg',err)))
+                else:
+                    print("[{}] {}".format(name,stage))
+
+        if reconcile:
+            try:
+                for vm in data['vm']:
+                    complete(vm)
+                plan, failed = reconcile_plan(self.content, data['vm'], prune)
+            except KeyError as err:
+                print('ERR: {} not found'.format(err))
+                return
+            except Exception as err:
+                print("ERR: {}".format(getattr(err,'msg',err)))
+                return
+            for name,err in failed.items():
+                progress(name, 'failed', err)
+            if not plan:
+                print("Nothing to do, {} vms as described".format(len(data['vm'])-len(failed)))
+                return
+            print("####\nFollowing changes would be made\n")
+            for entry in plan:
+                if self.output != 'text':
+                    self.emit(name=entry['name'],action=entry['action'],
+                              changes=[list(change) for change in entry.get('changes',[])])
+                elif entry['action'] == 'create':
+                    vm = entry['vm']
+                    print(" create {} ({}, {} cpu, {}GB ram, {}GB hdd, {})".format(
+                          vm['name'],vm['template'],vm['cpu'],vm['ram'],vm['hdd'],vm['epg']))
+                elif entry['action'] == 'delete':
+                    print(" delete {} ({})".format(entry['name'],entry['row'].get('runtime.powerState')))
+                else:
+                    print(" {} {}: {}".format(entry['action'],entry['name'],', '.join(
+                          "{} {} -> {}".format(*change) for change in entry['changes'])))
+            if not self.confirm():
+                return
             print('processing...')
-            for vm in data['vm']:
-                if vm['cluster'].lower() == 'default':
-                    vm['cluster'] = data['default']['cluster']
-
-                if vm['datastore'].lower() == 'default':
-                    vm['datastore'] = data['default']['datastore']
-
-                if vm['epg'].lower() == 'default':
-                    vm['epg'] = data['default']['epg']
-                    
-                if vm['template'].lower() == 'default':
-                    vm['template'] = data['default']['template']
-
-                if vm['tenant'].lower() == 'default':
-                    vm['tenant'] = data['default']['tenant']
-
-                print("Cloning {} to {}...".format(vm['template'],vm['name']))
-                clone(self.content,vm['name'],vm['template'],vm['tenant'],vm['cluster'],vm['datastore'])
-                print('Completed')
-                
-                print("Changing {} settings...".format(vm['name']))
-                vm_settings(self.content,vm['name'],vm['cpu'],vm['ram'],vm['hdd'],vm['epg'])
-                print("Completed")
+            results = apply_plan(self.content, plan,
+                                 workers=data['default'].get('workers',8),
+                                 cluster_tasks=data['default'].get('cluster_tasks',CLUSTER_TASKS),
+                                 datastore_tasks=data['default'].get('datastore_tasks',DATASTORE_TASKS),
+                                 progress=progress)
+            results.update(failed)
         else:
-            return
-        
+            try:
+                print("####\nFollowing configuration would be provisioned\n")
+                print('DEFAULT:')
+                print(' Datacenter={}\n Datastore={}\n Cluster={}\n'.format(
+                                                    data['default']['datacenter'],
+                                                    data['default']['datastore'],
+                                                    data['default']['cluster']))
+
+                print('VMS:')
+                for vm in data['vm']:
+                    print(' name={}\n tenant={}\n template={}\n cpu={}\n ram={}\n hdd={}\n datastore={}\n epg={}\n cluster={}\n'.format(
+                            vm['name'],vm['tenant'],vm['template'],vm['cpu'],vm['ram'],vm['hdd'],vm['datastore'],vm['epg'],vm['cluster']))
+
+            except KeyError as err:
+                print('ERR: {} not found'.format(err))
+                return
+
+            if not self.confirm():
+                return
+            print('processing...')
+            for vm in data['vm']:
+                complete(vm)
+            results = provision(self.content, data['vm'],
+                                workers=data['default'].get('workers',8),
+                                cluster_tasks=data['default'].get('cluster_tasks',CLUSTER_TASKS),
+                                datastore_tasks=data['default'].get('datastore_tasks',DATASTORE_TASKS),
+                                progress=progress)
+        failed = [name for name,err in results.items() if err]
+        print("Completed {} of {}".format(len(results)-len(failed),len(results)))
+        if failed:
+            print("Failed: {}".format(' '.join(sorted(failed))))
+
     def do_start_vm(self, line):
         '''
         Start virtual machine
@@ -231,10 +516,12 @@ class VcenterShell(Cmd):
         args = line.split()
         vm = get_obj(self.content,[vim.VirtualMachine],name=args[0])
         if vm:
-            print("Poweron {}...".format(vm.name))
-            task = vm.PowerOnVM_Task()
-            wait_for_task(task)
-            print("Started!")
+            print("Poweron {}...".format(args[0]))
+            try:
+                wait_for_task(vm.PowerOnVM_Task())
+                print("Started!")
+            except Exception as err:
+                print("ERR: {}".format(getattr(err,'msg',err)))
         else:
             print("No vm with {} name found".format(args[0]))
 
@@ -246,10 +533,12 @@ class VcenterShell(Cmd):
         args = line.split()
         vm = get_obj(self.content,[vim.VirtualMachine],name=args[0])
         if vm:
-            print("Poweroff {}...".format(vm.name))
-            task = vm.PowerOffVM_Task()
-            wait_for_task(task)
-            print("Stopped!")
+            print("Poweroff {}...".format(args[0]))
+            try:
+                wait_for_task(vm.PowerOffVM_Task())
+                print("Stopped!")
+            except Exception as err:
+                print("ERR: {}".format(getattr(err,'msg',err)))
         else:
             print("No vm with {} name found".format(args[0]))
 
@@ -261,10 +550,12 @@ class VcenterShell(Cmd):
         args = line.split()
         vm = get_obj(self.content,[vim.VirtualMachine],name=args[0])
         if vm:
-            print("Reseting {}...".format(vm.name))
-            task = vm.ResetVM_Task()
-            wait_for_task(task)
-            print("Done!")
+            print("Reseting {}...".format(args[0]))
+            try:
+                wait_for_task(vm.ResetVM_Task())
+                print("Done!")
+            except Exception as err:
+                print("ERR: {}".format(getattr(err,'msg',err)))
         else:
             print("No vm with {} name found".format(args[0]))
 
@@ -284,10 +575,66 @@ class VcenterShell(Cmd):
                 print("Destroying {}...".format(args[0]))
                 task = vm.Destroy_Task()
                 wait_for_task(task)
+                inventory(self.content).forget(vm)
                 print("Done!")
-        except Exception:
-            pass
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
  
+    def do_power(self, line):
+        '''
+        Power on, power off, shut down, reset or remove many virtual machines
+        Examples: power on NAME [NAME|GLOB ...]
+                  power shutdown --tenant TENANT [--timeout SECONDS]
+                  power off --file FILENAME [--workers N]
+        Actions: on, off, shutdown, reset, remove. FILENAME has one name or
+        glob per line. shutdown asks the guest OS first and powers off what
+        still runs after --timeout seconds (default 300). --workers limits
+        the tasks in flight (default 16).
+        '''
+        args, opts = self.options(line, tenant=None, file=None, timeout=SHUTDOWN_TIMEOUT,
+                                  workers=POWER_TASKS)
+        if not args or args[0] not in POWER_ACTIONS:
+            print("ERR: power {} NAME|GLOB ... | --tenant TENANT | --file FILENAME".format('|'.join(POWER_ACTIONS)))
+            return
+        action, patterns = args[0], args[1:]
+        try:
+            if opts['file']:
+                with open(opts['file']) as stream:
+                    patterns += [l.strip() for l in stream if l.strip() and not l.startswith('#')]
+            vms = select_vms(self.content, patterns, opts['tenant'], self.site['VC_DATACENTER'])
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+            return
+        if not vms:
+            print("No vm found")
+            return
+        print("{} {} vms: {}".format(action, len(vms), ' '.join(sorted(vms))))
+        if not self.confirm():
+            return
+
+        # power_vms reports from its pool threads
+        lock = threading.Lock()
+
+        def progress(name, outcome, err):
+            with lock:
+                if self.output != 'text':
+                    self.emit(name=name,outcome=outcome,error=str(getattr(err,'msg',err)) if err else None)
+                elif err:
+                    print("[{}] {} :-(\nERR: {}".format(name,outcome,getattr(err,'msg',err)))
+                else:
+                    print("[{}] {}".format(name,outcome))
+
+        try:
+            results = power_vms(self.content, vms, action, workers=int(opts['workers']),
+                                timeout=int(opts['timeout']), progress=progress)
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+            return
+        failed = [name for name,outcome in results.items() if isinstance(outcome, Exception)]
+        print("Completed {} of {}".format(len(results)-len(failed),len(results)))
+        if failed:
+            print("Failed: {}".format(' '.join(sorted(failed))))
+
     def do_vm_info(self, line):
         '''
         View virtual machine config/hardware settings
@@ -295,46 +642,518 @@ class VcenterShell(Cmd):
         '''
         args = line.split()
         vm = get_obj(self.content,[vim.VirtualMachine],name=args[0])
-        config_info = vm_info(vm)
+        if not vm:
+            print("No vm with {} name found".format(args[0]))
+            return
+        config_info = vm_info(self.content,vm)
+        if self.output != 'text':
+            self.emit(**dict(zip(VM_COLUMNS,config_info)))
+            return
         print('NAME\n----')
         for info in config_info:
             print("{}\t".format(info),end='')
         print()
 
+    def options(self, line, **defaults):
+        '''positional args and --name VALUE options of line, options default to defaults'''
+        args, opts = [], dict(defaults)
+        words = iter(line.split())
+        for word in words:
+            if word.startswith('--') and word[2:] in defaults:
+                opts[word[2:]] = next(words, None)
+            else:
+                args.append(word)
+        return args, opts
+
+    def print_stats(self, stats, columns):
+        '''[(name, {column: value})] as a table or records'''
+        if self.output != 'text':
+            for name,values in stats:
+                self.emit(name=name,**values)
+            return
+        print(("{:<30s}" + " {:>17s}"*len(columns)).format('NAME',*[c.upper() for c in columns]))
+        print('----')
+        for name,values in stats:
+            print(("{:<30s}" + " {:>17s}"*len(columns)).format(
+                  name,*['-' if values[c] is None else str(values[c]) for c in columns]))
+
+    def do_vm_stats(self, line):
+        '''
+        Runtime performance of virtual machines
+        Example: vm_stats NAME [NAME...] [--interval INTERVAL] [--samples N]
+                 vm_stats --tenant TENANT [--top N] [--by ready|balloon|latency|cpu]
+        INTERVAL is realtime (default), day, week, month or year. With --tenant
+        every running vm of the tenant is shown, --top keeps the N highest by
+        cpu ready %, balloon memory, disk latency or cpu usage.
+        '''
+        names,opts = self.options(line,tenant=None,interval='realtime',samples=PERF_SAMPLES,
+                                  top=None,by='ready')
+        if not names and not opts['tenant']:
+            print('Please provide arguments as in help')
+            return
+        try:
+            samples = int(opts['samples'])
+            if opts['top']:
+                if not opts['tenant']:
+                    raise Exception("--top needs --tenant")
+                stats = top_vms(self.content,opts['tenant'],opts['by'],int(opts['top']),
+                                opts['interval'],samples,self.site['VC_DATACENTER'])
+            else:
+                stats = sorted(vm_stats(self.content,names,opts['tenant'],opts['interval'],
+                                        samples,self.site['VC_DATACENTER']).items())
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+            return
+        self.print_stats(stats,list(VM_STATS))
+
+    def do_host_stats(self, line):
+        '''
+        Runtime performance of hosts, all connected ones without names
+        Example: host_stats [HOST...] [--interval INTERVAL] [--samples N]
+        '''
+        names,opts = self.options(line,interval='realtime',samples=PERF_SAMPLES)
+        try:
+            stats = host_stats(self.content,names,opts['interval'],int(opts['samples']),
+                               self.site['VC_DATACENTER'])
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+            return
+        self.print_stats(sorted(stats.items()),list(HOST_STATS))
+
+    def do_datastore_stats(self, line):
+        '''
+        Latency and iops of datastores, as seen by the hosts mounting them
+        Example: datastore_stats [DATASTORE...] [--interval INTERVAL] [--samples N]
+        '''
+        names,opts = self.options(line,interval='realtime',samples=PERF_SAMPLES)
+        try:
+            stats = datastore_stats(self.content,names,opts['interval'],int(opts['samples']),
+                                    self.site['VC_DATACENTER'])
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+            return
+        self.print_stats(sorted(stats.items()),list(DATASTORE_STATS))
+
+    def do_watch(self, line):
+        '''
+        Stream changes of the vms in a tenant or cluster until Ctrl-C:
+        new (+) and removed (-) vms, power state, cpu, ram and ip changes (~)
+        and the progress of tasks on them. Clones into the tenant run on their
+        template, they show as the new vm once done. Only changes travel,
+        nothing is polled.
+        Example: watch TENANT [--for SECONDS]
+                 watch --cluster CLUSTER [--for SECONDS]
+        '''
+        args,opts = self.options(line,cluster=None,**{'for':None})
+        try:
+            duration = float(opts['for']) if opts['for'] else None
+        except ValueError:
+            print("ERR: --for takes a number of seconds")
+            return
+        if opts['cluster']:
+            root = get_obj(self.content,[vim.ClusterComputeResource],opts['cluster'])
+        elif args:
+            root = tenant_folder(self.content,args[0],self.site['VC_DATACENTER'])
+        else:
+            print('Please provide arguments as in help')
+            return
+        if root is None:
+            print("Not found")
+            return
+        marks = {'added':'+','removed':'-','changed':'~'}
+        try:
+            for event in watch(self.content,root,duration=duration):
+                if self.output != 'text':
+                    self.emit(**event)
+                    continue
+                stamp = time.strftime('%H:%M:%S')
+                if event['event'] == 'task':
+                    progress = '' if event['progress'] is None else ' {}%'.format(event['progress'])
+                    print("{} task {} {} {}{}".format(stamp,event['name'],event['task'],event['state'],progress))
+                else:
+                    changes = ' '.join("{}={}".format(path.split('.')[-1],value)
+                                       for path,value in sorted(event['changes'].items()) if path != 'name')
+                    print("{} {} {} {}".format(stamp,marks[event['event']],event['name'],changes).rstrip())
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            print("Stopped")
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+
+    def do_profile(self, line):
+        '''
+        Profile the vcenter calls of the commands that follow
+        Example: profile on|off|reset
+                 profile [show] [--top N]
+                 profile export FILENAME
+                 profile serve PORT
+        show lists per command the calls, KB sent and received and seconds
+        on the network, waiting for updates and on tasks, then calls by
+        method with latency percentiles and the N (default 10) property paths
+        with the most call time. export writes the totals as OpenMetrics
+        text, serve publishes them on http://HOST:PORT/metrics.
+        '''
+        args,opts = self.options(line,top='10')
+        action = args[0] if args else 'show'
+        if action == 'on':
+            if self.profiler is None:
+                self.profiler = Profiler()
+            for site,content in self.sites:
+                self.profiler.attach(content.rootFolder._stub)
+            print("Profiling")
+            return
+        if self.profiler is None:
+            print("ERR: profiling is off, use profile on")
+            return
+        if action == 'off':
+            self.profiler.detach()
+            self.profiler = None
+            print("Stopped profiling")
+        elif action == 'reset':
+            self.profiler.reset()
+        elif action == 'export' and len(args) > 1:
+            with open(args[1], 'w') as f:
+                f.write(self.profiler.openmetrics())
+            print("Written to {}".format(args[1]))
+        elif action == 'serve' and len(args) > 1:
+            try:
+                self.profiler.serve(int(args[1]))
+            except (OSError, ValueError) as err:
+                print("ERR: {}".format(err))
+                return
+            print("Serving metrics on port {}".format(args[1]))
+        elif action == 'show':
+            self.print_profile(int(opts['top']))
+        else:
+            print('Please provide arguments as in help')
+
+    def print_profile(self, top):
+        '''profile commands, methods and top property paths as tables or records'''
+        profiler = self.profiler
+        with profiler.lock:
+            commands = [(line,stats.summary()) for line,stats in profiler.commands.items()]
+            total = profiler.total
+            methods = [(method,total.calls[method],total.seconds[method],total.percentile(method,0.5),
+                        total.percentile(method,0.9),total.percentile(method,0.99),total.slowest[method])
+                       for method in sorted(total.calls,key=lambda m: -total.seconds[m])]
+            paths = sorted(total.paths.items(),key=lambda item: -item[1][1])[:top]
+        if self.output != 'text':
+            for line,summary in commands:
+                self.emit(kind='command',line=line,**summary)
+            for method,calls,seconds,p50,p90,p99,slowest in methods:
+                self.emit(kind='method',method=method,calls=calls,seconds=seconds,
+                          p50=p50,p90=p90,p99=p99,max=slowest)
+            for path,(calls,seconds,slowest) in paths:
+                self.emit(kind='path',path=path,calls=calls,seconds=seconds,max=slowest)
+            return
+        print("{:<40s} {:>6s} {:>9s} {:>9s} {:>8s} {:>8s} {:>8s}".format(
+              'COMMAND','CALLS','SENT(KB)','RECV(KB)','NET(s)','WAIT(s)','TASKS(s)'))
+        print('----')
+        for line,summary in commands:
+            print("{:<40s} {:>6d} {:>9.1f} {:>9.1f} {:>8.3f} {:>8.3f} {:>8.3f}".format(
+                  line[:40],summary['calls'],summary['sent']/1024,summary['received']/1024,
+                  summary['network'],summary['wait'],summary['tasks']))
+        print("\n{:<40s} {:>6s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+              'METHOD','CALLS','TOTAL(s)','p50(ms)','p90(ms)','p99(ms)','MAX(ms)'))
+        print('----')
+        for method,calls,seconds,p50,p90,p99,slowest in methods:
+            print("{:<40s} {:>6d} {:>9.3f} {:>9.0f} {:>9.0f} {:>9.0f} {:>9.1f}".format(
+                  method,calls,seconds,p50*1000,p90*1000,p99*1000,slowest*1000))
+        print("\n{:<40s} {:>6s} {:>9s} {:>9s}".format('PROPERTY PATH','CALLS','TOTAL(s)','MAX(ms)'))
+        print('----')
+        for path,(calls,seconds,slowest) in paths:
+            print("{:<40s} {:>6d} {:>9.3f} {:>9.1f}".format(path[:40],calls,seconds,slowest*1000))
+
     def do_set(self, line):
         '''
-        Set virtual machine settings
-        NOT IMPLEMENTED YET
+        Set virtual machine settings in one reconfigure task
+        Example: set NAME CPU RAM HDD [EPG] [--dry-run]
+        Use \'default\' to keep the current value. With --dry-run
+        only show what would change.
         '''
-        pass
+        args = line.split()
+        dry_run = '--dry-run' in args
+        args = [None if arg.lower() == 'default' else arg for arg in args if arg != '--dry-run']
+        if len(args) < 4:
+            print('Please provide arguments as in help')
+            return
+        vm_name,cpu,ram,hdd = args[:4]
+        epg = args[4] if len(args) > 4 else None
+        try:
+            diff = vm_settings(self.content,vm_name,cpu,ram,hdd,epg,dry_run=dry_run)
+        except Exception as err:
+            print("Could not change settings to {} :-(\nERR: {}".format(vm_name,getattr(err,'msg',err)))
+            return
+        if not diff:
+            print("Nothing to change")
+        for setting,old,new in diff:
+            if self.output != 'text':
+                self.emit(name=vm_name,setting=setting,old=old,new=new,applied=not dry_run)
+            else:
+                print("{:<5s} {} -> {}".format(setting,old,new))
+        if diff and not dry_run:
+            print("Completed")
 
     def do_add(self, line):
         '''
-        Add virtual device
-        NOT IMPLEMENTED YET
+        Add disks to a virtual machine in one reconfigure task
+        Example: add disk NAME SIZE[:TYPE] [COUNTxSIZE[:TYPE] ...] [--datastore DS]
+                 [--controller pvscsi|lsilogic|lsisas] [--spread N] [--dry-run]
+        SIZE in GB, TYPE thin (default), thick or eager. Disks go on the
+        least used scsi controller, new --controller controllers (pvscsi by
+        default) are added when they are full, or to have at least --spread
+        of them. With --dry-run only show the layout.
         '''
-        pass
+        dry_run = '--dry-run' in line.split()
+        args, opts = self.options(line.replace('--dry-run',''), datastore=None,
+                                  controller='pvscsi', spread='1')
+        if len(args) < 3 or args[0] != 'disk':
+            print('Please provide arguments as in help')
+            return
+        vm_name = args[1]
+        disks = []
+        try:
+            for arg in args[2:]:
+                size, _, kind = arg.partition(':')
+                count, _, size = size.rpartition('x')
+                disks += [{'size': int(size), 'type': kind or 'thin', 'datastore': opts['datastore']}
+                          for i in range(int(count or 1))]
+            layout = add_disks(self.content, vm_name, disks, opts['controller'],
+                               int(opts['spread']), dry_run=dry_run)
+        except Exception as err:
+            print("Could not add disks to {} :-(\nERR: {}".format(vm_name,getattr(err,'msg',err)))
+            return
+        for device,what in layout:
+            if self.output != 'text':
+                self.emit(name=vm_name,device=device,added=what,applied=not dry_run)
+            else:
+                print("{:<8s} {}".format(device,what))
+        if not dry_run:
+            print("Completed")
+
+    def guest_login(self, user=None):
+        '''
+        (user, password) of guest logins: user defaults to GUEST_USER of
+        .credentials or root, the password is GUEST_PASS or asked once
+        '''
+        user = user or self.site.get('GUEST_USER') or 'root'
+        if user not in self.guest_passwords:
+            if user == self.site.get('GUEST_USER') and self.site.get('GUEST_PASS') is not None:
+                self.guest_passwords[user] = self.site['GUEST_PASS']
+            elif self.batch:
+                self.refused = True
+                raise Exception("no GUEST_PASS for {} in {}, batch mode can't ask for it".format(user,__credentials__))
+            else:
+                self.guest_passwords[user] = getpass.getpass("{} password in the guests: ".format(user))
+        return user, self.guest_passwords[user]
 
     def do_shell(self, line):
         '''
-        Drop to virtual machine shell
-        NOT IMPLEMENTED YET
+        Run commands inside a virtual machine until exit
+        Example: shell NAME [--user USER] [--timeout SECONDS]
+        Every line goes to the guest shell, its output is shown as it comes.
+        ps lists the guest processes, get GUEST_PATH [LOCAL] and
+        put LOCAL GUEST_PATH copy files, exit leaves.
         '''
-        pass
-    
+        args,opts = self.options(line,user=None,timeout=GUEST_TIMEOUT)
+        if not args:
+            print("ERR: shell NAME [--user USER]")
+            return
+        if self.batch:
+            self.refused = True
+            print("ERR: shell is interactive, use run in batch mode")
+            return
+        vm = get_obj(self.content,[vim.VirtualMachine],name=args[0])
+        if not vm:
+            print("No vm with {} name found".format(args[0]))
+            return
+        try:
+            user,password = self.guest_login(opts['user'])
+            session = guest_session(self.content,vm,user,password)
+        except vim.fault.InvalidGuestLogin as err:
+            self.guest_passwords.pop(user,None)
+            print("ERR: {}".format(err.msg))
+            return
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+            return
+        while True:
+            try:
+                command = input("[{}]# ".format(args[0])).strip()
+            except EOFError:
+                print()
+                break
+            words = command.split()
+            if not words:
+                continue
+            try:
+                if words[0] == 'exit':
+                    break
+                elif words[0] == 'ps':
+                    for process in sorted(session.ps(),key=lambda process: process.pid):
+                        print("{:>8d} {:<12s} {:<20s} {}".format(process.pid,process.owner or '-',
+                              str(process.startTime)[:19],process.cmdLine or process.name))
+                elif words[0] == 'get' and len(words) in (2, 3):
+                    local = words[2] if len(words) == 3 else os.path.basename(words[1].replace('\\','/'))
+                    with open(local,'wb') as f:
+                        f.write(session.read(words[1]))
+                    print("Copied to {}".format(local))
+                elif words[0] == 'put' and len(words) == 3:
+                    with open(words[1],'rb') as f:
+                        session.write(words[2],f.read())
+                    print("Copied to {}".format(words[2]))
+                else:
+                    code = session.run(command,output=print,timeout=int(opts['timeout']))
+                    if code:
+                        print("exit {}".format(code))
+            except Exception as err:
+                print("ERR: {}".format(getattr(err,'msg',err)))
+
     def do_run(self, line):
         '''
-        Run command inside virtual machine
-        NOT IMPLEMENTED YET
+        Run a command inside many virtual machines at once
+        Example: run NAME [NAME|GLOB ...] -- COMMAND
+                 run --tenant TENANT [--file FILENAME] [--user USER] [--workers N]
+                     [--timeout SECONDS] [--put LOCAL:GUEST_PATH] -- COMMAND
+        Output lines are prefixed by the vm name as they are written. --put
+        copies a local file into every guest before the command runs, a
+        script to run say. --workers limits the vms at once (default 16).
+        The guest login is kept for later run and shell commands.
         '''
-        pass
-        
+        head,sep,command = (' '+line).partition(' -- ')
+        args,opts = self.options(head,tenant=None,file=None,user=None,workers=GUEST_TASKS,
+                                 timeout=GUEST_TIMEOUT,put=None)
+        if not sep or not command.strip() or not (args or opts['tenant'] or opts['file']):
+            print("ERR: run NAME|GLOB ... | --tenant TENANT | --file FILENAME -- COMMAND")
+            return
+        try:
+            upload = None
+            if opts['put']:
+                local,colon,remote = opts['put'].partition(':')
+                if not colon:
+                    raise Exception("--put takes LOCAL:GUEST_PATH")
+                with open(local,'rb') as f:
+                    upload = (f.read(),remote)
+            if opts['file']:
+                with open(opts['file']) as stream:
+                    args += [l.strip() for l in stream if l.strip() and not l.startswith('#')]
+            vms = select_vms(self.content, args, opts['tenant'], self.site['VC_DATACENTER'])
+        except Exception as err:
+            print("ERR: {}".format(getattr(err,'msg',err)))
+            return
+        if not vms:
+            print("No vm found")
+            return
+        print("run on {} vms: {}".format(len(vms), ' '.join(sorted(vms))))
+        if not self.confirm():
+            return
+        try:
+            user,password = self.guest_login(opts['user'])
+        except Exception as err:
+            print("ERR: {}".format(err))
+            return
+        lock = threading.Lock()
+
+        def output(name, text):
+            with lock:
+                if self.output != 'text':
+                    self.emit(name=name,line=text)
+                else:
+                    print("[{}] {}".format(name,text))
+
+        def progress(name, code, err):
+            with lock:
+                if self.output != 'text':
+                    self.emit(name=name,exit=code,error=str(getattr(err,'msg',err)) if err else None)
+                elif err:
+                    print("[{}] failed :-(\nERR: {}".format(name,getattr(err,'msg',err)))
+                else:
+                    print("[{}] exit {}".format(name,code))
+
+        results = guest_run(self.content, vms, command.strip(), user, password,
+                            workers=int(opts['workers']), timeout=int(opts['timeout']),
+                            upload=upload, output=output, progress=progress)
+        if any(isinstance(result, vim.fault.InvalidGuestLogin) for result in results.values()):
+            self.guest_passwords.pop(user,None)
+        names = {row['obj']._moId:name for name,row in vms.items()}
+        failed = [names[moid] for moid,result in results.items() if result != 0]
+        print("Completed {} of {}".format(len(results)-len(failed),len(results)))
+        if failed:
+            print("Failed: {}".format(' '.join(sorted(failed))))
+
+
+def run_batch(commands, output='ndjson', assume_yes=False):
+    '''
+    Run commands over one vcenter session. With json/ndjson output every
+    result is written to stdout as soon as it's there. Nothing is read from
+    stdin, commands that need a confirmation fail unless assume_yes.
+    Returns the number of failed commands.
+    '''
+    shell = VcenterShell()
+    shell.batch = True
+    shell.output = output
+    shell.assume_yes = assume_yes
+    out = sys.stdout
+    first = [True]
+
+    def write(record):
+        line = json.dumps(record, default=str)
+        if output == 'json':
+            line = ('[\n' if first[0] else ',\n') + line
+            first[0] = False
+        else:
+            line += '\n'
+        out.write(line)
+        out.flush()
+
+    shell.writer = write
+    with contextlib.redirect_stdout(sys.stderr):
+        shell.do_connect_to_api('')
+    failed = 0
+    for line in commands:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if output == 'text':
+            shell.refused = False
+            stop = shell.onecmd(line)
+            failed += shell.refused
+            if stop:
+                break
+            continue
+        ok, stop = shell.run(line)
+        failed += not ok
+        if stop:
+            break
+    if output == 'json':
+        out.write('[\n]\n' if first[0] else '\n]\n')
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='vcenter shell, interactive without commands')
+    parser.add_argument('commands', nargs='*', help='shell commands to run, one per argument')
+    parser.add_argument('-f', '--file', help='script with one command per line, - for stdin')
+    parser.add_argument('-o', '--output', choices=['ndjson','json','text'], default='ndjson',
+                        help='batch output format (default ndjson)')
+    parser.add_argument('-y', '--yes', action='store_true', help='answer yes to confirmations, batch commands that need one fail without it')
+    args = parser.parse_args(argv)
+
+    script = []
+    if args.file == '-' or (not args.commands and not args.file and not sys.stdin.isatty()):
+        # read lazily, so piped commands run as they come
+        script = sys.stdin
+    elif args.file:
+        with open(args.file) as f:
+            script = f.readlines()
+    if args.commands or script:
+        return 1 if run_batch(itertools.chain(args.commands, script), args.output, args.yes) else 0
 
-if __name__ == '__main__':
     myshell = VcenterShell()
     try:
         myshell.cmdloop()
     except KeyboardInterrupt:
         print("Exiting...")
-        
-    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())